@@ -1,31 +1,116 @@
 import os
+import json
 import logging
 import random
+import time
 import traceback
 
 from typing import Optional
 
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import StreamingResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 
-from t5qg import T5
+from t5qg import T5, OnnxT5
+from t5qg.batch_scheduler import BatchScheduler, get_executor
+from t5qg.decoding import DecodingPolicy
+from t5qg.exceptions import QueueFullError, ModelNotFoundError
+from t5qg.instrumentation import METRICS
+from t5qg.model_registry import ModelRegistry, parse_mapping
+from t5qg.result_cache import ResultCache
 
 logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s', level=logging.DEBUG, datefmt='%Y-%m-%d %H:%M:%S')
 
 
 # Initialization
 MODEL = os.getenv('MODEL', 'asahi417/question-generation-squad-t5-small')
+# named models (`name=path,name=path`) and the model of each language (`language=name,language=name`)
+MODELS = parse_mapping(os.getenv('MODELS', None)) or {'default': MODEL}
+MODEL_LANGUAGES = parse_mapping(os.getenv('MODEL_LANGUAGES', None))
+DEFAULT_MODEL = os.getenv('DEFAULT_MODEL', list(MODELS.keys())[0])
+MAX_MODEL_MEMORY_GB = os.getenv('MAX_MODEL_MEMORY_GB', None)
+ALLOW_MODEL_SWAP = os.getenv('ALLOW_MODEL_SWAP', '0') == '1'
 MAX_LENGTH = int(os.getenv('MAX_LENGTH', 512))
 MAX_LENGTH_OUTPUT = int(os.getenv('MAX_LENGTH_OUTPUT', 32))
-qg_model = T5(MODEL, MAX_LENGTH, MAX_LENGTH_OUTPUT)
+ONNX = os.getenv('ONNX', '0') == '1'
+QUANTIZE = os.getenv('QUANTIZE', '0') == '1'
+TORCH_NUM_INTEROP_THREADS = os.getenv('TORCH_NUM_INTEROP_THREADS', None)
+DRAFT_MODEL = os.getenv('DRAFT_MODEL', None)
+DRAFT_MODELS = parse_mapping(os.getenv('DRAFT_MODELS', None))
+if DRAFT_MODEL is not None:
+    DRAFT_MODELS.setdefault(DEFAULT_MODEL, DRAFT_MODEL)
+MAX_BATCH_SIZE = int(os.getenv('MAX_BATCH_SIZE', 32))
+MAX_WAIT_MS = float(os.getenv('MAX_WAIT_MS', 10))
+RESULT_CACHE_SIZE = int(os.getenv('RESULT_CACHE_SIZE', 10000))
+RESULT_CACHE_TTL = os.getenv('RESULT_CACHE_TTL', None)
+RESULT_CACHE_PATH = os.getenv('RESULT_CACHE_PATH', None)
+MAX_CONCURRENCY = int(os.getenv('MAX_CONCURRENCY', 1))
+MAX_QUEUE_SIZE = int(os.getenv('MAX_QUEUE_SIZE', 256))
+TORCH_NUM_THREADS = os.getenv('TORCH_NUM_THREADS', None)
+RETRY_AFTER = int(os.getenv('RETRY_AFTER', 1))
+STREAM_CHUNK_SIZE = int(os.getenv('STREAM_CHUNK_SIZE', 4))
+LATENCY_BUDGET_MS = os.getenv('LATENCY_BUDGET_MS', None)
+NUM_CANDIDATES = os.getenv('NUM_CANDIDATES', None)
+SKIP_OVERFLOW_ERROR = os.getenv('SKIP_OVERFLOW_ERROR', '0') == '1'
+if os.getenv('METRICS', '1') == '1':
+    METRICS.enable()
+# the result cache is shared by the models as its key includes the model fingerprint
+result_cache = None
+if RESULT_CACHE_SIZE > 0:
+    result_cache = ResultCache(max_entries=RESULT_CACHE_SIZE,
+                               ttl=None if RESULT_CACHE_TTL is None else float(RESULT_CACHE_TTL),
+                               path=RESULT_CACHE_PATH)
+executor = get_executor(MAX_CONCURRENCY, None if TORCH_NUM_THREADS is None else int(TORCH_NUM_THREADS))
+
+
+def load_model(name: str, path: str):
+    start = time.time()
+    # the model serving a single language splits the sentences without the language detection
+    languages = [k for k, v in MODEL_LANGUAGES.items() if v == name]
+    language = languages[0] if len(languages) == 1 else None
+    if ONNX:
+        qg_model = OnnxT5(path, MAX_LENGTH, MAX_LENGTH_OUTPUT, language=language)
+    else:
+        qg_model = T5(path, MAX_LENGTH, MAX_LENGTH_OUTPUT, quantize=QUANTIZE, draft_model=DRAFT_MODELS.get(name),
+                      language=language,
+                      num_interop_threads=None if TORCH_NUM_INTEROP_THREADS is None else int(TORCH_NUM_INTEROP_THREADS))
+    qg_model.startup_time['total'] = time.time() - start
+    qg_model.result_cache = result_cache
+    qg_model.decoding_policy = DecodingPolicy(
+        latency_budget=None if LATENCY_BUDGET_MS is None else float(LATENCY_BUDGET_MS) / 1000,
+        num_candidates=None if NUM_CANDIDATES is None else int(NUM_CANDIDATES))
+    return qg_model
+
+
+def get_scheduler(qg_model):
+    return BatchScheduler(
+        qg_model, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS, max_concurrency=MAX_CONCURRENCY,
+        max_queue_size=MAX_QUEUE_SIZE, executor=executor, skip_overflow_error=SKIP_OVERFLOW_ERROR)
+
+
+registry = ModelRegistry(
+    MODELS, loader=load_model, scheduler_factory=get_scheduler, languages=MODEL_LANGUAGES, default=DEFAULT_MODEL,
+    max_memory_gb=None if MAX_MODEL_MEMORY_GB is None else float(MAX_MODEL_MEMORY_GB))
 
 
 # Run app
 class ModelInput(BaseModel):
     input_text: str
     highlight: Optional[str] = None
-    num_beam: int = 4
+    num_beam: Optional[int] = None
+    latency_budget_ms: Optional[float] = None
+    model: Optional[str] = None
+    language: Optional[str] = None
+
+    @property
+    def latency_budget(self):
+        return None if self.latency_budget_ms is None else self.latency_budget_ms / 1000
+
+
+class ModelSwapInput(BaseModel):
+    name: str
+    path: str
 
 
 app = FastAPI()
@@ -38,6 +123,18 @@ app.add_middleware(
 )
 
 
+@app.on_event("startup")
+async def startup():
+    # load the default model before the first request
+    async with registry.acquire():
+        pass
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await registry.close()
+
+
 # Endpoint
 @app.get("/")
 def read_root():
@@ -47,30 +144,95 @@ def read_root():
 @app.get("/info")
 async def info():
     return {
-        "model": MODEL,
+        "model": registry.stats(),
         "max_length": MAX_LENGTH,
-        "max_length_output": MAX_LENGTH_OUTPUT
+        "max_length_output": MAX_LENGTH_OUTPUT,
+        "quantize": QUANTIZE,
+        "onnx": ONNX,
+        "draft_model": DRAFT_MODELS,
+        "max_batch_size": MAX_BATCH_SIZE,
+        "max_wait_ms": MAX_WAIT_MS,
+        "max_concurrency": MAX_CONCURRENCY,
+        "max_queue_size": MAX_QUEUE_SIZE,
+        "result_cache": None if result_cache is None else result_cache.stats()
     }
 
 
+@app.get("/metrics")
+async def metrics():
+    """ Metrics in the Prometheus text format. """
+    return PlainTextResponse(METRICS.render(), media_type='text/plain; version=0.0.4')
+
+
+@app.post("/model")
+async def swap_model(model_input: ModelSwapInput):
+    """ Swap the model of the name to a new checkpoint (or register a new model) without dropping the requests. """
+    if not ALLOW_MODEL_SWAP:
+        raise HTTPException(status_code=403, detail='Model swap is disabled (set `ALLOW_MODEL_SWAP=1`).')
+    try:
+        await registry.swap(model_input.name, model_input.path)
+    except Exception:
+        logging.exception('Error')
+        raise HTTPException(status_code=400, detail='Failed to load `{}`.'.format(model_input.path))
+    return registry.stats()
+
+
 @app.post("/question_generation")
 async def process(model_input: ModelInput):
     if len(model_input.input_text) == 0:
         raise HTTPException(status_code=404, detail='Input text is empty string.')
     try:
-        if model_input.highlight is None or len(model_input.highlight) == 0:
-            qa_list = qg_model.generate_qa(model_input.input_text, num_beams=model_input.num_beam)
-        else:
-            out = qg_model.generate_q([model_input.input_text],
-                                      list_answer=[model_input.highlight],
-                                      num_beams=model_input.num_beam)
-            qa_list = [(out[0], model_input.highlight)]
+        with METRICS.timer('t5qg_request_seconds', endpoint='question_generation'):
+            async with registry.acquire(model_input.model, model_input.language) as scheduler:
+                if model_input.highlight is None or len(model_input.highlight) == 0:
+                    qa_list = await scheduler.generate_qa(model_input.input_text, num_beams=model_input.num_beam,
+                                                          latency_budget=model_input.latency_budget,
+                                                          language=model_input.language)
+                else:
+                    out = await scheduler.generate_q(model_input.input_text, model_input.highlight,
+                                                     num_beams=model_input.num_beam,
+                                                     latency_budget=model_input.latency_budget)
+                    qa_list = [(out, model_input.highlight)]
         return {'qa': qa_list}
-    except Exception:
+    except ModelNotFoundError as e:
+        METRICS.error(e)
+        raise HTTPException(status_code=404, detail=e.message)
+    except QueueFullError as e:
+        METRICS.error(e)
+        raise HTTPException(status_code=429, detail=e.message, headers={'Retry-After': str(RETRY_AFTER)})
+    except Exception as e:
+        METRICS.error(e)
         logging.exception('Error')
         raise HTTPException(status_code=404, detail=traceback.print_exc())
 
 
+@app.post("/question_generation_stream")
+async def process_stream(model_input: ModelInput):
+    """ Stream the (question, answer) pairs as newline-delimited json as soon as each of them is generated. """
+    if len(model_input.input_text) == 0:
+        raise HTTPException(status_code=404, detail='Input text is empty string.')
+
+    async def generate():
+        try:
+            async with registry.acquire(model_input.model, model_input.language) as scheduler:
+                if model_input.highlight is None or len(model_input.highlight) == 0:
+                    async for q, a in scheduler.generate_qa_stream(
+                            model_input.input_text, num_beams=model_input.num_beam, chunk_size=STREAM_CHUNK_SIZE,
+                            latency_budget=model_input.latency_budget, language=model_input.language):
+                        yield json.dumps({'qa': [q, a]}) + '\n'
+                else:
+                    q = await scheduler.generate_q(model_input.input_text, model_input.highlight,
+                                                   num_beams=model_input.num_beam,
+                                                   latency_budget=model_input.latency_budget)
+                    yield json.dumps({'qa': [q, model_input.highlight]}) + '\n'
+        except Exception as e:
+            METRICS.error(e)
+            logging.exception('Error')
+            yield json.dumps({'error': '{}: {}'.format(type(e).__name__, str(e))}) + '\n'
+
+    return StreamingResponse(generate(), media_type='application/x-ndjson')
+
+
 @app.post("/question_generation_dummy")
 async def process(model_input: ModelInput):
     i = random.randint(0, 2)
@@ -15,17 +15,16 @@ def get_prediction(model: str, batch_size: int = 32, max_length: int = 512, max_
     predictions = {}
 
     for _split in ['dev', 'test']:
-        full_examples = get_dataset("squad", split=_split, return_raw_triplet=True)
-        context = [i['context'] for i in full_examples]
+        context, _, _ = get_dataset("squad", split=_split, return_raw_triplet=True)
         q_list = []
         a_list = []
-        for c in context:
-            qa_list = lm.generate_qa(c, num_beams=num_beams, batch_size=batch_size)
-            qa_list = list(zip(qa_list))
-            q_list.append(qa_list[0])
-            a_list.append(qa_list[1])
-        predictions[_split]['question'] = q_list
-        predictions[_split]['answer'] = a_list
+        # all the contexts are batched together, and the failed ones get empty prediction
+        for qa_list in lm.generate_qa_batch(context, num_beams=num_beams, batch_size=batch_size):
+            if isinstance(qa_list, Exception):
+                qa_list = []
+            q_list.append([q for q, _ in qa_list])
+            a_list.append([a for _, a in qa_list])
+        predictions[_split] = {'question': q_list, 'answer': a_list}
     return predictions
 
 
@@ -35,7 +35,7 @@ setup(
         "pandas",
         "gdown",
         "numpy",
-        "transformers",
+        "transformers>=4.26",
         "sentencepiece",
         "tensorboard",
         "datasets",
@@ -46,12 +46,17 @@ setup(
         'uvicorn',
         'pydantic'
     ],
-    python_requires='>=3.6',
+    extras_require={
+        'onnx': ['onnx', 'onnxruntime'],  # t5qg-export and OnnxT5
+        'packing': ['transformers>=4.26,<4.46']  # the 3D attention masks of the sequence packing (`--packing`)
+    },
+    python_requires='>=3.7',
     entry_points={
         'console_scripts': [
             't5qg-train = t5qg_cl.model_training:main',
             't5qg-eval = t5qg_cl.model_evaluation:main',
             't5qg-search = t5qg_cl.model_search:main',
+            't5qg-export = t5qg_cl.model_export:main',
         ]
     }
 )
@@ -1,7 +1,25 @@
-from .evaluator import evaluate_qg
-from .grid_searcher import GridSearcher
-from .trainer import Trainer
+""" Modules pulling heavy dependencies (nlgeval, gdown, requests, nltk, onnxruntime) are imported at the first access. """
+import importlib
+
 from .lm_t5 import T5
-from .data import get_dataset, wget
-from . import sentence_split, exceptions
+from . import exceptions
+
+LAZY_ATTRIBUTE = {
+    'evaluate_qg': 'evaluator',
+    'evaluate_quantization': 'evaluator',
+    'GridSearcher': 'grid_searcher',
+    'Trainer': 'trainer',
+    'get_dataset': 'data',
+    'wget': 'data',
+    'OnnxT5': 'onnx_model',
+    'export_onnx': 'onnx_model'
+}
+LAZY_MODULE = ['sentence_split', 'evaluator', 'grid_searcher', 'trainer', 'data', 'onnx_model']
+
 
+def __getattr__(name):
+    if name in LAZY_ATTRIBUTE:
+        return getattr(importlib.import_module('.{}'.format(LAZY_ATTRIBUTE[name]), __name__), name)
+    if name in LAZY_MODULE:
+        return importlib.import_module('.{}'.format(name), __name__)
+    raise AttributeError('module {} has no attribute {}'.format(__name__, name))
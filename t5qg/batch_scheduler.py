@@ -0,0 +1,256 @@
+""" Request-coalescing scheduler to serve concurrent requests with a single batched model call. """
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+import torch
+
+from .exceptions import HighlightNotFoundError, QueueFullError, AnswerNotFoundError, ExceedMaxLengthError
+from .instrumentation import METRICS
+
+__all__ = ('BatchScheduler', 'get_executor')
+
+
+def get_executor(max_workers: int = 1, num_threads: int = None):
+    """ Thread pool to run the model. The intra-op thread count of torch is process-wide, so it is set once to the
+    share of each worker, so that the concurrent model invocations do not oversubscribe the cores in total.
+
+    @param max_workers: Number of concurrent model invocations.
+    @param num_threads: Total number of the intra-op threads (`torch.get_num_threads()` if None).
+    @return: concurrent.futures.ThreadPoolExecutor
+    """
+    num_threads = torch.get_num_threads() if num_threads is None else num_threads
+    torch.set_num_threads(max(1, num_threads // max_workers))
+    return ThreadPoolExecutor(max_workers=max_workers)
+
+
+class Request:
+    """ Single prediction request waiting in the queue. """
+
+    def __init__(self, context: str, highlight: str or None, task_type: str, num_beams: int or None, future,
+                 latency_budget: float = None):
+        self.context = context
+        self.highlight = highlight
+        self.task_type = task_type
+        self.num_beams = num_beams
+        self.latency_budget = latency_budget
+        self.future = future
+        self.created = time.perf_counter()
+
+    @property
+    def key(self):
+        return self.task_type, self.num_beams, self.latency_budget
+
+
+class BatchScheduler:
+    """ Micro-batching scheduler: requests are put on an asyncio queue and coalesced into one
+    `T5.generate_prediction` call, bounded by the max batch size and the max waiting time. """
+
+    def __init__(self,
+                 model,
+                 max_batch_size: int = 32,
+                 max_wait_ms: float = 10,
+                 skip_overflow_error: bool = False,
+                 executor=None,
+                 max_concurrency: int = 1,
+                 max_queue_size: int = 0):
+        """ Micro-batching scheduler.
+
+        @param model: t5qg.T5 instance.
+        @param max_batch_size: Max number of requests in a single model call.
+        @param max_wait_ms: Max time (milliseconds) to wait for the batch to be filled.
+        @param skip_overflow_error: Truncate the input exceeding the max token length instead of raising error (the
+            error is raised to the request of the input only, not to the other requests in the batch).
+        @param executor: concurrent.futures.Executor to run the model (default executor of the loop if None).
+        @param max_concurrency: Max number of the batches running on the executor at the same time.
+        @param max_queue_size: Max number of the requests waiting in the queue, beyond which QueueFullError is
+            raised (unbounded if 0).
+        """
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.skip_overflow_error = skip_overflow_error
+        self.executor = executor
+        self.max_concurrency = max_concurrency
+        self.max_queue_size = max_queue_size
+        self.queue = None
+        self.worker = None
+
+    def start(self):
+        """ Start the background worker (should be called inside the running event loop). """
+        if self.worker is None:
+            self.queue = asyncio.Queue(maxsize=self.max_queue_size)
+            self.worker = asyncio.get_event_loop().create_task(self.run())
+        return self
+
+    @property
+    def queue_size(self):
+        return 0 if self.queue is None else self.queue.qsize()
+
+    async def stop(self):
+        if self.worker is not None:
+            self.worker.cancel()
+            try:
+                await self.worker
+            except asyncio.CancelledError:
+                pass
+            self.worker = None
+
+    async def submit(self, context: str, highlight: str = None, task_type: str = 'qg', num_beams: int = None,
+                     latency_budget: float = None):
+        """ Put a single input on the queue and wait for the prediction.
+
+        @param context: Input context.
+        @param highlight: Highlight phrase (answer for `qg`, sentence for `ans_ext`).
+        @param task_type: Either of `qg`, `ans_ext`, `qa`.
+        @param num_beams: Number of beam for model generation (the default of the task if None).
+        @param latency_budget: Latency budget (sec) of the batch to lower the number of beams.
+        @return: Generated sentence.
+        """
+        self.start()
+        future = asyncio.get_event_loop().create_future()
+        try:
+            self.queue.put_nowait(Request(context, highlight, task_type, num_beams, future, latency_budget))
+        except asyncio.QueueFull:
+            raise QueueFullError(self.max_queue_size)
+        return await future
+
+    async def generate_q(self, context: str, answer: str = None, num_beams: int = None, latency_budget: float = None):
+        return await self.submit(context, answer, task_type='qg', num_beams=num_beams, latency_budget=latency_budget)
+
+    async def generate_a(self, context: str, num_beams: int = None, latency_budget: float = None,
+                         language: str = None):
+        loop = asyncio.get_event_loop()
+        list_sentence = await loop.run_in_executor(self.executor, self.model.split_sentence, context, language)
+        out = await asyncio.gather(*[self.submit(
+            context, s, task_type='ans_ext', num_beams=num_beams, latency_budget=latency_budget)
+            for s in list_sentence])
+        return self.model.filter_answer(context, out)
+
+    async def generate_qa(self, context: str, num_beams: int = None, latency_budget: float = None,
+                          language: str = None):
+        list_answer = await self.generate_a(context, num_beams=num_beams, latency_budget=latency_budget,
+                                            language=language)
+        list_question = await asyncio.gather(
+            *[self.generate_q(context, a, num_beams, latency_budget) for a in list_answer])
+        return list(zip(list_question, list_answer))
+
+    async def generate_qa_stream(self, context: str, num_beams: int = None, chunk_size: int = 4,
+                                 latency_budget: float = None, language: str = None):
+        """ Async generator of (question, answer) pairs, where the sentences are processed in chunks and the answer
+        extraction of the next chunk runs while the questions of the current chunk are generated.
+
+        @param context: Input context.
+        @param num_beams: Number of beam for model generation (the default of the task if None).
+        @param chunk_size: Number of sentences in a chunk.
+        @param latency_budget: Latency budget (sec) of the batch to lower the number of beams.
+        @param language: Language of the context to split into the sentences (the language of the model if None).
+        """
+        loop = asyncio.get_event_loop()
+        list_sentence = await loop.run_in_executor(self.executor, self.model.split_sentence, context, language)
+        chunks = [list_sentence[i:i + chunk_size] for i in range(0, len(list_sentence), chunk_size)]
+
+        def extract(chunk):
+            return asyncio.ensure_future(asyncio.gather(*[self.submit(
+                context, s, task_type='ans_ext', num_beams=num_beams, latency_budget=latency_budget)
+                for s in chunk]))
+
+        n_pair = 0
+        next_answer = extract(chunks[0]) if len(chunks) > 0 else None
+        try:
+            for n in range(len(chunks)):
+                list_answer = await next_answer
+                next_answer = extract(chunks[n + 1]) if n + 1 < len(chunks) else None
+                try:
+                    list_answer = self.model.filter_answer(context, list_answer)
+                except AnswerNotFoundError:
+                    continue
+                list_question = [asyncio.ensure_future(self.generate_q(context, a, num_beams, latency_budget))
+                                 for a in list_answer]
+                for q, a in zip(list_question, list_answer):
+                    yield await q, a
+                    n_pair += 1
+        finally:
+            if next_answer is not None:
+                next_answer.cancel()
+        if n_pair == 0:
+            raise AnswerNotFoundError(context)
+
+    async def get_batch(self):
+        """ Wait for the first request, then keep collecting until the batch is full or the deadline passes. """
+        loop = asyncio.get_event_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        while True:
+            batch = await self.get_batch()
+            # requests can be batched together only if they share the task and the decoding config
+            groups = {}
+            for r in batch:
+                groups.setdefault(r.key, []).append(r)
+            for requests in groups.values():
+                await semaphore.acquire()
+                task = loop.create_task(self.process(requests))
+                task.add_done_callback(lambda _: semaphore.release())
+
+    async def process(self, requests: List[Request]):
+        now = time.perf_counter()
+        valid = []
+        for r in requests:
+            METRICS.observe('t5qg_queue_wait_seconds', now - r.created)
+            if r.future.cancelled():
+                continue
+            if r.highlight is not None and r.context.find(r.highlight) == -1:
+                r.future.set_exception(HighlightNotFoundError(r.highlight, r.context))
+                continue
+            valid.append(r)
+        if len(valid) == 0:
+            return
+        await self.run_batch(valid)
+
+    async def run_batch(self, valid: List[Request]):
+        logging.debug('batch size: {} ({}, num_beams={}, latency_budget={})'.format(len(valid), *valid[0].key))
+        list_highlight = [r.highlight for r in valid]
+        try:
+            out = await asyncio.get_event_loop().run_in_executor(
+                self.executor,
+                lambda: self.model.generate_prediction(
+                    [r.context for r in valid],
+                    list_highlight=None if all(h is None for h in list_highlight) else list_highlight,
+                    task_type=valid[0].task_type,
+                    num_beams=valid[0].num_beams,
+                    latency_budget=valid[0].latency_budget,
+                    skip_overflow_error=self.skip_overflow_error,
+                    batch_size=len(valid),
+                    dynamic_padding=True))
+            assert len(out) == len(valid), '{} != {}'.format(len(out), len(valid))
+        except ExceedMaxLengthError as e:
+            if len(valid) == 1:
+                valid[0].future.set_exception(e)
+                return
+            # find the overflow input by running the requests one by one
+            for r in valid:
+                await self.run_batch([r])
+            return
+        except Exception as e:
+            for r in valid:
+                if not r.future.done():
+                    r.future.set_exception(e)
+            return
+        for r, o in zip(valid, out):
+            if not r.future.done():
+                r.future.set_result(o)
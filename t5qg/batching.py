@@ -0,0 +1,320 @@
+""" Batch samplers and collate functions for the encoded features. """
+import heapq
+import itertools
+import logging
+import random
+from itertools import chain
+from typing import List, Dict
+
+import torch
+
+__all__ = ('BucketBatchSampler', 'RandomBatchSampler', 'TokenBudgetBatchSampler', 'DynamicPaddingCollator',
+           'PackedDataset', 'pack_examples')
+
+
+class EpochBatchSampler(torch.utils.data.Sampler):
+    """ Base batch sampler of which the shuffle is seeded by the epoch and the first batches of the epoch can be
+    skipped, so that the training resumes at the exact batch within an epoch. With multiple replicas (distributed
+    training), every process draws the same batches from the shared seed and takes its own share of them, padded
+    (or truncated with `drop_last`) to the same number of batches per process. """
+
+    def __init__(self, seed: int = None, num_replicas: int = 1, rank: int = 0):
+        assert num_replicas == 1 or seed is not None, 'seed is required to shard the batches over replicas'
+        assert 0 <= rank < num_replicas, (rank, num_replicas)
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.drop_last = False
+        self.epoch = 0
+        self.skip = 0
+
+    def set_epoch(self, epoch: int, skip: int = 0):
+        """ Set the epoch to seed the shuffle and the number of the batches to skip (eg. consumed before resume). """
+        self.epoch = epoch
+        self.skip = skip
+
+    @property
+    def rng(self):
+        # the global random state is used without seed
+        return random if self.seed is None else random.Random(self.seed + self.epoch)
+
+    def batches(self):
+        raise NotImplementedError()
+
+    def num_batches(self):
+        raise NotImplementedError()
+
+    def num_replica_batches(self):
+        """ Number of the batches of each process in the epoch, including the skipped ones. """
+        if self.drop_last:
+            return self.num_batches() // self.num_replicas
+        return (self.num_batches() + self.num_replicas - 1) // self.num_replicas
+
+    def __iter__(self):
+        batches = self.batches()
+        if self.num_replicas > 1:
+            size = self.num_replica_batches() * self.num_replicas
+            batches = batches[:size] if self.drop_last else (batches * size)[:size]
+            batches = batches[self.rank::self.num_replicas]
+        return itertools.islice(iter(batches), self.skip, None)
+
+    def __len__(self):
+        return max(0, self.num_replica_batches() - self.skip)
+
+
+class RandomBatchSampler(EpochBatchSampler):
+    """ Batch sampler of the shuffled examples. """
+
+    def __init__(self, size: int, batch_size: int, shuffle: bool = True, drop_last: bool = False, seed: int = None,
+                 num_replicas: int = 1, rank: int = 0):
+        """ Batch sampler of the shuffled examples.
+
+        @param size: Number of the examples.
+        @param batch_size: Batch size.
+        @param shuffle: Shuffle the examples.
+        @param drop_last: Drop the last incomplete batch (and the batches not shared evenly by the replicas).
+        @param seed: Seed of the shuffle, combined with the epoch (the global random state if None).
+        @param num_replicas: Number of the processes sharing the batches.
+        @param rank: Rank of the process.
+        """
+        super().__init__(seed, num_replicas, rank)
+        self.size = size
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+
+    def batches(self):
+        index = list(range(self.size))
+        if self.shuffle:
+            self.rng.shuffle(index)
+        batches = [index[i:i + self.batch_size] for i in range(0, len(index), self.batch_size)]
+        if self.drop_last and len(batches) > 0 and len(batches[-1]) < self.batch_size:
+            batches = batches[:-1]
+        return batches
+
+    def num_batches(self):
+        if self.drop_last:
+            return self.size // self.batch_size
+        return (self.size + self.batch_size - 1) // self.batch_size
+
+
+class BucketBatchSampler(EpochBatchSampler):
+    """ Batch sampler grouping the examples of similar length, so that each batch needs little padding. """
+
+    def __init__(self,
+                 lengths: List,
+                 batch_size: int,
+                 shuffle: bool = False,
+                 drop_last: bool = False,
+                 bucket_size: int = 100,
+                 seed: int = None,
+                 num_replicas: int = 1,
+                 rank: int = 0):
+        """ Batch sampler grouping the examples of similar length.
+
+        @param lengths: List of the sequence length of each example.
+        @param batch_size: Batch size.
+        @param shuffle: Shuffle the examples within a pool of `batch_size * bucket_size` examples before sorting
+            by length, and shuffle the order of the batches.
+        @param drop_last: Drop the last incomplete batch (and the batches not shared evenly by the replicas).
+        @param bucket_size: Number of batches in a pool sorted by length (only used when shuffle is True).
+        @param seed: Seed of the shuffle, combined with the epoch (the global random state if None).
+        @param num_replicas: Number of the processes sharing the batches.
+        @param rank: Rank of the process.
+        """
+        super().__init__(seed, num_replicas, rank)
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.bucket_size = bucket_size
+
+    def batches(self):
+        rng = self.rng
+        index = list(range(len(self.lengths)))
+        if self.shuffle:
+            rng.shuffle(index)
+            pool_size = self.batch_size * self.bucket_size
+            pools = [index[i:i + pool_size] for i in range(0, len(index), pool_size)]
+            index = list(chain(*[sorted(p, key=lambda x: self.lengths[x]) for p in pools]))
+        else:
+            index = sorted(index, key=lambda x: self.lengths[x])
+        batches = [index[i:i + self.batch_size] for i in range(0, len(index), self.batch_size)]
+        if self.drop_last and len(batches) > 0 and len(batches[-1]) < self.batch_size:
+            batches = batches[:-1]
+        if self.shuffle:
+            rng.shuffle(batches)
+        return batches
+
+    def num_batches(self):
+        if self.drop_last:
+            return len(self.lengths) // self.batch_size
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+
+class TokenBudgetBatchSampler(EpochBatchSampler):
+    """ Batch sampler filling each batch with the examples of similar length up to a budget of the input and output
+    tokens after padding, instead of a fixed number of examples. """
+
+    def __init__(self,
+                 lengths: List,
+                 label_lengths: List,
+                 max_tokens: int,
+                 shuffle: bool = False,
+                 drop_last: bool = False,
+                 pool_size: int = 10000,
+                 seed: int = None,
+                 num_replicas: int = 1,
+                 rank: int = 0):
+        """ Batch sampler of a token budget.
+
+        @param lengths: List of the input length of each example.
+        @param label_lengths: List of the output length of each example.
+        @param max_tokens: Max number of the input and output tokens of a batch including the padding to the longest
+            sequence (an example exceeding the budget makes a batch by itself).
+        @param shuffle: Shuffle the examples within a pool of `pool_size` examples before sorting by length, and
+            shuffle the order of the batches.
+        @param drop_last: Drop a random batch (and the batches not shared evenly by the replicas).
+        @param pool_size: Number of the examples in a pool sorted by length (only used when shuffle is True).
+        @param seed: Seed of the shuffle, combined with the epoch (the global random state if None).
+        @param num_replicas: Number of the processes sharing the batches.
+        @param rank: Rank of the process.
+        """
+        super().__init__(seed, num_replicas, rank)
+        assert len(lengths) == len(label_lengths), '{} != {}'.format(len(lengths), len(label_lengths))
+        self.lengths = lengths
+        self.label_lengths = label_lengths
+        self.max_tokens = max_tokens
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.pool_size = pool_size
+        self._batches = None
+
+    def set_epoch(self, epoch: int, skip: int = 0):
+        super().set_epoch(epoch, skip)
+        self._batches = None
+
+    def batches(self):
+        # drawn once per epoch, so that the length and the iteration agree (and the length does not consume the
+        # global random state without seed)
+        if self._batches is None:
+            self._batches = self._draw_batches()
+        return self._batches
+
+    def _draw_batches(self):
+        rng = self.rng
+        index = list(range(len(self.lengths)))
+        if self.shuffle:
+            rng.shuffle(index)
+            pools = [index[i:i + self.pool_size] for i in range(0, len(index), self.pool_size)]
+            index = list(chain(*[sorted(p, key=lambda x: self.lengths[x]) for p in pools]))
+        else:
+            index = sorted(index, key=lambda x: self.lengths[x])
+        batches, batch, max_length, max_length_output = [], [], 0, 0
+        for i in index:
+            _max_length = max(max_length, self.lengths[i])
+            _max_length_output = max(max_length_output, self.label_lengths[i])
+            if len(batch) > 0 and (len(batch) + 1) * (_max_length + _max_length_output) > self.max_tokens:
+                batches.append(batch)
+                batch, _max_length, _max_length_output = [], self.lengths[i], self.label_lengths[i]
+            batch.append(i)
+            max_length, max_length_output = _max_length, _max_length_output
+        if len(batch) > 0:
+            batches.append(batch)
+        if self.drop_last and len(batches) > 0:
+            # the last batch in the sorted order has the longest examples, so a random batch is dropped instead
+            batches.pop(rng.randrange(len(batches)))
+        if self.shuffle:
+            rng.shuffle(batches)
+        return batches
+
+    def num_batches(self):
+        # the number of the batches depends on the shuffle of the epoch
+        return len(self.batches())
+
+
+class DynamicPaddingCollator:
+    """ Pad each batch to its own longest sequence instead of the max length of the model. """
+
+    def __init__(self, pad_token_id: int, label_pad_token_id: int = -100):
+        self.pad_value = {'input_ids': pad_token_id, 'attention_mask': 0, 'labels': label_pad_token_id,
+                          'decoder_input_ids': pad_token_id, 'segment_ids': 0, 'decoder_segment_ids': 0}
+
+    def __call__(self, batch: List[Dict]):
+        return {k: torch.nn.utils.rnn.pad_sequence(
+            [i[k] for i in batch], batch_first=True, padding_value=self.pad_value.get(k, 0)) for k in batch[0].keys()}
+
+
+def pack_examples(lengths: List, label_lengths: List, max_length: int, max_length_output: int):
+    """ Pack the examples into rows within the max lengths of the input and the output (worst-fit decreasing on the
+    input length, where each example goes to the row of the most remaining space that also fits its output).
+
+    @param lengths: Input length of each example.
+    @param label_lengths: Output length of each example.
+    @param max_length: Max input length of a row.
+    @param max_length_output: Max output length of a row.
+    @return: List of the rows (the indices of the examples).
+    """
+    rows, row_label_lengths = [], []
+    heap = []  # (-remaining input length, row)
+    for i in sorted(range(len(lengths)), key=lambda x: -lengths[x]):
+        row, skipped = None, []
+        while len(heap) > 0 and -heap[0][0] >= lengths[i]:
+            remaining, r = heapq.heappop(heap)
+            if row_label_lengths[r] + label_lengths[i] <= max_length_output:
+                row = r
+                break
+            skipped.append((remaining, r))
+        for item in skipped:
+            heapq.heappush(heap, item)
+        if row is None:
+            row, remaining = len(rows), -max_length
+            rows.append([])
+            row_label_lengths.append(0)
+        rows[row].append(i)
+        row_label_lengths[row] += label_lengths[i]
+        heapq.heappush(heap, (remaining + lengths[i], row))
+    return rows
+
+
+class PackedDataset(torch.utils.data.Dataset):
+    """ Dataset of the rows of several examples concatenated (sequence packing), with the segment ids of each token
+    (1, 2, ... for the examples and 0 for the padding) to mask the attention across the examples, and the decoder
+    inputs shifted right within each example. The rows are packed once and shuffled by the batch sampler. """
+
+    def __init__(self, dataset, max_length: int, max_length_output: int = None, decoder_start_token_id: int = 0):
+        """ Dataset of the packed rows.
+
+        @param dataset: Dataset of the encoded features without padding (`input_ids` and `labels`).
+        @param max_length: Max input length of a row.
+        @param max_length_output: Max output length of a row (`max_length` if None).
+        @param decoder_start_token_id: First decoder input of each example.
+        """
+        self.dataset = dataset
+        self.decoder_start_token_id = decoder_start_token_id
+        lengths, label_lengths = dataset.lengths('input_ids'), dataset.lengths('labels')
+        self.rows = pack_examples(
+            lengths, label_lengths, max_length, max_length if max_length_output is None else max_length_output)
+        self.row_lengths = {
+            'input_ids': [sum(lengths[i] for i in r) for r in self.rows],
+            'labels': [sum(label_lengths[i] for i in r) for r in self.rows]}
+        logging.info('pack {} examples into {} rows (input efficiency: {})'.format(
+            len(dataset), len(self.rows), round(sum(lengths) / max(len(self.rows) * max_length, 1), 3)))
+
+    def __len__(self):
+        return len(self.rows)
+
+    def lengths(self, name: str = 'input_ids'):
+        return self.row_lengths[name]
+
+    def __getitem__(self, idx):
+        examples = [self.dataset[i] for i in self.rows[idx]]
+        start = torch.tensor([self.decoder_start_token_id], dtype=torch.long)
+        return {
+            'input_ids': torch.cat([e['input_ids'] for e in examples]),
+            'segment_ids': torch.cat([torch.full_like(e['input_ids'], n + 1) for n, e in enumerate(examples)]),
+            'labels': torch.cat([e['labels'] for e in examples]),
+            # the decoder input restarts at each example
+            'decoder_input_ids': torch.cat([torch.cat([start, e['labels'][:-1]]) for e in examples]),
+            'decoder_segment_ids': torch.cat([torch.full_like(e['labels'], n + 1) for n, e in enumerate(examples)])
+        }
@@ -0,0 +1,156 @@
+""" Content-addressed cache keys and size-bounded cache manifest. """
+import hashlib
+import json
+import logging
+import os
+import shutil
+import socket
+import time
+from glob import glob
+from contextlib import contextmanager
+from typing import List
+
+try:
+    import fcntl
+except ImportError:  # no file lock on windows
+    fcntl = None
+
+__all__ = ('DEFAULT_CACHE_DIR', 'CacheManifest', 'file_fingerprint', 'text_fingerprint', 'config_fingerprint',
+           'file_lock')
+DEFAULT_CACHE_DIR = '{}/.cache/t5qg'.format(os.path.expanduser('~'))
+MAX_CACHE_SIZE_GB = float(os.getenv('T5QG_MAX_CACHE_SIZE_GB', 50))
+CACHE_GRACE_SEC = float(os.getenv('T5QG_CACHE_GRACE_SEC', 3600))
+
+
+def file_fingerprint(path: str, chunk_size: int = 1 << 20):
+    """ Hash of the file content. """
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def text_fingerprint(*list_text: List):
+    """ Hash of the lists of texts (None is allowed as an element). """
+    md5 = hashlib.md5()
+    for texts in list_text:
+        md5.update(b'\x01')
+        for t in texts:
+            md5.update(b'\x00' if t is None else t.encode() + b'\x02')
+    return md5.hexdigest()
+
+
+def config_fingerprint(**kwargs):
+    """ Hash of json-serializable parameters. """
+    return hashlib.md5(json.dumps(kwargs, sort_keys=True).encode()).hexdigest()
+
+
+@contextmanager
+def file_lock(path: str):
+    """ Exclusive lock on the file across the processes (no lock on windows). """
+    with open(path, 'w') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def process_alive(pid: int):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:  # owned by another user
+        return True
+    return True
+
+
+def get_size(path: str):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(r, f)) for r, _, files in os.walk(path) for f in files)
+
+
+class CacheManifest:
+    """ Manifest of the cache entries with LRU eviction to keep the total size under the limit. The manifest is
+    guarded by a file lock, so that concurrent jobs can share the cache directory, and an entry is not evicted while
+    a live process holds a lease on it (eg. a training job reading the memory-mapped features) or within the grace
+    window after its last access. """
+
+    def __init__(self, cache_dir: str = DEFAULT_CACHE_DIR, max_size_gb: float = MAX_CACHE_SIZE_GB,
+                 grace: float = CACHE_GRACE_SEC):
+        """ Manifest of the cache entries.
+
+        @param cache_dir: Directory to keep the manifest.
+        @param max_size_gb: Max total size of the cache entries in GB (no eviction if None).
+        @param grace: Entries accessed within this time (sec) are not evicted.
+        """
+        self.path = '{}/manifest.json'.format(cache_dir)
+        self.lease_dir = '{}/leases'.format(cache_dir)
+        self.max_size = None if max_size_gb is None else max_size_gb * (1 << 30)
+        self.grace = grace
+        os.makedirs(self.lease_dir, exist_ok=True)
+
+    def lock(self):
+        return file_lock('{}.lock'.format(self.path))
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path) as f:
+            return json.load(f)
+
+    def dump(self, entries):
+        tmp = '{}.tmp.{}'.format(self.path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(entries, f)
+        os.replace(tmp, self.path)
+
+    def lease_prefix(self, path: str):
+        return '{}/{}'.format(self.lease_dir, hashlib.md5(os.path.abspath(path).encode()).hexdigest())
+
+    def lease(self, path: str):
+        """ Protect the entry (which may not exist yet) from the eviction until the current process exits. """
+        open('{}.{}.{}'.format(self.lease_prefix(path), socket.gethostname(), os.getpid()), 'a').close()
+
+    def in_use(self, path: str):
+        """ Whether a live process holds a lease on the entry (the leases of the dead processes are removed). """
+        hostname = socket.gethostname()
+        for lease in glob('{}.*'.format(self.lease_prefix(path))):
+            host, pid = os.path.basename(lease).split('.', 1)[1].rsplit('.', 1)
+            if host != hostname or process_alive(int(pid)):  # the process on another host is assumed alive
+                return True
+            try:
+                os.remove(lease)
+            except FileNotFoundError:
+                pass
+        return False
+
+    def touch(self, path: str):
+        """ Register the cache entry (or update its last access time), and evict the least recently used entries
+        if the total size exceeds the limit. """
+        path = os.path.abspath(path)
+        with self.lock():
+            entries = self.load()
+            entries = {k: v for k, v in entries.items() if os.path.exists(k)}
+            if os.path.exists(path):
+                entries[path] = {'size': get_size(path), 'last_access': time.time()}
+            if self.max_size is not None:
+                total = sum(v['size'] for v in entries.values())
+                for k, v in sorted(entries.items(), key=lambda x: x[1]['last_access']):
+                    if total <= self.max_size:
+                        break
+                    if k == path or time.time() - v['last_access'] < self.grace or self.in_use(k):
+                        continue
+                    logging.info('evict cache {} ({} bytes)'.format(k, v['size']))
+                    if os.path.isdir(k):
+                        shutil.rmtree(k, ignore_errors=True)
+                    elif os.path.exists(k):
+                        os.remove(k)
+                    total -= v['size']
+                    entries.pop(k)
+            self.dump(entries)
@@ -0,0 +1,111 @@
+""" Step-level training checkpoints written in a background thread with the rotation of the old ones. """
+import logging
+import os
+import random
+import re
+import threading
+from glob import glob
+
+import numpy as np
+import torch
+
+__all__ = ('StepCheckpointer', 'get_rng_state', 'set_rng_state')
+
+
+def to_cpu(obj):
+    """ Copy the tensors in the nested state to CPU, so that the training can update the original while saving. """
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+
+def get_rng_state():
+    state = {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+class StepCheckpointer:
+    """ Checkpoints of the training state at the optimizer steps (`{checkpoint_dir}/steps/step_{n}.pt`). The state
+    is copied to CPU in the training loop and written to disk in a background thread, where at most one write is
+    in flight, and only the last `keep_last` checkpoints are kept. """
+
+    def __init__(self, checkpoint_dir: str, keep_last: int = 2):
+        """ Step-level training checkpoints.
+
+        @param checkpoint_dir: Checkpoint directory of the trainer.
+        @param keep_last: Number of the checkpoints to keep.
+        """
+        assert keep_last > 0, keep_last
+        self.dir = '{}/steps'.format(checkpoint_dir)
+        self.keep_last = keep_last
+        self.thread = None
+        self.error = None
+
+    def list(self):
+        """ Paths of the checkpoints sorted by the step. """
+        paths = glob('{}/step_*.pt'.format(self.dir))
+        return sorted(paths, key=lambda x: int(re.findall(r'step_(\d+)\.pt\Z', x)[0]))
+
+    def latest(self):
+        paths = self.list()
+        return paths[-1] if len(paths) > 0 else None
+
+    def load(self, path: str = None):
+        """ Load the checkpoint (the latest if the path is not given), or return None if there is no checkpoint. """
+        path = self.latest() if path is None else path
+        if path is None:
+            return None
+        logging.info('load step checkpoint from {}'.format(path))
+        # the checkpoint written by `save` has the RNG states of python and numpy besides the tensors
+        return torch.load(path, map_location=torch.device('cpu'), weights_only=False)
+
+    def save(self, step: int, state: dict):
+        """ Copy the state to CPU and write it in a background thread.
+
+        @param step: Global step.
+        @param state: Dictionary of the state (tensors, state dicts, and python objects).
+        """
+        state = to_cpu(state)
+        self.wait()
+        self.thread = threading.Thread(target=self.write, args=(step, state), daemon=True)
+        self.thread.start()
+
+    def write(self, step: int, state: dict):
+        try:
+            os.makedirs(self.dir, exist_ok=True)
+            path = '{}/step_{}.pt'.format(self.dir, step)
+            tmp = '{}.tmp'.format(path)
+            torch.save(state, tmp)
+            os.replace(tmp, path)
+            for p in self.list()[:-self.keep_last]:
+                os.remove(p)
+            logging.debug('step checkpoint is saved at {}'.format(path))
+        except Exception as e:
+            self.error = e
+            logging.exception('failed to save step checkpoint at step {}'.format(step))
+
+    def wait(self):
+        """ Wait for the write in flight. """
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def clear(self):
+        """ Remove all the checkpoints (eg. once the epoch checkpoint supersedes them). """
+        self.wait()
+        for p in self.list():
+            os.remove(p)
@@ -2,32 +2,85 @@ import json
 import logging
 import os
 import re
+import shutil
+from itertools import chain
+from multiprocessing import Pool
 
-import requests
 import tarfile
 import zipfile
 import gzip
 from typing import List, Dict
 from tqdm import tqdm
 
-import gdown
-
 from .lm_t5 import TASK_PREFIX, ADDITIONAL_SP_TOKENS
 from .sentence_split import SentSplit
+from .cache import DEFAULT_CACHE_DIR, CacheManifest, file_fingerprint, config_fingerprint, file_lock
 
-__all__ = ('get_dataset', 'jsonline_reader', 'jsonline_writer', 'wget')
-DEFAULT_CACHE_DIR = '{}/.cache/t5qg'.format(os.path.expanduser('~'))
+__all__ = ('get_dataset', 'jsonline_reader', 'jsonline_iterator', 'jsonline_writer', 'JsonlineWriter', 'wget')
+# bump when `process_single_data` changes to invalidate the processed files
+PROCESS_VERSION = 1
 
 
-def jsonline_reader(filename: str):
+def jsonline_iterator(filename: str):
+    """ Lazy reader yielding one example per line. """
     with open(filename, 'r') as f:
-        examples = [json.loads(i) for i in f.read().split('\n') if len(i) > 0]
-    return examples
+        for i in f:
+            i = i.rstrip('\n')
+            if len(i) > 0:
+                yield json.loads(i)
+
+
+def jsonline_reader(filename: str):
+    return list(jsonline_iterator(filename))
 
 
-def jsonline_writer(data, export):
-    with open(export, 'w') as f:
-        f.write('\n'.join([json.dumps(x) for x in data]))
+class JsonlineWriter:
+    """ Incremental jsonline writer flushing every `chunk_size` examples. The file is written to a temporary file
+    and renamed on `close`, so that a concurrent reader never sees a partial file. """
+
+    def __init__(self, export: str, chunk_size: int = 1000):
+        self.export = export
+        self.tmp = '{}.tmp.{}'.format(export, os.getpid())
+        self.chunk_size = chunk_size
+        self.chunk = []
+        self.first_line = True
+        self.f = open(self.tmp, 'w')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, x):
+        self.chunk.append(json.dumps(x))
+        if len(self.chunk) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.chunk) == 0:
+            return
+        self.f.write(('' if self.first_line else '\n') + '\n'.join(self.chunk))
+        self.first_line = False
+        self.chunk = []
+
+    def close(self):
+        self.flush()
+        self.f.close()
+        os.replace(self.tmp, self.export)
+
+    def abort(self):
+        self.f.close()
+        os.remove(self.tmp)
+
+
+def jsonline_writer(data, export, chunk_size: int = 1000):
+    with JsonlineWriter(export, chunk_size=chunk_size) as writer:
+        for x in data:
+            writer.write(x)
 
 
 def get_dataset(name,
@@ -36,11 +89,21 @@ def get_dataset(name,
                 language: List or str = 'en',
                 cache_dir: str = None,
                 no_prefix: bool = False,
-                return_raw_triplet: bool = False):
+                return_raw_triplet: bool = False,
+                stream: bool = False,
+                num_workers: int = None):
+    """ Get dataset as the list of the input and the output texts (or context, question and answer if
+    `return_raw_triplet`). If `stream`, return a generator yielding a tuple of each example instead. """
     language = [language] if type(language) is str else language
     task_type = [task_type] if type(task_type) is str else task_type
-    data = Dataset(name, cache_dir, no_prefix=no_prefix).get_data(
-        split, language=language, task_type=task_type, return_raw_triplet=return_raw_triplet)
+    dataset = Dataset(name, cache_dir, no_prefix=no_prefix, num_workers=num_workers)
+    if stream:
+        data = dataset.iter_data(split, language=language, task_type=task_type, return_raw_triplet=return_raw_triplet)
+        if return_raw_triplet:
+            return ((i["context"], i["question"], i["answer"]) for i in data)
+        return ((i["source_text"], i["target_text"]) for i in data)
+
+    data = dataset.get_data(split, language=language, task_type=task_type, return_raw_triplet=return_raw_triplet)
     if return_raw_triplet:
         context = [i["context"] for i in data]
         question = [i["question"] for i in data]
@@ -56,10 +119,12 @@ def wget(url, cache_dir: str, gdrive_filename: str = None):
     """ wget and uncompress data_iterator """
     os.makedirs(cache_dir, exist_ok=True)
     if url.startswith('https://drive.google.com'):
+        import gdown
         assert gdrive_filename is not None, 'please provide fileaname for gdrive download'
         gdown.download(url, '{}/{}'.format(cache_dir, gdrive_filename), quiet=False)
         filename = gdrive_filename
     else:
+        import requests
         filename = os.path.basename(url)
         with open('{}/{}'.format(cache_dir, filename), "wb") as f:
             r = requests.get(url)
@@ -85,6 +150,26 @@ def wget(url, cache_dir: str, gdrive_filename: str = None):
     return cache_dir
 
 
+PROCESSOR = None  # data processor of each worker process
+
+
+def init_worker(data_alias: str, no_prefix: bool):
+    global PROCESSOR
+    PROCESSOR = Dataset(data_alias, no_prefix=no_prefix)
+
+
+def process_shard(task, processor=None):
+    """ Process a shard of the raw examples (of the language if known) and save it with a completion marker. """
+    shard_path, shard, language = task
+    if shard is None:
+        return shard_path
+    processor = PROCESSOR if processor is None else processor
+    jsonline_writer(chain(*[processor.process_single_data(i, language) for i in shard]), shard_path)
+    with open('{}.done'.format(shard_path), 'w'):
+        pass
+    return shard_path
+
+
 class Dataset:
 
     all_language_tydiqa = ['arabic', 'bengali', 'english', 'finnish', 'indonesian', 'korean', 'russian', 'swahili', 'telugu']
@@ -93,22 +178,45 @@ class Dataset:
     def __init__(self,
                  data_alias: str = 'squad',
                  cache_dir: str = None,
-                 no_prefix: bool = False):
+                 no_prefix: bool = False,
+                 num_workers: int = None,
+                 shard_size: int = 1000):
+        """ Data processor.
+
+        @param data_alias: Either of `squad`, `tydiqa`.
+        @param cache_dir: Directory to cache the raw and processed files.
+        @param no_prefix: Process the input without the task prefix.
+        @param num_workers: Number of processes to preprocess the raw file (the number of CPUs if None).
+        @param shard_size: Number of raw examples in a shard of the preprocessing.
+        """
         self.data_alias = data_alias
+        self.num_workers = num_workers
+        self.shard_size = shard_size
         assert self.data_alias in ['tydiqa', 'squad']
         self.cache = '{}/data/{}'.format(DEFAULT_CACHE_DIR, self.data_alias) if cache_dir is None else cache_dir
         self.sent_splitter = SentSplit()
+        # the language is known for squad (and for each file of tydiqa), so the language detection is skipped
+        self.language = 'en' if self.data_alias == 'squad' else None
         self.sp_token_hl = ADDITIONAL_SP_TOKENS['hl']
         self.no_prefix = no_prefix
         logging.info('instantiate data processor')
 
     def get_data(self, split: str = 'train', language: List = None, task_type: List = None,
                  return_raw_triplet: bool = False):
+        return list(self.iter_data(split, language=language, task_type=task_type,
+                                   return_raw_triplet=return_raw_triplet))
+
+    def iter_data(self, split: str = 'train', language: List = None, task_type: List = None,
+                  return_raw_triplet: bool = False):
+        """ Generator yielding the examples filtered by the task type. The processed file is read lazily, or
+        written incrementally while processing the raw file, so the memory usage is constant. """
         if self.data_alias == 'squad':
             language = [None]
         else:
             language = self.all_language_alias_tydiqa if language is None else language
         assert split in ['train', 'dev', 'test'], split
+        if task_type is not None and not return_raw_triplet:
+            assert all(i in TASK_PREFIX for i in task_type), task_type
         if return_raw_triplet:
             output_prefix = '{}/{}/processed/{}.raw'.format(self.cache, self.data_alias, split)
         elif self.no_prefix:
@@ -117,40 +225,100 @@ class Dataset:
             output_prefix = '{}/{}/processed/{}'.format(self.cache, self.data_alias, split)
 
         logging.info("generating examples: {}".format(split))
-        full_examples = []
         for la in language:
             if self.data_alias == 'squad':
-                output = '{}.jsonl'.format(output_prefix)
+                output = output_prefix
                 path = '{}/raw/{}/{}.jsonl'.format(self.cache, self.data_alias, split)
+                la = self.language
             else:
-                output = '{}.{}.jsonl'.format(output_prefix, la)
+                output = '{}.{}'.format(output_prefix, la)
                 path = '{}/raw/{}/{}.{}.jsonl'.format(self.cache, self.data_alias, self.all_language_alias_tydiqa[la], split)
             os.makedirs(os.path.dirname(output), exist_ok=True)
             os.makedirs(os.path.dirname(path), exist_ok=True)
+            if not os.path.exists(path):
+                wget('https://github.com/asahi417/t5-question-generation/releases/download/0.0.0/{}.zip'.format(self.data_alias),
+                     cache_dir='{}/raw'.format(self.cache))
+            # the processed file is keyed by the raw file content and the preprocessing config
+            output = '{}.{}.jsonl'.format(output, self.fingerprint(path, return_raw_triplet, la))
             # exclude YES/NO questions or unanswerable questions
+            CacheManifest().lease(output)
             if os.path.exists(output):
-                examples = jsonline_reader(output)
+                examples = jsonline_iterator(output)
             else:
-                if not os.path.exists(path):
-                    wget('https://github.com/asahi417/t5-question-generation/releases/download/0.0.0/{}.zip'.format(self.data_alias),
-                         cache_dir='{}/raw'.format(self.cache))
-                data = jsonline_reader(path)
-                examples = []
-                for _data in tqdm(data):
-                    if return_raw_triplet:
-                        examples.append({i: _data[i] for i in ["context", "question", "answer"]})
-                    else:
-                        examples += self.process_single_data(_data)
-                jsonline_writer(data=examples, export=output)
-            full_examples += examples
-        if task_type is None or return_raw_triplet:
-            return full_examples
+                examples = self.process_file(path, output, return_raw_triplet, la)
+            for i in examples:
+                if task_type is None or return_raw_triplet or i['task'] in task_type:
+                    yield i
+            CacheManifest().touch(output)
+
+    def process_file(self, path: str, output: str, return_raw_triplet: bool = False, language: str = None):
+        """ Process the raw file (of the language if known), writing the processed examples to `output` while
+        yielding them. The build is guarded by a lock file, so that a concurrent process (eg. another job or a rank
+        of the distributed training) waits for the output instead of building it in the same shard directory. """
+        with file_lock('{}.lock'.format(output)):
+            if os.path.exists(output):  # built by the process holding the lock before
+                yield from jsonline_iterator(output)
+                return
+            if not return_raw_triplet:
+                yield from self.process_file_sharded(path, output, language)
+                return
+            with JsonlineWriter(output) as writer:
+                for _data in tqdm(jsonline_iterator(path)):
+                    i = {k: _data[k] for k in ["context", "question", "answer"]}
+                    writer.write(i)
+                    yield i
+
+    def process_file_sharded(self, path: str, output: str, language: str = None):
+        """ Split the raw file into shards processed on a process pool (one sentence splitter per worker). Each shard
+        is saved with a completion marker, so that an interrupted run resumes from the unfinished shards (called
+        under the lock of `process_file`). """
+        shard_dir = '{}.shards.{}'.format(output, self.shard_size)
+        os.makedirs(shard_dir, exist_ok=True)
+
+        def iterate_shard():
+            shard = []
+            for _data in jsonline_iterator(path):
+                shard.append(_data)
+                if len(shard) == self.shard_size:
+                    yield shard
+                    shard = []
+            if len(shard) > 0:
+                yield shard
+
+        def get_task():
+            for n, shard in enumerate(iterate_shard()):
+                shard_path = '{}/{:05d}.jsonl'.format(shard_dir, n)
+                # completed shards are not sent to the workers
+                yield shard_path, None if os.path.exists('{}.done'.format(shard_path)) else shard, language
+
+        num_workers = os.cpu_count() if self.num_workers is None else self.num_workers
+        logging.info('process {} with {} workers (shard size: {})'.format(path, num_workers, self.shard_size))
+        if num_workers > 1:
+            pool = Pool(num_workers, initializer=init_worker, initargs=(self.data_alias, self.no_prefix))
+            shard_paths = pool.imap(process_shard, get_task())
         else:
-            assert all(i in TASK_PREFIX for i in task_type), task_type
-            return [i for i in full_examples if i['task'] in task_type]
+            shard_paths = (process_shard(i, self) for i in get_task())
+        try:
+            with JsonlineWriter(output) as writer:
+                for shard_path in tqdm(shard_paths):
+                    for i in jsonline_iterator(shard_path):
+                        writer.write(i)
+                        yield i
+        finally:
+            if num_workers > 1:
+                pool.terminate()
+        shutil.rmtree(shard_dir)
+
+    def fingerprint(self, path: str, return_raw_triplet: bool = False, language: str = None):
+        """ Hash of the raw file and the preprocessing config. """
+        # the language of tydiqa is in the key, as the file processed with the language detection can differ
+        return config_fingerprint(
+            raw=file_fingerprint(path), no_prefix=self.no_prefix, return_raw_triplet=return_raw_triplet,
+            task=sorted(TASK_PREFIX.keys()), hl=self.sp_token_hl, version=PROCESS_VERSION,
+            **({} if self.data_alias == 'squad' else {'language': language}))
 
-    def process_ans_ext(self, context: str, answer: str):
-        sents = self.sent_splitter(context)
+    def process_ans_ext(self, context: str, answer: str, language: str = None):
+        sents = self.sent_splitter(context, language=self.language if language is None else language)
         ind_candidate = [n for n, s in enumerate(sents) if answer in s]
         if len(ind_candidate) == 0:
             logging.warning('answer not found \n - answer: {} \n - context: {}'.format(answer, context))
@@ -164,14 +332,14 @@ class Dataset:
         sent = "{0} {1} {2} {1} {3}".format(before, self.sp_token_hl, sent, after)
         return re.sub(r'\s+', ' ', sent)
 
-    def process_single_data(self, data: Dict):
-        """ This function returns the examples in the raw (text) form. """
+    def process_single_data(self, data: Dict, language: str = None):
+        """ This function returns the examples in the raw (text) form (the language is detected if None). """
         question = data["question"]
         context = data["context"]
         answer = data["answer"]
         examples = []
         if 'ans_ext' in TASK_PREFIX:
-            source_text = self.process_ans_ext(context, answer)
+            source_text = self.process_ans_ext(context, answer, language)
             if source_text is not None:
                 if not self.no_prefix:
                     source_text = "{}: {}".format(TASK_PREFIX['ans_ext'], source_text)
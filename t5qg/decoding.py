@@ -0,0 +1,115 @@
+""" Decoding policy resolving the generation config of each model call from the task, the request, and the load. """
+import logging
+import threading
+from typing import Dict, List
+
+__all__ = ('DecodingPolicy', 'TASK_DECODING')
+# answer extraction copies a span of the highlighted sentence, where greedy decoding is almost as good as beam search
+TASK_DECODING = {
+    'ans_ext': {'num_beams': 1, 'early_stopping': False},
+    'qg': {'num_beams': 4, 'early_stopping': True},
+    'e2e_qg': {'num_beams': 4, 'early_stopping': True},
+    'qa': {'num_beams': 4, 'early_stopping': True}
+}
+
+
+class DecodingPolicy:
+    """ Decoding policy with per-task defaults, a latency budget lowering the number of beams based on the measured
+    cost of the previous model calls, a length bound of the extracted answers, and an option to rerank the sampled
+    candidates instead of beam search. """
+
+    def __init__(self,
+                 task_decoding: Dict = None,
+                 latency_budget: float = None,
+                 min_beams: int = 1,
+                 length_aware: bool = True,
+                 num_candidates: int = None,
+                 decay: float = 0.9):
+        """ Decoding policy.
+
+        @param task_decoding: Default config of each task (`TASK_DECODING` if None), a dictionary of `num_beams`
+            and `early_stopping`.
+        @param latency_budget: Latency budget (sec) of a single batch, under which the number of beams is lowered
+            (no limit if None).
+        @param min_beams: Min number of beams when the number of beams is lowered by the latency budget.
+        @param length_aware: Bound the output length of answer extraction by the length of the highlighted sentence.
+        @param num_candidates: Sample the candidates and return the one of the highest score instead of greedy
+            decoding (only when the number of beams is 1).
+        @param decay: Decay of the exponential moving average of the cost.
+        """
+        self.task_decoding = TASK_DECODING if task_decoding is None else task_decoding
+        self.latency_budget = latency_budget
+        self.min_beams = min_beams
+        self.length_aware = length_aware
+        self.num_candidates = num_candidates
+        self.decay = decay
+        # exponential moving average of the time (sec) per input and beam of each task
+        self.cost = {}
+        self.lock = threading.Lock()
+
+    def resolve(self,
+                task_type: str,
+                num_beams: int = None,
+                batch_size: int = 1,
+                latency_budget: float = None,
+                max_length_output: int = 32,
+                highlight_length: int = None):
+        """ Resolve the decoding config of a model call.
+
+        @param task_type: Either of `qg`, `ans_ext`, `qa`.
+        @param num_beams: Number of beam requested (the default of the task if None).
+        @param batch_size: Number of the inputs in a batch.
+        @param latency_budget: Latency budget (sec) of the request (the budget of the policy if None).
+        @param max_length_output: Max sequence length for the output.
+        @param highlight_length: Max number of tokens of the highlights.
+        @return: Dictionary of `num_beams`, `early_stopping`, `max_length_output`, and `num_candidates`.
+        """
+        default = self.task_decoding.get(task_type, {'num_beams': 4, 'early_stopping': True})
+        num_beams = default['num_beams'] if num_beams is None else num_beams
+        latency_budget = self.latency_budget if latency_budget is None else latency_budget
+        if latency_budget is not None and task_type in self.cost and num_beams > self.min_beams:
+            # the largest number of beams of which the estimated latency is within the budget
+            affordable = int(latency_budget / (self.cost[task_type] * batch_size))
+            affordable = max(self.min_beams, min(num_beams, affordable))
+            if affordable < num_beams:
+                logging.debug('lower num_beams by the latency budget: {} -> {} ({})'.format(
+                    num_beams, affordable, task_type))
+                num_beams = affordable
+        if self.length_aware and task_type == 'ans_ext' and highlight_length is not None:
+            # the answer is a span of the highlight (+1 for the decoder start token and +1 as the margin of the
+            # tokenization of the span out of the sentence)
+            max_length_output = min(max_length_output, highlight_length + 2)
+        return {'num_beams': num_beams,
+                'early_stopping': default.get('early_stopping', False) if num_beams > 1 else False,
+                'max_length_output': max_length_output,
+                'num_candidates': self.num_candidates if num_beams == 1 else None}
+
+    def update(self, task_type: str, num_beams: int, batch_size: int, elapsed: float):
+        """ Update the cost of the task with the elapsed time (sec) of a model call. """
+        cost = elapsed / (batch_size * max(num_beams, 1))
+        with self.lock:
+            if task_type not in self.cost:
+                self.cost[task_type] = cost
+            else:
+                self.cost[task_type] = self.decay * self.cost[task_type] + (1 - self.decay) * cost
+
+    @staticmethod
+    def cache_config(decoding: Dict):
+        """ Decoding config to be included in the result cache key. The max output length bounded by the highlight
+        depends on the other inputs in the batch but does not change the output, so it is excluded. """
+        return {k: v for k, v in decoding.items() if k != 'max_length_output'}
+
+    def stats(self):
+        return {'latency_budget': self.latency_budget, 'min_beams': self.min_beams,
+                'num_candidates': self.num_candidates, 'cost': self.cost.copy()}
+
+
+def highlight_length(tokenizer, list_highlight: List or None):
+    """ Max number of tokens of the highlights (None if the highlights are not given). The None entries (eg. an
+    empty segment of the sentence splitter) are skipped, and it is 0 if there is no highlight left. """
+    if list_highlight is None or len(list_highlight) == 0:
+        return None
+    list_highlight = [h for h in list_highlight if h is not None]
+    if len(list_highlight) == 0:
+        return 0
+    return max(len(i) for i in tokenizer(list_highlight)['input_ids'])
@@ -0,0 +1,111 @@
+""" Utilities of the distributed data parallel training (process group, rank, and local process launcher). """
+import logging
+import os
+from contextlib import contextmanager
+from typing import Callable
+
+import torch
+import torch.distributed as dist
+
+__all__ = ('init_distributed', 'cleanup', 'launch', 'get_rank', 'get_world_size', 'get_local_rank',
+           'is_main_process', 'barrier', 'main_process_first', 'all_reduce_mean', 'all_gather_object')
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def get_local_rank():
+    return int(os.getenv('LOCAL_RANK', 0))
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def init_distributed(backend: str = None):
+    """ Initialize the process group from the environment variables (`RANK`, `WORLD_SIZE`, `MASTER_ADDR`,
+    `MASTER_PORT`, and `LOCAL_RANK`), which are set by `launch` or `torchrun`.
+
+    @param backend: Backend of the process group (`nccl` with GPUs, otherwise `gloo`, if None).
+    @return: (rank, world size)
+    """
+    if not is_distributed():
+        if backend is None:
+            backend = 'nccl' if torch.cuda.is_available() else 'gloo'
+        if torch.cuda.is_available():
+            torch.cuda.set_device(get_local_rank())
+        dist.init_process_group(backend=backend, init_method='env://')
+        logging.info('initialize process group ({}): rank {}/{}'.format(backend, get_rank(), get_world_size()))
+    return get_rank(), get_world_size()
+
+
+def cleanup():
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+@contextmanager
+def main_process_first():
+    """ Context where the main process runs first and the others wait for it (eg. to build the feature cache once
+    and load it in the other processes). """
+    if not is_main_process():
+        barrier()
+    yield
+    if is_main_process():
+        barrier()
+
+
+def all_reduce_mean(value: float):
+    """ Mean of the value over the processes. """
+    if not is_distributed():
+        return value
+    tensor = torch.tensor([value], dtype=torch.float64)
+    if dist.get_backend() == 'nccl':
+        tensor = tensor.cuda()
+    dist.all_reduce(tensor)
+    return tensor.item() / get_world_size()
+
+
+def all_gather_object(obj):
+    """ List of the objects of all the processes in the order of the rank. """
+    if not is_distributed():
+        return [obj]
+    out = [None] * get_world_size()
+    dist.all_gather_object(out, obj)
+    return out
+
+
+def worker(local_rank: int, fn: Callable, nprocs: int, master_addr: str, master_port: int, args: tuple):
+    os.environ.update({'RANK': str(local_rank), 'LOCAL_RANK': str(local_rank), 'WORLD_SIZE': str(nprocs),
+                       'MASTER_ADDR': master_addr, 'MASTER_PORT': str(master_port)})
+    try:
+        fn(*args)
+    finally:
+        cleanup()
+
+
+def launch(fn: Callable, nprocs: int, *args, master_addr: str = '127.0.0.1', master_port: int = 29500):
+    """ Run the function in the local processes with the environment variables of the process group (for
+    multiple nodes, use `torchrun` instead).
+
+    @param fn: Function to run in each process (picklable, eg. defined at the top level of a module).
+    @param nprocs: Number of the processes.
+    @param args: Arguments of the function.
+    @param master_addr: Address of the rank 0 process.
+    @param master_port: Free port of the rank 0 process.
+    """
+    torch.multiprocessing.spawn(worker, args=(fn, nprocs, master_addr, master_port, args), nprocs=nprocs, join=True)
@@ -5,7 +5,6 @@ import random
 from typing import List
 
 import torch
-from nlgeval import compute_metrics
 from .lm_t5 import T5
 from .data import get_dataset
 
@@ -18,8 +17,18 @@ def evaluate_qg(model: str,
                 max_length_output: int = 32,
                 batch: int = 128,
                 num_beams: int = 4,
-                random_seed: int = 32):
-    """ Evaluate question-generation model """
+                random_seed: int = 32,
+                dynamic_padding: bool = False,
+                quantize: bool = False,
+                n_sample: int = None,
+                split: List or str = None):
+    """ Evaluate question-generation model
+
+    @param quantize: Evaluate the model with dynamic int8 quantization.
+    @param n_sample: Evaluate on the first n examples of each split (all the examples if None).
+    @param split: Split(s) to evaluate (`dev` and `test` if None).
+    """
+    from nlgeval import compute_metrics
     path_metric = '{}/metric.json'.format(export_dir)
     if os.path.exists(path_metric):
         with open(path_metric, 'r') as f:
@@ -27,28 +36,33 @@ def evaluate_qg(model: str,
     random.seed(random_seed)
     torch.manual_seed(random_seed)
 
-    lm = T5(model, max_length=max_length, max_length_output=max_length_output)
+    lm = T5(model, max_length=max_length, max_length_output=max_length_output, quantize=quantize)
     lm.eval()
     os.makedirs(export_dir, exist_ok=True)
     metrics_dict = {}
+    split = ['dev', 'test'] if split is None else split
+    split = [split] if type(split) is str else split
 
-    for split in ['dev', 'test']:
-        path_hypothesis = '{}/samples.{}.hyp.txt'.format(export_dir, split)
-        path_reference = '{}/samples.{}.ref.txt'.format(export_dir, split)
+    for _split in split:
+        path_hypothesis = '{}/samples.{}.hyp.txt'.format(export_dir, _split)
+        path_reference = '{}/samples.{}.ref.txt'.format(export_dir, _split)
 
         def generate_samples():
             raw_input, raw_output = get_dataset(dataset,
-                                                split=split,
+                                                split=_split,
                                                 language=language,
                                                 task_type='qg',
                                                 no_prefix=lm.no_prefix)
+            if n_sample is not None:
+                raw_input, raw_output = raw_input[:n_sample], raw_output[:n_sample]
             output = lm.generate_q(
                 raw_input,
                 batch_size=batch,
                 num_beams=num_beams,
                 drop_overflow_text=False,
                 skip_overflow_error=True,
-                parallel=True)
+                batch_encoding=True,
+                dynamic_padding=dynamic_padding)
             with open(path_hypothesis, 'w') as f:
                 f.write('\n'.join(output))
             with open(path_reference, 'w') as f:
@@ -58,13 +72,34 @@ def evaluate_qg(model: str,
             generate_samples()
 
         try:
-            metrics_dict[split] = compute_metrics(hypothesis=path_hypothesis, references=[path_reference],
-                                                  no_skipthoughts=True, no_glove=True)
+            metrics_dict[_split] = compute_metrics(hypothesis=path_hypothesis, references=[path_reference],
+                                                   no_skipthoughts=True, no_glove=True)
         except Exception:
             generate_samples()
-            metrics_dict[split] = compute_metrics(hypothesis=path_hypothesis, references=[path_reference],
-                                                  no_skipthoughts=True, no_glove=True)
+            metrics_dict[_split] = compute_metrics(hypothesis=path_hypothesis, references=[path_reference],
+                                                   no_skipthoughts=True, no_glove=True)
 
     with open(path_metric, 'w') as f:
         json.dump(metrics_dict, f)
     return metrics_dict
+
+
+def evaluate_quantization(model: str,
+                          export_dir: str,
+                          n_sample: int = 500,
+                          split: str = 'dev',
+                          metric: str = 'Bleu_4',
+                          **kwargs):
+    """ Compare the metric of the model with dynamic int8 quantization against the fp32 model on a sample.
+
+    @param model: Path to the checkpoint or alias on huggingface modelhub.
+    @param export_dir: Directory to export the prediction of each model (`fp32` and `int8` sub-directories).
+    @param n_sample: Number of the examples to evaluate.
+    @param split: Split to evaluate.
+    @param metric: Metric to compare.
+    @param kwargs: Other arguments of `evaluate_qg`.
+    @return: Dictionary of the metric of each model and the difference.
+    """
+    fp32 = evaluate_qg(model, '{}/fp32'.format(export_dir), n_sample=n_sample, split=split, **kwargs)
+    int8 = evaluate_qg(model, '{}/int8'.format(export_dir), n_sample=n_sample, split=split, quantize=True, **kwargs)
+    return {'fp32': fp32[split][metric], 'int8': int8[split][metric], 'diff': int8[split][metric] - fp32[split][metric]}
@@ -23,3 +23,19 @@ class AnswerNotFoundError(Exception):
     def __init__(self, context: str):
         self.message = 'Model cannot find any answer candidates in `{}`'.format(context)
         super().__init__(self.message)
+
+
+class QueueFullError(Exception):
+    """ Request queue of the scheduler is full. """
+
+    def __init__(self, max_queue_size: int = None):
+        self.message = 'Request queue is full (max queue size: {})'.format(max_queue_size)
+        super().__init__(self.message)
+
+
+class ModelNotFoundError(Exception):
+    """ Model is not registered. """
+
+    def __init__(self, name: str = None, language: str = None):
+        self.message = 'Model is not registered (name: {}, language: {})'.format(name, language)
+        super().__init__(self.message)
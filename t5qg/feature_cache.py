@@ -0,0 +1,129 @@
+""" Memory-mapped columnar cache of the encoded features.
+
+Each field (`input_ids`, `attention_mask`, `labels`) is stored as a flat token array plus an offsets index, so the
+cache is loaded in constant time with `numpy.load(mmap_mode='r')`, and its pages are shared across the DataLoader
+workers instead of each worker holding its own copy of a list of python integers.
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+from itertools import chain
+from typing import List, Dict
+
+import numpy as np
+import torch
+
+__all__ = ('CACHE_VERSION', 'MemmapDataset', 'save_feature', 'load_feature', 'tokenizer_fingerprint',
+           'feature_fingerprint')
+CACHE_VERSION = 1
+FIELD_DTYPE = {'attention_mask': np.int8}
+
+
+def tokenizer_fingerprint(tokenizer):
+    """ Hash of the tokenizer vocabulary and the special tokens. """
+    vocab = sorted(tokenizer.get_vocab().items(), key=lambda x: x[1])
+    config = [type(tokenizer).__name__, len(tokenizer), tokenizer.all_special_tokens, vocab]
+    return hashlib.md5(json.dumps(config, ensure_ascii=False).encode()).hexdigest()
+
+
+def feature_fingerprint(tokenizer, **kwargs):
+    """ Hash of the tokenizer and the preprocessing parameters, which identifies the encoded features. """
+    config = {'version': CACHE_VERSION, 'tokenizer': tokenizer_fingerprint(tokenizer)}
+    config.update(kwargs)
+    return hashlib.md5(json.dumps(config, sort_keys=True).encode()).hexdigest()
+
+
+def save_feature(features: List[Dict], cache_dir: str, fingerprint: str):
+    """ Save the encoded features as flat arrays plus offsets.
+
+    @param features: List of the encoded features (dictionary of the list of token ids).
+    @param cache_dir: Directory to save the cache, which is written to a temporary directory first and then renamed
+        (an existing cache is kept instead).
+    @param fingerprint: Fingerprint to be validated when loading the cache.
+    """
+    tmp_dir = '{}.tmp.{}'.format(cache_dir, os.getpid())
+    os.makedirs(tmp_dir, exist_ok=True)
+    fields = sorted(features[0].keys()) if len(features) > 0 else []
+    for k in fields:
+        offsets = np.zeros(len(features) + 1, dtype=np.int64)
+        np.cumsum([len(f[k]) for f in features], out=offsets[1:])
+        array = np.fromiter(chain(*[f[k] for f in features]), dtype=FIELD_DTYPE.get(k, np.int32), count=offsets[-1])
+        np.save('{}/{}.npy'.format(tmp_dir, k), array)
+        np.save('{}/{}.offsets.npy'.format(tmp_dir, k), offsets)
+    with open('{}/meta.json'.format(tmp_dir), 'w') as f:
+        json.dump({'version': CACHE_VERSION, 'fingerprint': fingerprint, 'size': len(features), 'fields': fields}, f)
+    # the directory is content-addressed, so an existing cache (eg. built by a concurrent job, which may be in use)
+    # is kept as it is
+    if not os.path.exists(cache_dir):
+        try:
+            os.replace(tmp_dir, cache_dir)
+            return
+        except OSError:
+            if not os.path.exists(cache_dir):
+                raise
+    logging.info('cache is built by another process at {}'.format(cache_dir))
+    shutil.rmtree(tmp_dir)
+
+
+def load_feature(cache_dir: str, fingerprint: str = None):
+    """ Load the cache as MemmapDataset, or return None if the cache is missing or stale.
+
+    @param cache_dir: Directory of the cache.
+    @param fingerprint: Fingerprint of the current configuration (not validated if None).
+    @return: MemmapDataset or None.
+    """
+    path_meta = '{}/meta.json'.format(cache_dir)
+    if not os.path.exists(path_meta):
+        return None
+    with open(path_meta) as f:
+        meta = json.load(f)
+    if meta['version'] != CACHE_VERSION or (fingerprint is not None and meta['fingerprint'] != fingerprint):
+        logging.warning('stale cache at {} (version: {}, fingerprint: {}), expected (version: {}, fingerprint: {})'.format(
+            cache_dir, meta['version'], meta['fingerprint'], CACHE_VERSION, fingerprint))
+        return None
+    return MemmapDataset(cache_dir)
+
+
+class MemmapDataset(torch.utils.data.Dataset):
+    """ torch.utils.data.Dataset reading the memory-mapped cache without materializing python lists """
+    float_tensors = ['attention_mask']
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        with open('{}/meta.json'.format(self.cache_dir)) as f:
+            self.meta = json.load(f)
+        self.array = None
+        self.offsets = None
+        self.open()
+
+    def open(self):
+        self.array = {k: np.load('{}/{}.npy'.format(self.cache_dir, k), mmap_mode='r') for k in self.meta['fields']}
+        self.offsets = {k: np.load('{}/{}.offsets.npy'.format(self.cache_dir, k), mmap_mode='r')
+                        for k in self.meta['fields']}
+
+    def __getstate__(self):
+        # re-open the memory map in the worker process instead of pickling the arrays
+        state = self.__dict__.copy()
+        state['array'] = None
+        state['offsets'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.open()
+
+    def __len__(self):
+        return self.meta['size']
+
+    def lengths(self, name: str = 'input_ids'):
+        return np.diff(self.offsets[name]).tolist()
+
+    def to_tensor(self, name, data):
+        if name in self.float_tensors:
+            return torch.tensor(data, dtype=torch.float32)
+        return torch.from_numpy(data.astype(np.int64))
+
+    def __getitem__(self, idx):
+        return {k: self.to_tensor(k, v[self.offsets[k][idx]:self.offsets[k][idx + 1]]) for k, v in self.array.items()}
@@ -0,0 +1,179 @@
+""" Metrics of the inference pipeline (histograms and counters) rendered in the Prometheus text format.
+
+The metrics are recorded to the global `METRICS`, which is disabled by default and costs a single attribute lookup
+per call until `METRICS.enable()` is called. Hooks registered by `METRICS.add_hook` receive every record, eg. to
+forward them to another monitoring system.
+"""
+import bisect
+import logging
+import threading
+import time
+from typing import Callable
+
+__all__ = ('METRICS', 'Metrics', 'LATENCY_BUCKETS', 'SIZE_BUCKETS')
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+THROUGHPUT_BUCKETS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+DESCRIPTION = {
+    't5qg_stage_seconds': ('histogram', 'Latency of each stage (split, tokenize, encode, decode, detokenize).'),
+    't5qg_batch_size': ('histogram', 'Number of the inputs in a model call.'),
+    't5qg_tokens_per_second': ('histogram', 'Generated tokens per second of a model call.'),
+    't5qg_generated_tokens_total': ('counter', 'Number of the generated tokens.'),
+    't5qg_queue_wait_seconds': ('histogram', 'Time of a request waiting in the queue of the scheduler.'),
+    't5qg_request_seconds': ('histogram', 'Latency of a request.'),
+    't5qg_result_cache_total': ('counter', 'Lookups of the result cache by the result (hit or miss).'),
+    't5qg_errors_total': ('counter', 'Errors by the exception type.')
+}
+
+
+class NullTimer:
+    """ Timer doing nothing when the metrics are disabled. """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+NULL_TIMER = NullTimer()
+
+
+class Timer:
+    """ Context to observe the elapsed time in a histogram. """
+
+    def __init__(self, metrics, name: str, labels: dict):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+        self.start = None
+        self.elapsed = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.elapsed = time.perf_counter() - self.start
+        self.metrics.observe(self.name, self.elapsed, **self.labels)
+        return False
+
+
+class Histogram:
+
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def format_labels(labels: tuple):
+    if len(labels) == 0:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('"', '\\"')) for k, v in labels) + '}'
+
+
+class Metrics:
+    """ Registry of the histograms and the counters. """
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.histograms = {}
+        self.counters = {}
+        self.hooks = []
+        self.lock = threading.Lock()
+
+    def enable(self):
+        self.enabled = True
+        return self
+
+    def disable(self):
+        self.enabled = False
+        return self
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+            self.counters = {}
+
+    def add_hook(self, hook: Callable):
+        """ Register a function of (kind, name, value, labels) called on each record (`kind` is either of
+        `histogram` or `counter`). """
+        self.hooks.append(hook)
+
+    def call_hooks(self, kind: str, name: str, value: float, labels: dict):
+        for hook in self.hooks:
+            try:
+                hook(kind, name, value, labels)
+            except Exception:
+                logging.exception('metrics hook failed')
+
+    def observe(self, name: str, value: float, buckets: tuple = None, **labels):
+        """ Observe the value in the histogram of the name and the labels. """
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram(LATENCY_BUCKETS if buckets is None else buckets)
+            self.histograms[key].observe(value)
+        self.call_hooks('histogram', name, value, labels)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        """ Increment the counter of the name and the labels. """
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+        self.call_hooks('counter', name, value, labels)
+
+    def timer(self, name: str, **labels):
+        """ Context to observe the elapsed time (sec) in the histogram. """
+        if not self.enabled:
+            return NULL_TIMER
+        return Timer(self, name, labels)
+
+    def stage(self, stage: str):
+        """ Context to observe the latency of a stage of the pipeline. """
+        return self.timer('t5qg_stage_seconds', stage=stage)
+
+    def error(self, exception: Exception):
+        self.inc('t5qg_errors_total', type=type(exception).__name__)
+
+    def render(self):
+        """ Metrics in the Prometheus text exposition format. """
+        with self.lock:
+            histograms = sorted(self.histograms.items())
+            counters = sorted(self.counters.items())
+        lines = []
+        described = set()
+
+        def describe(name, kind):
+            if name not in described:
+                described.add(name)
+                if name in DESCRIPTION:
+                    lines.append('# HELP {} {}'.format(name, DESCRIPTION[name][1]))
+                lines.append('# TYPE {} {}'.format(name, kind))
+
+        for (name, labels), h in histograms:
+            describe(name, 'histogram')
+            cumulative = 0
+            for le, count in zip(list(h.buckets) + ['+Inf'], h.counts):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(name, format_labels(labels + (('le', le),)), cumulative))
+            lines.append('{}_sum{} {}'.format(name, format_labels(labels), h.sum))
+            lines.append('{}_count{} {}'.format(name, format_labels(labels), h.count))
+        for (name, labels), value in counters:
+            describe(name, 'counter')
+            lines.append('{}{} {}'.format(name, format_labels(labels), value))
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = Metrics()
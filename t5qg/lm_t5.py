@@ -4,16 +4,26 @@ import os
 import logging
 import pickle
 import re
+import threading
+import time
 from typing import List, Dict
 from multiprocessing import Pool
 
 import torch
 from torch.nn import CrossEntropyLoss, functional
+from torch.utils.checkpoint import checkpoint
 import transformers
 from .exceptions import ExceedMaxLengthError, HighlightNotFoundError, AnswerNotFoundError
-from . import sentence_split
+from .batching import BucketBatchSampler, RandomBatchSampler, TokenBudgetBatchSampler, DynamicPaddingCollator, \
+    PackedDataset
+from .feature_cache import MemmapDataset, save_feature, load_feature, feature_fingerprint, tokenizer_fingerprint
+from .cache import CacheManifest, text_fingerprint, config_fingerprint
+from .decoding import DecodingPolicy, highlight_length
+from .instrumentation import METRICS, SIZE_BUCKETS, THROUGHPUT_BUCKETS
 
 CE_IGNORE_INDEX = -100
+# inference_mode is faster than no_grad but only available for torch>=1.9
+inference_mode = getattr(torch, 'inference_mode', torch.no_grad)
 
 os.environ["TOKENIZERS_PARALLELISM"] = "false"  # to turn off warning message
 TASK_PREFIX = {
@@ -70,8 +80,17 @@ def load_language_model(model_name, cache_dir: str = None):
     return tokenizer, model, config
 
 
-def label_smoothed_loss(logits, labels, epsilon):
-    """ https://github.com/huggingface/transformers/blob/55bb4c06f7be141c6d895dbe1f11018dc8580b2d/src/transformers/trainer_pt_utils.py#L430 """
+def clean(string):
+    string = re.sub(r'\A\s*', '', string)
+    string = re.sub(r'\s*\Z', '', string)
+    if len(string) > 0:
+        return string
+    return None
+
+
+def label_smoothed_loss(logits, labels, epsilon, reduction: str = 'mean'):
+    """ https://github.com/huggingface/transformers/blob/55bb4c06f7be141c6d895dbe1f11018dc8580b2d/src/transformers/trainer_pt_utils.py#L430
+    (`reduction='sum'` returns the sum over the tokens instead of the mean) """
     log_probs = - functional.log_softmax(logits, dim=-1)
     if labels.dim() == log_probs.dim() - 1:
         labels = labels.unsqueeze(-1)
@@ -90,11 +109,60 @@ def label_smoothed_loss(logits, labels, epsilon):
 
     # Take the mean over the label dimensions, then divide by the number of active elements (i.e. not-padded):
     num_active_elements = padding_mask.numel() - padding_mask.long().sum()
+    if reduction == 'sum':
+        num_active_elements = 1
     nll_loss = nll_loss.sum() / num_active_elements
     smoothed_loss = smoothed_loss.sum() / (num_active_elements * log_probs.shape[-1])
     return (1 - epsilon) * nll_loss + epsilon * smoothed_loss
 
 
+def smoothed_cross_entropy(logits, labels, padding_mask):
+    """ Sums of the negative log likelihood and the negative log probabilities over the vocabulary of the tokens,
+    computed from the log-sum-exp without the log probabilities of the vocabulary (in fp32 at least). """
+    if torch.finfo(logits.dtype).bits < 32:
+        logits = logits.float()
+    log_normalizer = torch.logsumexp(logits, dim=-1)
+    nll_loss = log_normalizer - logits.gather(dim=-1, index=labels.unsqueeze(-1)).squeeze(-1)
+    smoothed_loss = log_normalizer * logits.size(-1) - logits.sum(dim=-1)
+    return nll_loss.masked_fill(padding_mask, 0.0).sum(), smoothed_loss.masked_fill(padding_mask, 0.0).sum()
+
+
+def chunked_label_smoothed_loss(logits, labels, epsilon, reduction: str = 'mean', chunk_size: int = 1024):
+    """ Same loss as `label_smoothed_loss` computed over the chunks of `chunk_size` tokens, where each chunk is
+    recomputed in the backward pass (activation checkpointing), so that neither the log probabilities nor the fp32
+    copy of the half precision logits [batch, length, vocab] are kept (labels are not modified in place). """
+    vocab_size = logits.size(-1)
+    logits = logits.reshape(-1, vocab_size)
+    labels = labels.reshape(-1)
+    padding_mask = labels.eq(CE_IGNORE_INDEX)
+    labels = labels.clamp_min(0)
+    checkpointing = torch.is_grad_enabled() and logits.requires_grad
+    nll_loss, smoothed_loss = 0.0, 0.0
+    for i in range(0, len(labels), chunk_size):
+        chunk = (logits[i:i + chunk_size], labels[i:i + chunk_size], padding_mask[i:i + chunk_size])
+        if checkpointing:
+            _nll_loss, _smoothed_loss = checkpoint(smoothed_cross_entropy, *chunk, use_reentrant=False)
+        else:
+            _nll_loss, _smoothed_loss = smoothed_cross_entropy(*chunk)
+        nll_loss = nll_loss + _nll_loss
+        smoothed_loss = smoothed_loss + _smoothed_loss
+    num_active_elements = 1 if reduction == 'sum' else padding_mask.numel() - padding_mask.long().sum()
+    nll_loss = nll_loss / num_active_elements
+    smoothed_loss = smoothed_loss / (num_active_elements * vocab_size)
+    return (1 - epsilon) * nll_loss + epsilon * smoothed_loss
+
+
+def packed_attention_mask(query_segment_ids, key_segment_ids, causal: bool = False):
+    """ Attention mask [batch, query, key] of the packed rows, where a token attends only to the tokens of the same
+    example (and the preceding ones if causal). The 3D mask is taken as is by `get_extended_attention_mask` of the
+    encoder and the decoder, and by `invert_attention_mask` of the cross attention (transformers<4.46). The padding
+    (segment 0) attends to every key, as a query masking every key gives NaN in the softmax of float64. """
+    mask = query_segment_ids.unsqueeze(-1).eq(key_segment_ids.unsqueeze(-2)) | query_segment_ids.eq(0).unsqueeze(-1)
+    if causal:
+        mask = mask.tril()
+    return mask.long()
+
+
 class Dataset(torch.utils.data.Dataset):
     """ torch.utils.data.Dataset wrapper converting into tensor """
     float_tensors = ['attention_mask']
@@ -110,6 +178,9 @@ class Dataset(torch.utils.data.Dataset):
             return torch.tensor(data, dtype=torch.float32)
         return torch.tensor(data, dtype=torch.long)
 
+    def lengths(self, name: str = 'input_ids'):
+        return [len(i[name]) for i in self.data]
+
     def __getitem__(self, idx):
         return {k: self.to_tensor(k, v) for k, v in self.data[idx].items()}
 
@@ -157,9 +228,8 @@ class EncodePlus:
     def __call__(self, inputs):
         return self.encode_plus(*inputs)
 
-    def encode_plus(self, input_sequence: str, output_sequence: str = None, input_highlight: str = None):
-
-        # add highlight to the input
+    def preprocess(self, input_sequence: str, input_highlight: str = None):
+        """ Add the highlight and the task prefix to the input (None if the highlight is skipped). """
         if input_highlight is not None:
             position = input_sequence.find(input_highlight)
             if position == -1:
@@ -172,6 +242,14 @@ class EncodePlus:
 
         if self.task_prefix is not None:
             input_sequence = '{}: {}'.format(TASK_PREFIX[self.task_prefix], input_sequence)
+        return input_sequence
+
+    def encode_plus(self, input_sequence: str, output_sequence: str = None, input_highlight: str = None):
+
+        # add highlight to the input
+        input_sequence = self.preprocess(input_sequence, input_highlight)
+        if input_sequence is None:
+            return None
 
         # remove sentence that exceeds the max_length
         if self.drop_overflow_text or not self.skip_overflow_error:
@@ -189,40 +267,207 @@ class EncodePlus:
             encode['labels'] = self.tokenizer.encode(output_sequence, **self.param_out)
         return encode
 
+    def batch_encode_plus(self, inputs: List, chunk_size: int = 1000):
+        """ Batched version of `encode_plus`, which tokenizes each chunk of the inputs with a single tokenizer call
+        and checks the overflow on the returned lengths, so each text is tokenized only once.
+
+        @param inputs: List of (input_sequence, output_sequence, input_highlight) as `encode_plus`.
+        @param chunk_size: Number of inputs to tokenize in a single call.
+        @return: List of the encoded features (None for the dropped inputs).
+        """
+        out = []
+        for i in range(0, len(inputs), chunk_size):
+            out += self.batch_encode_plus_chunk(inputs[i:i + chunk_size])
+        return out
+
+    def batch_encode_plus_chunk(self, inputs: List):
+        out = [None] * len(inputs)
+        index, input_sequence, output_sequence = [], [], []
+        for n, i in enumerate(inputs):
+            _input = self.preprocess(i[0], i[2] if len(i) > 2 else None)
+            if _input is None:
+                continue
+            index.append(n)
+            input_sequence.append(_input)
+            output_sequence.append(i[1] if len(i) > 1 else None)
+        if len(index) == 0:
+            return out
+        with_output = all(o is not None for o in output_sequence)
+
+        if self.drop_overflow_text or not self.skip_overflow_error:
+            # tokenize without truncation to get the actual length, then pad the ones within the max length,
+            # which is identical to tokenize with truncation
+            encode = self.tokenizer(input_sequence)
+            labels = self.tokenizer(output_sequence)['input_ids'] if with_output else None
+            keep = []
+            for n in range(len(index)):
+                if len(encode['input_ids'][n]) > self.max_length or \
+                        (with_output and len(labels[n]) > self.max_length_output):
+                    if self.drop_overflow_text:
+                        continue
+                    raise ExceedMaxLengthError(self.max_length)
+                keep.append(n)
+            index = [index[n] for n in keep]
+            encode = {k: [v[n] for n in keep] for k, v in encode.items()}
+            if self.padding:
+                encode = self.tokenizer.pad(encode, padding='max_length', max_length=self.max_length)
+            if with_output:
+                labels = {'input_ids': [labels[n] for n in keep]}
+                if self.padding:
+                    labels = self.tokenizer.pad(labels, padding='max_length', max_length=self.max_length_output)
+                labels = labels['input_ids']
+        else:
+            encode = self.tokenizer(input_sequence, **self.param_in)
+            labels = self.tokenizer(output_sequence, **self.param_out)['input_ids'] if with_output else None
+
+        for n, i in enumerate(index):
+            out[i] = {k: encode[k][n] for k in encode.keys()}
+            if with_output:
+                out[i]['labels'] = labels[n]
+        return out
+
 
 class T5:
     """ T5 model. """
 
     def __init__(self, model: str, max_length: int = 512, max_length_output: int = 32, cache_dir: str = None,
-                 label_smoothing: float = None):
+                 label_smoothing: float = None, quantize: bool = False, num_threads: int = None,
+                 num_interop_threads: int = None, draft_model: str = None, num_draft_tokens: int = None,
+                 distributed: bool = False, language: str = None):
         """ T5 model.
 
         @param model: path to the checkpoint or alias on huggingface modelhub.
         @param max_length: Max sequence length for the input.
         @param max_length_output: Max sequence length for the output.
         @param cache_dir:
+        @param quantize: Apply dynamic int8 quantization to the linear layers for CPU inference (the model is
+            placed on CPU and cannot be trained or saved).
+        @param num_threads: Number of the intra-op threads of torch.
+        @param num_interop_threads: Number of the inter-op threads of torch.
+        @param draft_model: Path to the checkpoint or alias on huggingface modelhub of a smaller model sharing the
+            tokenizer, which proposes the tokens to be verified by the model in greedy decoding (speculative decoding).
+        @param num_draft_tokens: Number of the tokens proposed by the draft model at each step (the heuristic schedule
+            of transformers if None).
+        @param distributed: Wrap the model with DistributedDataParallel on the device of the local rank instead of
+            DataParallel (the process group has to be initialized, see t5qg.distributed.init_distributed).
+        @param language: Language of the documents to split into the sentences for answer extraction, which skips
+            the language detection (detected for each document if None).
         """
-        self.model_name = model
-        self.max_length = max_length
-        self.max_length_output = max_length_output
-        self.label_smoothing = label_smoothing
+        self.init_state(model, max_length, max_length_output, language, label_smoothing, quantize)
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+        if num_interop_threads is not None:
+            try:
+                torch.set_num_interop_threads(num_interop_threads)
+            except RuntimeError:  # can be set only once before any inter-op parallel work
+                logging.warning('failed to set the inter-op threads: {}'.format(torch.get_num_interop_threads()))
         logging.info('instantiate T5 model class with `{}`'.format(self.model_name))
+        start = time.time()
         self.tokenizer, self.model, config = load_language_model(self.model_name, cache_dir=cache_dir)
-        self.no_prefix = False
+        self.startup_time['load_language_model'] = time.time() - start
+        self.model_type = config.model_type
         if config.model_type in ['mbart', 'bart']:
             self.no_prefix = True
 
         # GPU setup
-        self.device = 'cuda' if torch.cuda.device_count() > 0 else 'cpu'
-        self.parallel = False
-        if torch.cuda.device_count() > 1:
+        start = time.time()
+        self.device = 'cuda' if torch.cuda.device_count() > 0 and not self.quantize else 'cpu'
+        self.distributed = distributed
+        if self.quantize:
+            assert not self.distributed, 'quantized model cannot be trained'
+            self.model.eval()
+            self.model = torch.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+            logging.info('dynamic int8 quantization is applied')
+        elif self.distributed:
+            # one process per device
+            local_rank = int(os.getenv('LOCAL_RANK', 0))
+            self.device = 'cuda:{}'.format(local_rank) if self.device == 'cuda' else 'cpu'
+            self.parallel = True
+            self.model = torch.nn.parallel.DistributedDataParallel(
+                self.model.to(self.device), device_ids=None if self.device == 'cpu' else [local_rank])
+        elif torch.cuda.device_count() > 1:
             self.parallel = True
             self.model = torch.nn.DataParallel(self.model)
         self.model.to(self.device)
         logging.info('{} GPUs are in use'.format(torch.cuda.device_count()))
+        self.startup_time['device_setup'] = time.time() - start
+        logging.info('startup time (sec): {}'.format(self.startup_time))
+        if draft_model is not None:
+            self.set_draft_model(draft_model, num_draft_tokens, cache_dir=cache_dir)
 
-        # for answer extraction model
-        self.sentence_splitter = sentence_split.SentSplit()
+    def init_state(self, model: str, max_length: int, max_length_output: int, language: str = None,
+                   label_smoothing: float = None, quantize: bool = False):
+        """ Set the attributes other than the model, shared with the backends of the same interface (eg.
+        t5qg.onnx_model.OnnxT5). """
+        self.model_name = model
+        self.max_length = max_length
+        self.max_length_output = max_length_output
+        self.language = language
+        self.label_smoothing = label_smoothing
+        self.quantize = quantize
+        self.startup_time = {}
+        self.no_prefix = False
+        self.device = 'cpu'
+        self.parallel = False
+        self.distributed = False
+        # for answer extraction model (instantiated at the first use)
+        self._sentence_splitter = None
+        # t5qg.result_cache.ResultCache to memoize the prediction
+        self.result_cache = None
+        # t5qg.decoding.DecodingPolicy to resolve the decoding config of each model call
+        self.decoding_policy = DecodingPolicy()
+        self._fingerprint = None
+        # time of the encoder in the current model call, measured by the forward hooks if the metrics are enabled
+        self.encoder_time = threading.local()
+        self._encoder_hook = None
+        self.draft_model = None
+
+    def set_draft_model(self, model: str, num_draft_tokens: int = None, cache_dir: str = None):
+        """ Load the draft model for speculative decoding.
+
+        @param model: Path to the checkpoint or alias on huggingface modelhub.
+        @param num_draft_tokens: Number of the tokens proposed by the draft model at each step.
+        @param cache_dir:
+        """
+        start = time.time()
+        tokenizer, draft_model, config = load_language_model(model, cache_dir=cache_dir)
+        # the draft tokens are verified by their ids, so the vocabulary has to be identical
+        if tokenizer_fingerprint(tokenizer) != tokenizer_fingerprint(self.tokenizer):
+            raise ValueError('tokenizer of the draft model {} does not match the model {}'.format(
+                model, self.model_name))
+        draft_model.eval()
+        if self.quantize:
+            draft_model = torch.quantization.quantize_dynamic(draft_model, {torch.nn.Linear}, dtype=torch.qint8)
+        if num_draft_tokens is not None:
+            draft_model.generation_config.num_assistant_tokens = num_draft_tokens
+            draft_model.generation_config.num_assistant_tokens_schedule = 'constant'
+        self.draft_model = draft_model.to(self.device)
+        self.startup_time['load_draft_model'] = time.time() - start
+        logging.info('draft model `{}` is loaded in {} sec'.format(model, self.startup_time['load_draft_model']))
+
+    @property
+    def fingerprint(self):
+        """ Hash of the model config, the tokenizer, and the checkpoint files if the model is loaded from local. """
+        if self._fingerprint is None:
+            model = self.model.module if self.parallel else self.model
+            files = []
+            if os.path.isdir(self.model_name):
+                files = sorted([(i, os.path.getmtime(os.path.join(self.model_name, i)))
+                                for i in os.listdir(self.model_name)])
+            self._fingerprint = config_fingerprint(
+                model=self.model_name, config=model.config.to_json_string(), files=files,
+                tokenizer=tokenizer_fingerprint(self.tokenizer), quantize=self.quantize)
+        return self._fingerprint
+
+    @property
+    def sentence_splitter(self):
+        if self._sentence_splitter is None:
+            start = time.time()
+            from .sentence_split import SentSplit
+            self._sentence_splitter = SentSplit()
+            self.startup_time['sentence_splitter'] = time.time() - start
+            logging.info('sentence splitter is loaded in {} sec'.format(self.startup_time['sentence_splitter']))
+        return self._sentence_splitter
 
     def train(self):
         self.model.train()
@@ -236,73 +481,210 @@ class T5:
                     skip_overflow_error: bool = False,
                     parallel: bool = False,
                     batch_size: int = None,
-                    num_beams: int = 4,
+                    num_beams: int = None,
                     num_workers: int = 0,
-                    cache_path: str = None):
+                    cache_path: str = None,
+                    dynamic_padding: bool = False,
+                    batch_encoding: bool = False):
         """ Generate question given context.
 
         @param context: Input context.
         @param drop_overflow_text: Return None if the input sentence exceeds the max token length.
         @param skip_overflow_error: Raise error if the input sentence exceeds the max token length.
         @param batch_size: Batch size.
-        @param num_beams: Number of beam for model generation.
+        @param num_beams: Number of beam for model generation (the default of the task if None).
         @param num_workers:
         @param cache_path:
+        @param dynamic_padding: Pad each batch to its longest input instead of the max length.
+        @param batch_encoding: Tokenize the inputs in batch with the fast tokenizer instead of one by one.
         @return: List of generated sentences.
         """
         logging.info('running model for `ans_ext`')
         list_answer = self.generate_a(
             context, drop_overflow_text=drop_overflow_text, batch_size=batch_size, num_beams=num_beams,
             skip_overflow_error=skip_overflow_error, num_workers=num_workers, cache_path=cache_path,
-            parallel=parallel)
+            parallel=parallel, dynamic_padding=dynamic_padding,
+            batch_encoding=batch_encoding)
         list_context = [context] * len(list_answer)
         logging.info('running model for `qg`')
         list_question = self.generate_q(
             list_context, list_answer=list_answer, drop_overflow_text=drop_overflow_text, batch_size=batch_size,
             skip_overflow_error=skip_overflow_error, num_workers=num_workers, cache_path=cache_path,
-            num_beams=num_beams, parallel=parallel)
+            num_beams=num_beams, parallel=parallel, dynamic_padding=dynamic_padding,
+            batch_encoding=batch_encoding)
         assert len(list_answer) == len(list_question)
         return list(zip(list_question, list_answer))
 
+    def generate_qa_stream(self, context: str, chunk_size: int = 4, **kwargs):
+        """ Generator of (question, answer) pairs, which runs answer extraction and question generation on each
+        chunk of sentences in turn, so that the first pairs are yielded before the whole document is processed.
+
+        @param context: Input context.
+        @param chunk_size: Number of sentences in a chunk.
+        @param kwargs: Keyword arguments of `generate_prediction` (eg. num_beams, batch_size).
+        """
+        assert not self.no_prefix, 'model is not trained for answer extraction'
+        list_sentence = self.split_sentence(context)
+        n_pair = 0
+        for i in range(0, len(list_sentence), chunk_size):
+            chunk = list_sentence[i:i + chunk_size]
+            list_answer = self.generate_prediction(
+                [context] * len(chunk), list_highlight=chunk, task_type='ans_ext', **kwargs)
+            try:
+                list_answer = self.filter_answer(context, list_answer)
+            except AnswerNotFoundError:
+                continue
+            list_question = self.generate_prediction(
+                [context] * len(list_answer), list_highlight=list_answer, task_type='qg', **kwargs)
+            for q, a in zip(list_question, list_answer):
+                yield q, a
+                n_pair += 1
+        if n_pair == 0:
+            raise AnswerNotFoundError(context)
+
+    def generate_qa_batch(self,
+                          list_context: List,
+                          drop_overflow_text: bool = False,
+                          skip_overflow_error: bool = False,
+                          parallel: bool = False,
+                          batch_size: int = None,
+                          num_beams: int = None,
+                          num_workers: int = 0,
+                          dynamic_padding: bool = False,
+                          batch_encoding: bool = False):
+        """ Generate question and answer pairs of multiple documents. The sentences of all the documents are
+        processed in the same batches for answer extraction, and so are all the answers for question generation.
+
+        @param list_context: List of input contexts.
+        @param drop_overflow_text: Return None if the input sentence exceeds the max token length.
+        @param skip_overflow_error: Raise error if the input sentence exceeds the max token length.
+        @param batch_size: Batch size.
+        @param num_beams: Number of beam for model generation (the default of the task if None).
+        @param num_workers:
+        @param dynamic_padding: Pad each batch to its longest input instead of the max length.
+        @param batch_encoding: Tokenize the inputs in batch with the fast tokenizer instead of one by one.
+        @return: List of the (question, answer) pairs of each context, or the exception raised for the context
+            (eg. AnswerNotFoundError) so that a failure does not affect the other contexts.
+        """
+        config = dict(drop_overflow_text=drop_overflow_text, skip_overflow_error=skip_overflow_error,
+                      parallel=parallel, batch_size=batch_size, num_beams=num_beams, num_workers=num_workers,
+                      dynamic_padding=dynamic_padding, batch_encoding=batch_encoding)
+        assert not self.no_prefix, 'model is not trained for answer extraction'
+        logging.info('running model for `ans_ext`')
+        try:
+            list_sentence = self.split_sentence_many(list_context)
+        except Exception:
+            # split each context to return the exception for the failed one
+            list_sentence = []
+            for context in list_context:
+                try:
+                    list_sentence.append(self.split_sentence(context))
+                except Exception as e:
+                    METRICS.error(e)
+                    list_sentence.append(e)
+        list_answer = self.generate_prediction_group(list_context, list_sentence, task_type='ans_ext', **config)
+        for n, (context, answer) in enumerate(zip(list_context, list_answer)):
+            if not isinstance(answer, Exception):
+                try:
+                    list_answer[n] = self.filter_answer(context, answer)
+                except AnswerNotFoundError as e:
+                    METRICS.error(e)
+                    list_answer[n] = e
+        logging.info('running model for `qg`')
+        list_question = self.generate_prediction_group(list_context, list_answer, task_type='qg', **config)
+        return [q if isinstance(q, Exception) else list(zip(q, a)) for q, a in zip(list_question, list_answer)]
+
+    def generate_prediction_group(self, list_context: List, list_highlight: List, task_type: str = 'qg', **kwargs):
+        """ Run `generate_prediction` on the highlights of all the contexts at once and regroup the result.
+        If the batch fails, each context is processed separately to return the exception for the failed one.
+
+        @param list_context: List of contexts.
+        @param list_highlight: List of the highlights of each context (or an exception to pass through).
+        @param task_type: Either of `qg`, `ans_ext`, `qa`.
+        @return: List of the generated sentences of each context, or the exception raised for the context.
+        """
+        index = [n for n, h in enumerate(list_highlight) if not isinstance(h, Exception) and len(h) > 0]
+        out = list_highlight.copy()
+        flat_context = list(itertools.chain(*[[list_context[n]] * len(list_highlight[n]) for n in index]))
+        flat_highlight = list(itertools.chain(*[list_highlight[n] for n in index]))
+        try:
+            flat_out = self.generate_prediction(
+                flat_context, list_highlight=flat_highlight, task_type=task_type, **kwargs) if flat_context else []
+            assert len(flat_out) == len(flat_context), 'some inputs are dropped'
+        except Exception:
+            logging.exception('batch prediction failed, fallback to the prediction of each context')
+            for n in index:
+                try:
+                    out[n] = self.generate_prediction(
+                        [list_context[n]] * len(list_highlight[n]), list_highlight=list_highlight[n],
+                        task_type=task_type, **kwargs)
+                except Exception as e:
+                    METRICS.error(e)
+                    out[n] = e
+            return out
+        start = 0
+        for n in index:
+            out[n] = flat_out[start:start + len(list_highlight[n])]
+            start += len(list_highlight[n])
+        return out
+
     def generate_a(self,
                    context: str,
                    drop_overflow_text: bool = False,
                    skip_overflow_error: bool = False,
                    parallel: bool = False,
                    batch_size: int = None,
-                   num_beams: int = 4,
+                   num_beams: int = None,
                    num_workers: int = 0,
-                   cache_path: str = None):
+                   cache_path: str = None,
+                   dynamic_padding: bool = False,
+                   batch_encoding: bool = False):
         """ Generate answer candidate in each sentence.
 
         @param context: Input document.
         @param drop_overflow_text: Return None if the input sentence exceeds the max token length.
         @param skip_overflow_error: Raise error if the input sentence exceeds the max token length.
         @param batch_size: Batch size.
-        @param num_beams: Number of beam for model generation.
+        @param num_beams: Number of beam for model generation (the default of the task if None).
         @param num_workers:
         @param cache_path:
+        @param dynamic_padding: Pad each batch to its longest input instead of the max length.
+        @param batch_encoding: Tokenize the inputs in batch with the fast tokenizer instead of one by one.
         @return: List of generated answer.
         """
         assert not self.no_prefix, 'model is not trained for answer extraction'
-
-        def clean(string):
-            string = re.sub(r'\A\s*', '', string)
-            string = re.sub(r'\s*\Z', '', string)
-            if len(string) > 0:
-                return string
-            return None
-
         # list_context = process_for_ans_ext(context)
-        list_sentence = [clean(i) for i in self.sentence_splitter(context)]
+        list_sentence = self.split_sentence(context)
         list_context = [context] * len(list_sentence)
 
         out = self.generate_prediction(
             list_context, list_highlight=list_sentence, task_type='ans_ext', drop_overflow_text=drop_overflow_text,
             skip_overflow_error=skip_overflow_error, num_workers=num_workers, cache_path=cache_path,
-            num_beams=num_beams, batch_size=batch_size, parallel=parallel)
+            num_beams=num_beams, batch_size=batch_size, parallel=parallel, dynamic_padding=dynamic_padding,
+            batch_encoding=batch_encoding)
         # out = list(itertools.chain(*[[clean(ii) for ii in i.split(ADDITIONAL_SP_TOKENS['sep'])] for i in out]))
-        out = [clean(i) for i in out]
+        return self.filter_answer(context, out)
+
+    def split_sentence(self, context: str, language: str = None):
+        """ Split context into the sentences to be highlighted for answer extraction.
+
+        @param context: Input document.
+        @param language: Language of the document (the language of the model, or detected if it is None).
+        """
+        with METRICS.stage('split'):
+            language = self.language if language is None else language
+            return [clean(i) for i in self.sentence_splitter(context, language=language)]
+
+    def split_sentence_many(self, list_context: List, language: str = None):
+        """ Split the contexts into the sentences (see `split_sentence`). """
+        with METRICS.stage('split'):
+            language = self.language if language is None else language
+            return [[clean(i) for i in s] for s in self.sentence_splitter.split_many(list_context, language=language)]
+
+    @staticmethod
+    def filter_answer(context: str, list_answer: List):
+        """ Remove empty answers and answers out of the context, raising AnswerNotFoundError if nothing is left. """
+        out = [clean(i) for i in list_answer]
         out = list(filter(None, out))  # remove None
         out = list(filter(lambda x: x in context, out))  # remove answer out of context
         if len(out) == 0:
@@ -316,9 +698,11 @@ class T5:
                    skip_overflow_error: bool = False,
                    parallel: bool = False,
                    batch_size: int = None,
-                   num_beams: int = 4,
+                   num_beams: int = None,
                    num_workers: int = 0,
-                   cache_path: str = None):
+                   cache_path: str = None,
+                   dynamic_padding: bool = False,
+                   batch_encoding: bool = False):
         """ Generate question given context. Note that the answer should be either already highlighted in the context
         eg) "I live in <hl> Tokyo <hl>."
         or given by list_answer.
@@ -328,15 +712,18 @@ class T5:
         @param drop_overflow_text: Return None if the input sentence exceeds the max token length.
         @param skip_overflow_error: Raise error if the input sentence exceeds the max token length.
         @param batch_size: Batch size.
-        @param num_beams: Number of beam for model generation.
+        @param num_beams: Number of beam for model generation (the default of the task if None).
         @param num_workers:
         @param cache_path:
+        @param dynamic_padding: Pad each batch to its longest input instead of the max length.
+        @param batch_encoding: Tokenize the inputs in batch with the fast tokenizer instead of one by one.
         @return: List of generated sentences.
         """
         return self.generate_prediction(
             list_context, list_highlight=list_answer, task_type='qg', drop_overflow_text=drop_overflow_text,
             skip_overflow_error=skip_overflow_error, num_workers=num_workers, cache_path=cache_path,
-            num_beams=num_beams, batch_size=batch_size, parallel=parallel)
+            num_beams=num_beams, batch_size=batch_size, parallel=parallel, dynamic_padding=dynamic_padding,
+            batch_encoding=batch_encoding)
 
     def generate_prediction(self,
                             list_context: List,
@@ -347,9 +734,15 @@ class T5:
                             skip_highlight_error: bool = False,
                             parallel: bool = False,
                             batch_size: int = None,
-                            num_beams: int = 4,
+                            num_beams: int = None,
                             num_workers: int = 0,
-                            cache_path: str = None):
+                            cache_path: str = None,
+                            dynamic_padding: bool = False,
+                            batch_encoding: bool = False,
+                            deduplicate: bool = True,
+                            use_cache: bool = True,
+                            latency_budget: float = None,
+                            decoding: Dict = None):
         """ General method to generate model prediction
 
         @param list_context: List of input sentences.
@@ -358,41 +751,218 @@ class T5:
         @param drop_overflow_text: Return None if the input sentence exceeds the max token length.
         @param skip_overflow_error: Raise error if the input sentence exceeds the max token length.
         @param batch_size: Batch size.
-        @param num_beams: Number of beam for model generation.
+        @param num_beams: Number of beam for model generation (the default of the task if None).
         @param num_workers:
         @param cache_path:
+        @param dynamic_padding: Pad each batch to its longest input instead of the max length.
+        @param batch_encoding: Tokenize the inputs in batch with the fast tokenizer instead of one by one.
+        @param deduplicate: Run the model only once for identical (context, highlight) inputs, which is common when
+            multiple answers of a paragraph are given (ignored if some inputs can be dropped).
+        @param use_cache: Look up `T5.result_cache` before running the model (ignored if some inputs can be dropped).
+        @param latency_budget: Latency budget (sec) of a batch, under which the number of beams is lowered by
+            `T5.decoding_policy` (the budget of the policy if None).
+        @param decoding: Decoding config resolved by `T5.decoding_policy` (resolved from the other arguments if None).
         @return: List of generated sentences.
         """
         self.eval()
         assert type(list_context) == list, list_context
+        if decoding is None:
+            length = None
+            if self.decoding_policy.length_aware and task_type == 'ans_ext':
+                length = highlight_length(self.tokenizer, list_highlight)
+            decoding = self.decoding_policy.resolve(
+                task_type, num_beams=num_beams, latency_budget=latency_budget,
+                batch_size=max(1, min(batch_size or len(list_context), len(list_context))),
+                max_length_output=self.max_length_output, highlight_length=length)
+        # inputs are never dropped unless these flags are set, so the outputs can be mapped back to the inputs
+        if not drop_overflow_text and not skip_highlight_error:
+            config = dict(task_type=task_type, skip_overflow_error=skip_overflow_error, parallel=parallel,
+                          batch_size=batch_size, num_workers=num_workers, cache_path=cache_path,
+                          dynamic_padding=dynamic_padding, batch_encoding=batch_encoding, decoding=decoding)
+            inputs = list(zip(list_context, [None] * len(list_context) if list_highlight is None else list_highlight))
+
+            if use_cache and self.result_cache is not None:
+                keys = [self.result_cache.key(
+                    c, h, task_type=task_type, max_length=self.max_length, max_length_output=self.max_length_output,
+                    model=self.fingerprint, **self.decoding_policy.cache_config(decoding)) for c, h in inputs]
+                out = [self.result_cache.get(k) for k in keys]
+                miss = [n for n, o in enumerate(out) if o is None]
+                if len(miss) > 0:
+                    out_miss = self.generate_prediction(
+                        [list_context[n] for n in miss],
+                        list_highlight=None if list_highlight is None else [list_highlight[n] for n in miss],
+                        deduplicate=deduplicate, use_cache=False, **config)
+                    for n, o in zip(miss, out_miss):
+                        out[n] = o
+                        self.result_cache.set(keys[n], o)
+                return out
+
+            if deduplicate:
+                unique_inputs = list(dict.fromkeys(inputs))
+                if len(unique_inputs) < len(inputs):
+                    logging.info('deduplicate inputs: {} -> {}'.format(len(inputs), len(unique_inputs)))
+                    unique_context, unique_highlight = [list(i) for i in zip(*unique_inputs)]
+                    out = self.generate_prediction(
+                        unique_context, list_highlight=None if list_highlight is None else unique_highlight,
+                        deduplicate=False, use_cache=False, **config)
+                    out = dict(zip(unique_inputs, out))
+                    return [out[i] for i in inputs]
         # if highlight is not given, run answer extraction to get it
-        loader = self.get_data_loader(list_context,
-                                      highlights=list_highlight,
-                                      task_prefix=task_type,
-                                      drop_overflow_text=drop_overflow_text,
-                                      skip_overflow_error=skip_overflow_error,
-                                      batch_size=batch_size,
-                                      num_workers=num_workers,
-                                      cache_path=cache_path,
-                                      skip_highlight_error=skip_highlight_error,
-                                      parallel=parallel)
+        with METRICS.stage('tokenize'):
+            loader = self.get_data_loader(list_context,
+                                          highlights=list_highlight,
+                                          task_prefix=task_type,
+                                          drop_overflow_text=drop_overflow_text,
+                                          skip_overflow_error=skip_overflow_error,
+                                          batch_size=batch_size,
+                                          num_workers=num_workers,
+                                          cache_path=cache_path,
+                                          skip_highlight_error=skip_highlight_error,
+                                          parallel=parallel,
+                                          dynamic_padding=dynamic_padding,
+                                          batch_encoding=batch_encoding)
         outputs = []
         for encode in loader:
-            with torch.no_grad():
-                encode = {k: v.to(self.device) for k, v in encode.items()}
-                encode['max_length'] = self.max_length_output
-                encode['num_beams'] = num_beams
-                tensor = self.model.module.generate(**encode) if self.parallel else self.model.generate(**encode)
-                outputs += self.tokenizer.batch_decode(tensor, skip_special_tokens=True)
+            start = time.time()
+            outputs += self.generate_batch(encode, decoding)
+            self.decoding_policy.update(
+                task_type, decoding['num_beams'], len(encode['input_ids']), time.time() - start)
+        if dynamic_padding:
+            # bucketing sorts the inputs by length, so restore the original order
+            order = list(itertools.chain(*loader.batch_sampler))
+            _outputs = [None] * len(outputs)
+            for i, o in zip(order, outputs):
+                _outputs[i] = o
+            outputs = _outputs
         return outputs
 
-    def encode_to_loss(self, encode: Dict):
+    def generate_batch(self, encode: Dict, decoding: Dict):
+        """ Generate sentences of a single batch from the data loader.
+
+        @param encode: Batch of the encoded inputs (`input_ids` and `attention_mask`).
+        @param decoding: Decoding config resolved by `T5.decoding_policy`.
+        @return: List of generated sentences.
+        """
+        model = self.model.module if self.parallel else self.model
+        if METRICS.enabled:
+            self.register_encoder_hook(model)
+        self.encoder_time.value = 0.0
+        start = time.perf_counter()
+        with inference_mode():
+            encode = {k: v.to(self.device) for k, v in encode.items()}
+            batch_size = len(encode['input_ids'])
+            encode['max_length'] = decoding['max_length_output']
+            encode['num_beams'] = decoding['num_beams']
+            encode['early_stopping'] = decoding['early_stopping']
+            if decoding['num_candidates'] is not None and decoding['num_candidates'] > 1:
+                sequences = self.generate_batch_candidates(model, encode, decoding['num_candidates'])
+            elif self.draft_model is not None and decoding['num_beams'] == 1:
+                sequences = self.generate_batch_assisted(model, encode)
+            else:
+                sequences = model.generate(**encode)
+        self.record_generation(sequences, batch_size, time.perf_counter() - start)
+        with METRICS.stage('detokenize'):
+            return self.tokenizer.batch_decode(sequences, skip_special_tokens=True)
+
+    def generate_batch_candidates(self, model, encode: Dict, num_candidates: int):
+        """ Sample the candidates of all the inputs in a single call, and take the one of the highest score (mean
+        log-likelihood of the tokens) of each input. """
+        output = model.generate(**encode, do_sample=True, num_return_sequences=num_candidates,
+                                output_scores=True, return_dict_in_generate=True)
+        scores = model.compute_transition_scores(output.sequences, output.scores, normalize_logits=True)
+        mask = output.sequences[:, 1:] != self.tokenizer.pad_token_id
+        scores = (scores * mask).sum(-1) / mask.sum(-1).clamp_min(1)
+        best = scores.view(-1, num_candidates).argmax(-1)
+        best = best + torch.arange(len(best), device=best.device) * num_candidates
+        return output.sequences[best]
+
+    def generate_batch_assisted(self, model, encode: Dict):
+        """ Greedy decoding verifying the tokens proposed by the draft model, of which the output is identical to
+        the greedy decoding of the model. The assisted generation of transformers supports a single input at a time,
+        so the inputs are processed one by one without the padding. """
+        sequences = []
+        for input_ids, attention_mask in zip(encode.pop('input_ids'), encode.pop('attention_mask')):
+            length = int(attention_mask.sum())
+            tensor = model.generate(input_ids=input_ids[None, :length], attention_mask=attention_mask[None, :length],
+                                    assistant_model=self.draft_model, **encode)
+            sequences.append(tensor[0].tolist())
+        return sequences
+
+    def register_encoder_hook(self, model):
+        """ Register the forward hooks measuring the time of the encoder, which runs inside `generate`. """
+        if self._encoder_hook is not None:
+            return
+
+        def pre_hook(module, inputs):
+            self.encoder_time.start = time.perf_counter()
+
+        def hook(module, inputs, outputs):
+            self.encoder_time.value += time.perf_counter() - self.encoder_time.start
+
+        encoder = model.get_encoder()
+        self._encoder_hook = (encoder.register_forward_pre_hook(pre_hook), encoder.register_forward_hook(hook))
+
+    def record_generation(self, sequences, batch_size: int, elapsed: float):
+        """ Record the latency of encoding and decoding, the batch size, and the throughput of a model call. """
+        if not METRICS.enabled:
+            return
+        METRICS.observe('t5qg_stage_seconds', self.encoder_time.value, stage='encode')
+        METRICS.observe('t5qg_stage_seconds', elapsed - self.encoder_time.value, stage='decode')
+        METRICS.observe('t5qg_batch_size', batch_size, buckets=SIZE_BUCKETS)
+        pad = self.tokenizer.pad_token_id
+        # the first token is the decoder start token
+        n_tokens = sum(sum(1 for i in (s.tolist() if hasattr(s, 'tolist') else s)[1:] if i != pad) for s in sequences)
+        METRICS.inc('t5qg_generated_tokens_total', n_tokens)
+        if elapsed > 0:
+            METRICS.observe('t5qg_tokens_per_second', n_tokens / elapsed, buckets=THROUGHPUT_BUCKETS)
+
+    def encode_to_loss(self, encode: Dict, reduction: str = 'mean'):
+        """ Loss of the batch.
+
+        @param encode: Batch of the encoded features with `labels`.
+        @param reduction: `mean` over the tokens, or `sum` to normalize the gradients by the number of the tokens
+            over the accumulated batches.
+        """
         assert 'labels' in encode
-        output = self.model(**{k: v.to(self.device) for k, v in encode.items()})
-        if self.label_smoothing is None or self.label_smoothing == 0.0:
+        assert reduction in ['mean', 'sum'], reduction
+        if 'segment_ids' in encode:
+            return self.packed_loss(encode, reduction)
+        encode = {k: v.to(self.device) for k, v in encode.items()}
+        if reduction == 'mean' and (self.label_smoothing is None or self.label_smoothing == 0.0):
+            output = self.model(**encode)
             return output['loss'].mean() if self.parallel else output['loss']
-        else:
-            return label_smoothed_loss(output['logits'], encode['labels'].to(self.device), self.label_smoothing)
+        # without the labels, the model does not compute the cross entropy of its own over the logits
+        labels = encode.pop('labels')
+        model = self.model.module if self.parallel else self.model
+        encode['decoder_input_ids'] = model.prepare_decoder_input_ids_from_labels(labels=labels)
+        return self.logits_to_loss(self.model(**encode)['logits'], labels, reduction)
+
+    def logits_to_loss(self, logits, labels, reduction: str = 'mean'):
+        if self.label_smoothing is None or self.label_smoothing == 0.0:
+            loss_fct = CrossEntropyLoss(ignore_index=CE_IGNORE_INDEX, reduction=reduction)
+            return loss_fct(logits.view(-1, logits.size(-1)), labels.view(-1))
+        return chunked_label_smoothed_loss(logits, labels, self.label_smoothing, reduction)
+
+    def packed_loss(self, encode: Dict, reduction: str = 'mean'):
+        """ Loss of the packed rows (see t5qg.batching.PackedDataset), where the encoder and the decoder are run with
+        the block diagonal attention masks, since the model takes the same mask for the encoder and the cross
+        attention. T5 only, as its relative position bias within an example does not change by the packing. """
+        assert not self.parallel, 'sequence packing does not support (Distributed)DataParallel'
+        if hasattr(self.model.get_encoder(), '_update_causal_mask'):
+            # transformers>=4.46 takes only the 2D mask in the encoder, which would broadcast the 3D mask silently
+            raise ValueError('sequence packing requires transformers<4.46: {}'.format(transformers.__version__))
+        encode = {k: v.to(self.device) for k, v in encode.items()}
+        segment_ids, decoder_segment_ids = encode['segment_ids'], encode['decoder_segment_ids']
+        hidden = self.model.get_encoder()(
+            input_ids=encode['input_ids'], attention_mask=packed_attention_mask(segment_ids, segment_ids))[0]
+        hidden = self.model.get_decoder()(
+            input_ids=encode['decoder_input_ids'],
+            attention_mask=packed_attention_mask(decoder_segment_ids, decoder_segment_ids, causal=True),
+            encoder_hidden_states=hidden,
+            encoder_attention_mask=packed_attention_mask(decoder_segment_ids, segment_ids))[0]
+        if self.model.config.tie_word_embeddings:  # as in T5ForConditionalGeneration.forward
+            hidden = hidden * (self.model.model_dim ** -0.5)
+        return self.logits_to_loss(self.model.lm_head(hidden), encode['labels'], reduction)
 
     def get_data_loader(self,
                         inputs,
@@ -407,7 +977,14 @@ class T5:
                         drop_overflow_text: bool = False,
                         skip_overflow_error: bool = False,
                         skip_highlight_error: bool = False,
-                        parallel: bool = False):
+                        parallel: bool = False,
+                        dynamic_padding: bool = False,
+                        batch_encoding: bool = False,
+                        seed: int = None,
+                        num_replicas: int = 1,
+                        rank: int = 0,
+                        packing: bool = False,
+                        max_tokens: int = None):
         """ Transform features (produced by BERTClassifier.preprocess method) to data loader.
 
         @param inputs: List of input sentences.
@@ -418,9 +995,24 @@ class T5:
         @param num_workers:
         @param shuffle:
         @param drop_last:
-        @param cache_path:
+        @param cache_path: Root directory to cache the encoded features as memory-mapped arrays under a key hashed
+            from the input texts, the tokenizer and the preprocessing config (a path ending with `.pkl` is used as
+            a legacy pickle file as it is).
         @param drop_overflow_text: Return None if the input sentence exceeds the max token length.
         @param skip_overflow_error: Raise error if the input sentence exceeds the max token length.
+        @param dynamic_padding: Store the sequences without padding, group the examples of similar length into a
+            batch, and pad each batch to its longest sequence (labels are padded with the ignore index of the loss).
+        @param batch_encoding: Tokenize the inputs in chunks with a single call of the fast tokenizer per chunk
+            instead of one by one (`parallel` is ignored). The encoded features are identical to the default path.
+        @param seed: Seed of the shuffle combined with the epoch given by `loader.batch_sampler.set_epoch`, which also
+            skips the batches consumed before resuming the training (the global random state without the seed).
+        @param num_replicas: Number of the processes of the distributed training, where each process loads its own
+            share of the batches drawn with the seed.
+        @param rank: Rank of the process.
+        @param packing: Concatenate several examples into a row of the max length (sequence packing, T5 only), where
+            `batch_size` is the number of the rows and the features are stored without padding as `dynamic_padding`.
+        @param max_tokens: Fill each batch up to this number of the input and output tokens after padding instead of
+            `batch_size` examples (the features are stored without padding as `dynamic_padding`).
         @return: torch.utils.data.DataLoader
         """
         if outputs is not None:
@@ -433,25 +1025,55 @@ class T5:
             assert len(highlights) == len(inputs), '{} != {}'.format(len(highlights), len(inputs))
             data = [tuple(list(d) + [h]) for d, h in zip(data, highlights)]
 
+        if packing:
+            assert self.model_type in ['t5', 'mt5'], 'sequence packing is supported only by T5: {}'.format(
+                self.model_type)
+            assert outputs is not None, 'sequence packing needs the outputs'
+            dynamic_padding = True
+        if max_tokens is not None:
+            assert not packing, 'token budget batching does not support sequence packing'
+            assert outputs is not None, 'token budget batching needs the outputs'
+            dynamic_padding = True
+
         if self.no_prefix and task_prefix is not None:
             if task_prefix == 'qg':
                 task_prefix = None
             else:
                 raise ValueError('model is not trained with prefix')
 
+        config = {'tokenizer': self.tokenizer, 'max_length': self.max_length,
+                  'max_length_output': self.max_length_output, 'drop_overflow_text': drop_overflow_text,
+                  'task_prefix': task_prefix, 'skip_overflow_error': skip_overflow_error,
+                  'skip_highlight_error': skip_highlight_error}
+        if len(data) == 1 or dynamic_padding:
+            config['padding'] = False
+
+        dataset = None
+        fingerprint = None
+        if cache_path is not None and not cache_path.endswith('.pkl'):
+            # content-addressed key of the input texts, the tokenizer, and the preprocessing config
+            fingerprint = feature_fingerprint(
+                self.tokenizer,
+                data=text_fingerprint(inputs, outputs or [], highlights or []),
+                padding=config.get('padding', True),
+                **{k: v for k, v in config.items() if k not in ['tokenizer', 'padding']})
+            cache_path = '{}/{}'.format(cache_path, fingerprint)
+        if cache_path is not None:
+            # not to be evicted by a concurrent job while this process reads the memory map
+            CacheManifest().lease(cache_path)
         if cache_path is not None and os.path.exists(cache_path):
             logging.info('loading preprocessed feature from {}'.format(cache_path))
-            out = pickle_load(cache_path)
-        else:
+            if cache_path.endswith('.pkl'):  # legacy cache of the pickled list
+                dataset = Dataset(pickle_load(cache_path))
+            else:
+                dataset = load_feature(cache_path, fingerprint)
+        if dataset is None:
             # process in parallel
-            config = {'tokenizer': self.tokenizer, 'max_length': self.max_length,
-                      'max_length_output': self.max_length_output, 'drop_overflow_text': drop_overflow_text,
-                      'task_prefix': task_prefix, 'skip_overflow_error': skip_overflow_error,
-                      'skip_highlight_error': skip_highlight_error}
-            if len(data) == 1:
-                config['padding'] = False
-
-            if parallel:
+            if batch_encoding:
+                if not self.tokenizer.is_fast:
+                    logging.warning('batch encoding with a slow tokenizer: {}'.format(type(self.tokenizer)))
+                out = EncodePlus(**config).batch_encode_plus(data)
+            elif parallel:
                 pool = Pool()
                 out = pool.map(EncodePlus(**config), data)
                 pool.close()
@@ -467,16 +1089,50 @@ class T5:
             logging.info('after remove the overflow : {}'.format(len(out)))
 
             # cache the encoded data
-            if cache_path is not None:
+            if cache_path is None:
+                dataset = Dataset(out)
+            else:
                 os.makedirs(os.path.dirname(cache_path), exist_ok=True)
-                pickle_save(out, cache_path)
+                if cache_path.endswith('.pkl'):
+                    pickle_save(out, cache_path)
+                    dataset = Dataset(out)
+                else:
+                    save_feature(out, cache_path, fingerprint)
+                    dataset = MemmapDataset(cache_path)
                 logging.info('preprocessed feature is saved at {}'.format(cache_path))
+        if cache_path is not None:
+            CacheManifest().touch(cache_path)
 
-        batch_size = len(out) if batch_size is None else batch_size
+        if packing:
+            model = self.model.module if self.parallel else self.model
+            dataset = PackedDataset(dataset, self.max_length, max_length_output=self.max_length_output,
+                                    decoder_start_token_id=model.config.decoder_start_token_id)
+        batch_size = len(dataset) if batch_size is None else batch_size
+        if max_tokens is not None:
+            batch_sampler = TokenBudgetBatchSampler(
+                dataset.lengths('input_ids'), dataset.lengths('labels'), max_tokens=max_tokens, shuffle=shuffle,
+                drop_last=drop_last, seed=seed, num_replicas=num_replicas, rank=rank)
+            return torch.utils.data.DataLoader(
+                dataset, batch_sampler=batch_sampler, num_workers=num_workers,
+                collate_fn=DynamicPaddingCollator(self.tokenizer.pad_token_id, CE_IGNORE_INDEX))
+        if dynamic_padding:
+            batch_sampler = BucketBatchSampler(
+                dataset.lengths(), batch_size=batch_size, shuffle=shuffle, drop_last=drop_last, seed=seed,
+                num_replicas=num_replicas, rank=rank)
+            return torch.utils.data.DataLoader(
+                dataset, batch_sampler=batch_sampler, num_workers=num_workers,
+                collate_fn=DynamicPaddingCollator(self.tokenizer.pad_token_id, CE_IGNORE_INDEX))
+        if seed is not None or num_replicas > 1:
+            batch_sampler = RandomBatchSampler(
+                len(dataset), batch_size=batch_size, shuffle=shuffle, drop_last=drop_last, seed=seed,
+                num_replicas=num_replicas, rank=rank)
+            return torch.utils.data.DataLoader(dataset, batch_sampler=batch_sampler, num_workers=num_workers)
         return torch.utils.data.DataLoader(
-            Dataset(out), batch_size=batch_size, shuffle=shuffle, num_workers=num_workers, drop_last=drop_last)
+            dataset, batch_size=batch_size, shuffle=shuffle, num_workers=num_workers, drop_last=drop_last)
 
     def save(self, save_dir):
+        if self.quantize:
+            raise ValueError('quantized model cannot be saved, save the model before quantization')
         if self.parallel:
             self.model.module.save_pretrained(save_dir)
         else:
@@ -0,0 +1,196 @@
+""" Registry of the named models served by the app, loaded lazily and evicted under a memory budget. """
+import asyncio
+import gc
+import logging
+import os
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Dict, Callable
+
+import torch
+
+from .exceptions import ModelNotFoundError
+
+__all__ = ('ModelRegistry', 'parse_mapping')
+
+
+def parse_mapping(mapping: str or None):
+    """ Parse `key=value,key=value` (eg. the environment variable) into a dictionary. """
+    if mapping is None or len(mapping) == 0:
+        return {}
+    return dict(i.split('=', 1) for i in mapping.split(','))
+
+
+def model_size(model):
+    """ Memory size (bytes) of the model weights (the graph files for the ONNX model). """
+    if getattr(model, 'model', None) is None:
+        return sum(os.path.getsize(os.path.join(model.model_name, i)) for i in os.listdir(model.model_name)
+                   if i.endswith('.onnx'))
+    modules = [model.model] + ([model.draft_model] if getattr(model, 'draft_model', None) is not None else [])
+    # state_dict includes the packed weights of the quantized layers, which are not in the parameters
+    return sum(t.numel() * t.element_size() for m in modules for t in m.state_dict().values() if torch.is_tensor(t))
+
+
+class ModelEntry:
+    """ Loaded model and its scheduler with the number of the requests in flight. """
+
+    def __init__(self, name: str, path: str, model, scheduler):
+        self.name = name
+        self.path = path
+        self.model = model
+        self.scheduler = scheduler
+        self.size = model_size(model)
+        self.refcount = 0
+        self.retired = False
+        self.last_access = time.time()
+
+    async def close(self):
+        logging.info('unload model `{}` ({})'.format(self.name, self.path))
+        await self.scheduler.stop()
+        self.model = None
+        self.scheduler = None
+        gc.collect()
+
+    def stats(self):
+        return {'path': self.path, 'size': self.size, 'in_flight': self.refcount, 'last_access': self.last_access,
+                'queue_size': self.scheduler.queue_size, 'startup_time': self.model.startup_time,
+                'decoding_policy': self.model.decoding_policy.stats()}
+
+
+class ModelRegistry:
+    """ Registry of the named models, where each model is loaded at the first request with its own scheduler, the
+    least recently used models are unloaded when the total size exceeds the memory budget, and a model is swapped
+    to a new checkpoint without dropping the requests in flight (the old model is unloaded once they are done). """
+
+    def __init__(self,
+                 models: Dict,
+                 loader: Callable,
+                 scheduler_factory: Callable,
+                 languages: Dict = None,
+                 default: str = None,
+                 max_memory_gb: float = None):
+        """ Registry of the named models.
+
+        @param models: Dictionary of the model name and the path to the checkpoint.
+        @param loader: Function of (name, path) returning the model (eg. t5qg.T5).
+        @param scheduler_factory: Function of the model returning t5qg.batch_scheduler.BatchScheduler.
+        @param languages: Dictionary of the language and the model name to serve the language.
+        @param default: Name of the model used if neither the name nor the language of a model is given (the first
+            model if None).
+        @param max_memory_gb: Memory budget of the loaded models in GB (no eviction if None).
+        """
+        assert len(models) > 0, 'no model is registered'
+        self.models = dict(models)
+        self.loader = loader
+        self.scheduler_factory = scheduler_factory
+        self.languages = {} if languages is None else languages
+        self.default = list(self.models.keys())[0] if default is None else default
+        self.max_memory = None if max_memory_gb is None else max_memory_gb * (1 << 30)
+        assert self.default in self.models, 'default model `{}` is not registered'.format(self.default)
+        for language, name in self.languages.items():
+            assert name in self.models, 'model `{}` of language `{}` is not registered'.format(name, language)
+        self.entries = OrderedDict()  # loaded models in the order of the last access
+        self.locks = {}
+
+    def resolve(self, name: str = None, language: str = None):
+        """ Name of the model to serve the request, given by the name, the language, or the default (also for the
+        language without its model, as the language is given to skip the language detection as well). """
+        if name is not None:
+            if name not in self.models:
+                raise ModelNotFoundError(name=name)
+            return name
+        return self.languages.get(language, self.default)
+
+    def lock(self, name: str):
+        if name not in self.locks:
+            self.locks[name] = asyncio.Lock()
+        return self.locks[name]
+
+    async def load(self, name: str, path: str):
+        logging.info('load model `{}` ({})'.format(name, path))
+        start = time.time()
+        model = await asyncio.get_event_loop().run_in_executor(None, self.loader, name, path)
+        entry = ModelEntry(name, path, model, self.scheduler_factory(model).start())
+        logging.info('model `{}` is loaded in {} sec ({} bytes)'.format(name, time.time() - start, entry.size))
+        return entry
+
+    async def get(self, name: str):
+        """ Get the loaded model (loading it if necessary) and count the request in flight. """
+        async with self.lock(name):
+            entry = self.entries.get(name)
+            if entry is None:
+                entry = await self.load(name, self.models[name])
+                self.entries[name] = entry
+                await self.evict(keep=name)
+            entry.refcount += 1
+            entry.last_access = time.time()
+            self.entries.move_to_end(name)
+            return entry
+
+    async def release(self, entry: ModelEntry):
+        entry.refcount -= 1
+        if entry.retired and entry.refcount == 0:
+            await entry.close()
+
+    @asynccontextmanager
+    async def acquire(self, name: str = None, language: str = None):
+        """ Context to get the scheduler of the model for a request, which keeps the model loaded in the context.
+
+        @param name: Model name.
+        @param language: Language to choose the model if the name is not given.
+        @return: t5qg.batch_scheduler.BatchScheduler
+        """
+        entry = await self.get(self.resolve(name, language))
+        try:
+            yield entry.scheduler
+        finally:
+            await self.release(entry)
+
+    async def retire(self, entry: ModelEntry):
+        """ Unload the model now, or after the requests in flight are done. """
+        entry.retired = True
+        if entry.refcount == 0:
+            await entry.close()
+
+    async def evict(self, keep: str = None):
+        """ Unload the least recently used models until the total size is within the memory budget. """
+        if self.max_memory is None:
+            return
+        total = sum(e.size for e in self.entries.values())
+        for name, entry in list(self.entries.items()):
+            if total <= self.max_memory:
+                break
+            if name == keep or entry.refcount > 0:
+                continue
+            logging.info('evict model `{}` ({} bytes)'.format(name, entry.size))
+            self.entries.pop(name)
+            total -= entry.size
+            await self.retire(entry)
+        if total > self.max_memory:
+            logging.warning('loaded models exceed the memory budget: {} > {}'.format(total, self.max_memory))
+
+    async def swap(self, name: str, path: str):
+        """ Swap the model to a new checkpoint (or register a new model). The new model is loaded while the old one
+        keeps serving, and the requests after the swap are served by the new one.
+
+        @param name: Model name.
+        @param path: Path to the new checkpoint.
+        """
+        entry = await self.load(name, path)
+        async with self.lock(name):
+            old = self.entries.get(name)
+            self.models[name] = path
+            self.entries[name] = entry
+            self.entries.move_to_end(name)
+        if old is not None:
+            await self.retire(old)
+        await self.evict(keep=name)
+
+    async def close(self):
+        for name in list(self.entries.keys()):
+            await self.retire(self.entries.pop(name))
+
+    def stats(self):
+        return {'models': self.models, 'languages': self.languages, 'default': self.default,
+                'max_memory': self.max_memory, 'loaded': {k: v.stats() for k, v in self.entries.items()}}
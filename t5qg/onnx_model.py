@@ -0,0 +1,343 @@
+""" Export of the T5 checkpoint to ONNX graphs and the inference backend running the graphs with onnxruntime.
+
+The checkpoint is exported as three graphs:
+- `encoder`: (input_ids, attention_mask) -> encoder_hidden_states
+- `decoder_init`: first decoding step, returning the logits and the key/values of the self and cross attention
+- `decoder`: following decoding steps, taking the last token and the cached key/values, and returning the logits and
+    the updated key/values of the self attention (the cross attention key/values are fixed over the steps)
+"""
+import inspect
+import itertools
+import json
+import logging
+import os
+import time
+from typing import Dict
+
+import numpy as np
+import torch
+import transformers
+
+from .cache import config_fingerprint
+from .feature_cache import tokenizer_fingerprint
+from .instrumentation import METRICS
+from .lm_t5 import T5, load_language_model, TASK_PREFIX, ADDITIONAL_SP_TOKENS
+
+__all__ = ('export_onnx', 'OnnxT5')
+GRAPH_VERSION = 1
+GRAPHS = ['encoder', 'decoder_init', 'decoder']
+# the graphs are exported by the TorchScript exporter taking `dynamic_axes` (the dynamo exporter is the default of
+# torch>=2.9)
+EXPORT_KWARGS = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+
+
+def kv_names(prefix: str, num_layers: int, attention: tuple = ('self', 'cross')):
+    """ Names of the flattened key/values in the order of (self key, self value, cross key, cross value). """
+    return ['{}.{}.{}.{}'.format(prefix, i, a, kv) for i in range(num_layers) for a in attention
+            for kv in ['key', 'value']]
+
+
+class EncoderGraph(torch.nn.Module):
+    """ Encoder returning the last hidden states. """
+
+    def __init__(self, model):
+        super().__init__()
+        self.encoder = model.get_encoder()
+
+    def forward(self, input_ids, attention_mask):
+        return self.encoder(input_ids=input_ids, attention_mask=attention_mask, return_dict=False)[0]
+
+
+class DecoderGraph(torch.nn.Module):
+    """ Decoder and LM head with the key/values flattened into the inputs and outputs. """
+
+    def __init__(self, model, with_past: bool = False):
+        super().__init__()
+        self.decoder = model.get_decoder()
+        self.lm_head = model.lm_head
+        self.num_layers = model.config.num_decoder_layers
+        # T5 rescales the output when the embeddings are tied to the LM head
+        self.scale = model.config.d_model ** -0.5 if model.config.tie_word_embeddings else 1.0
+        self.with_past = with_past
+
+    def forward(self, decoder_input_ids, encoder_hidden_states, encoder_attention_mask, *past):
+        past_key_values = None
+        if self.with_past:
+            past_key_values = tuple(tuple(past[4 * i:4 * i + 4]) for i in range(self.num_layers))
+        output = self.decoder(input_ids=decoder_input_ids,
+                              encoder_hidden_states=encoder_hidden_states,
+                              encoder_attention_mask=encoder_attention_mask,
+                              past_key_values=past_key_values,
+                              use_cache=True,
+                              return_dict=False)
+        logits = self.lm_head(output[0] * self.scale)
+        present = output[1]
+        if hasattr(present, 'to_legacy_cache'):
+            present = present.to_legacy_cache()
+        if self.with_past:
+            present = [p[:2] for p in present]
+        return (logits,) + tuple(itertools.chain(*present))
+
+
+def export_onnx(model: str, export_dir: str, opset: int = 13, cache_dir: str = None):
+    """ Export the checkpoint (output of `T5.save`) to ONNX graphs with the tokenizer and the config, so that
+    `OnnxT5(export_dir)` loads them.
+
+    @param model: Path to the checkpoint or alias on huggingface modelhub (T5/MT5 only).
+    @param export_dir: Directory to export the graphs.
+    @param opset: ONNX opset version.
+    @param cache_dir:
+    """
+    tokenizer, lm, config = load_language_model(model, cache_dir=cache_dir)
+    if config.model_type not in ['t5', 'mt5']:
+        raise ValueError('unsupported model type for ONNX export: {}'.format(config.model_type))
+    lm.eval()
+    os.makedirs(export_dir, exist_ok=True)
+    num_layers = config.num_decoder_layers
+    dummy = '{}: {} dummy {} input'.format(TASK_PREFIX['qg'], ADDITIONAL_SP_TOKENS['hl'], ADDITIONAL_SP_TOKENS['hl'])
+    encode = tokenizer([dummy, dummy + ' text'], padding=True, return_tensors='pt')
+    input_ids, attention_mask = encode['input_ids'], encode['attention_mask']
+    decoder_input_ids = torch.full((input_ids.shape[0], 1), config.decoder_start_token_id, dtype=torch.long)
+    batch = {0: 'batch'}
+    encoder_axis = {0: 'batch', 1: 'encoder_length'}
+    past_axis = {n: {0: 'batch', 2: 'encoder_length' if '.cross.' in n else 'past_length'}
+                 for n in kv_names('past', num_layers)}
+    present_axis = {n: {0: 'batch', 2: 'encoder_length' if '.cross.' in n else 'present_length'}
+                    for n in kv_names('present', num_layers)}
+
+    with torch.no_grad():
+        logging.info('export encoder')
+        encoder = EncoderGraph(lm)
+        encoder_hidden_states = encoder(input_ids, attention_mask)
+        torch.onnx.export(
+            encoder, (input_ids, attention_mask), '{}/encoder.onnx'.format(export_dir),
+            input_names=['input_ids', 'attention_mask'], output_names=['encoder_hidden_states'],
+            dynamic_axes={'input_ids': encoder_axis, 'attention_mask': encoder_axis,
+                          'encoder_hidden_states': encoder_axis},
+            opset_version=opset, **EXPORT_KWARGS)
+
+        logging.info('export decoder (first step)')
+        decoder_inputs = (decoder_input_ids, encoder_hidden_states, attention_mask)
+        decoder_input_names = ['decoder_input_ids', 'encoder_hidden_states', 'encoder_attention_mask']
+        decoder_axis = {'decoder_input_ids': batch, 'encoder_hidden_states': encoder_axis,
+                        'encoder_attention_mask': encoder_axis, 'logits': batch}
+        decoder_init = DecoderGraph(lm)
+        present = decoder_init(*decoder_inputs)[1:]
+        torch.onnx.export(
+            decoder_init, decoder_inputs, '{}/decoder_init.onnx'.format(export_dir),
+            input_names=decoder_input_names, output_names=['logits'] + kv_names('present', num_layers),
+            dynamic_axes=dict(decoder_axis, **present_axis), opset_version=opset, **EXPORT_KWARGS)
+
+        logging.info('export decoder (with past key/values)')
+        present_self = kv_names('present', num_layers, ('self',))
+        torch.onnx.export(
+            DecoderGraph(lm, with_past=True), decoder_inputs + tuple(present), '{}/decoder.onnx'.format(export_dir),
+            input_names=decoder_input_names + kv_names('past', num_layers),
+            output_names=['logits'] + present_self,
+            dynamic_axes=dict(decoder_axis, **past_axis, **{k: present_axis[k] for k in present_self}),
+            opset_version=opset, **EXPORT_KWARGS)
+
+    # the tokenizer keeps the additional special tokens (`<hl>`)
+    tokenizer.save_pretrained(export_dir)
+    config.save_pretrained(export_dir)
+    with open('{}/graph_config.json'.format(export_dir), 'w') as f:
+        json.dump({'version': GRAPH_VERSION, 'model': model, 'opset': opset, 'num_layers': num_layers}, f)
+    logging.info('ONNX graphs are exported at {}'.format(export_dir))
+
+
+def log_softmax(x):
+    x = x - x.max(axis=-1, keepdims=True)
+    return x - np.log(np.exp(x).sum(axis=-1, keepdims=True))
+
+
+class Hypotheses:
+    """ Finished hypotheses of a single input in the beam search, as `transformers.BeamHypotheses`. """
+
+    def __init__(self, num_beams: int, length_penalty: float = 1.0, early_stopping: bool = False):
+        self.num_beams = num_beams
+        self.length_penalty = length_penalty
+        self.early_stopping = early_stopping
+        self.beams = []
+
+    def add(self, tokens, score: float, length: int):
+        """ Add the hypothesis of the score normalized by the number of the generated tokens (without the decoder
+        start token and with the end of sentence token if any). """
+        self.beams.append((score / length ** self.length_penalty, tokens))
+        self.beams = sorted(self.beams, key=lambda x: x[0], reverse=True)[:self.num_beams]
+
+    def is_done(self, best_score: float, length: int):
+        if len(self.beams) < self.num_beams:
+            return False
+        if self.early_stopping:
+            return True
+        return self.beams[-1][0] >= best_score / length ** self.length_penalty
+
+
+class OnnxT5(T5):
+    """ T5 running the exported ONNX graphs with onnxruntime on CPU, with the same interface as `T5` for inference
+    (`generate_q`, `generate_a`, `generate_qa`, and `generate_prediction`). """
+
+    def __init__(self, model: str, max_length: int = 512, max_length_output: int = 32, num_threads: int = None,
+                 providers: list = None, language: str = None):
+        """ T5 running the exported ONNX graphs.
+
+        @param model: Directory of the graphs exported by `export_onnx`.
+        @param max_length: Max sequence length for the input.
+        @param max_length_output: Max sequence length for the output.
+        @param num_threads: Number of the intra-op threads of onnxruntime.
+        @param providers: Execution providers of onnxruntime (`CPUExecutionProvider` if None).
+        @param language: Language of the documents for the sentence splitter (detected for each document if None).
+        """
+        try:
+            import onnxruntime
+        except ImportError:
+            raise ImportError('onnxruntime is required for OnnxT5: `pip install onnxruntime`')
+        self.init_state(model, max_length, max_length_output, language)
+        logging.info('instantiate ONNX T5 model class with `{}`'.format(self.model_name))
+        start = time.time()
+        with open('{}/graph_config.json'.format(self.model_name)) as f:
+            self.graph_config = json.load(f)
+        if self.graph_config['version'] != GRAPH_VERSION:
+            raise ValueError('graphs are exported with version {}, re-export them with version {}'.format(
+                self.graph_config['version'], GRAPH_VERSION))
+        self.tokenizer = transformers.AutoTokenizer.from_pretrained(self.model_name)
+        self.config = transformers.AutoConfig.from_pretrained(self.model_name)
+        options = onnxruntime.SessionOptions()
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        providers = ['CPUExecutionProvider'] if providers is None else providers
+        self.session = {k: onnxruntime.InferenceSession('{}/{}.onnx'.format(self.model_name, k), options,
+                                                        providers=providers) for k in GRAPHS}
+        self.startup_time['load_graph'] = time.time() - start
+        logging.info('startup time (sec): {}'.format(self.startup_time))
+        num_layers = self.graph_config['num_layers']
+        self.past_names = kv_names('past', num_layers)
+        self.past_self_names = kv_names('past', num_layers, ('self',))
+        self.past_cross_names = kv_names('past', num_layers, ('cross',))
+        self.model = None
+
+    @property
+    def fingerprint(self):
+        """ Hash of the model config, the tokenizer, and the graph files. """
+        if self._fingerprint is None:
+            files = sorted([(i, os.path.getmtime(os.path.join(self.model_name, i)))
+                            for i in os.listdir(self.model_name)])
+            self._fingerprint = config_fingerprint(
+                model=self.model_name, config=self.config.to_json_string(), files=files,
+                tokenizer=tokenizer_fingerprint(self.tokenizer), backend='onnx')
+        return self._fingerprint
+
+    def train(self):
+        raise ValueError('ONNX model cannot be trained')
+
+    def eval(self):
+        pass
+
+    def save(self, save_dir):
+        raise ValueError('ONNX model cannot be saved, export the checkpoint with `export_onnx` instead')
+
+    def run(self, graph: str, **inputs):
+        return self.session[graph].run(None, inputs)
+
+    def generate_batch(self, encode: Dict, decoding: Dict):
+        if decoding['num_candidates'] is not None and decoding['num_candidates'] > 1:
+            logging.warning('candidate reranking is not supported by OnnxT5, fallback to greedy decoding')
+        num_beams, max_length = decoding['num_beams'], decoding['max_length_output']
+        input_ids = encode['input_ids'].numpy().astype(np.int64)
+        attention_mask = encode['attention_mask'].numpy().astype(np.int64)
+        start = time.perf_counter()
+        encoder_hidden_states = self.run('encoder', input_ids=input_ids, attention_mask=attention_mask)[0]
+        self.encoder_time.value = time.perf_counter() - start
+        if num_beams > 1:
+            encoder_hidden_states = np.repeat(encoder_hidden_states, num_beams, axis=0)
+            attention_mask = np.repeat(attention_mask, num_beams, axis=0)
+            tokens = self.beam_search(encoder_hidden_states, attention_mask, num_beams, max_length,
+                                      early_stopping=decoding['early_stopping'])
+        else:
+            tokens = self.greedy_search(encoder_hidden_states, attention_mask, max_length)
+        self.record_generation(tokens, len(input_ids), time.perf_counter() - start)
+        with METRICS.stage('detokenize'):
+            return self.tokenizer.batch_decode(tokens, skip_special_tokens=True)
+
+    def decode_step(self, tokens, encoder_hidden_states, attention_mask, past: Dict = None):
+        """ Run a decoding step and return the log probabilities of the next token and the key/values. """
+        inputs = {'encoder_hidden_states': encoder_hidden_states, 'encoder_attention_mask': attention_mask}
+        if past is None:
+            out = self.run('decoder_init', decoder_input_ids=tokens, **inputs)
+            past = dict(zip(self.past_names, out[1:]))
+        else:
+            out = self.run('decoder', decoder_input_ids=tokens[:, -1:], **inputs, **past)
+            past = dict(past, **dict(zip(self.past_self_names, out[1:])))
+        return log_softmax(out[0][:, -1, :]), past
+
+    def greedy_search(self, encoder_hidden_states, attention_mask, max_length: int):
+        eos, pad = self.config.eos_token_id, self.config.pad_token_id
+        tokens = np.full((encoder_hidden_states.shape[0], 1), self.config.decoder_start_token_id, dtype=np.int64)
+        finished = np.zeros(tokens.shape[0], dtype=bool)
+        past = None
+        for _ in range(max_length - 1):
+            log_probs, past = self.decode_step(tokens, encoder_hidden_states, attention_mask, past)
+            next_tokens = np.where(finished, pad, log_probs.argmax(-1))
+            tokens = np.concatenate([tokens, next_tokens[:, None]], axis=1)
+            finished |= next_tokens == eos
+            if finished.all():
+                break
+        return tokens
+
+    def beam_search(self, encoder_hidden_states, attention_mask, num_beams: int, max_length: int,
+                    early_stopping: bool = False):
+        """ Beam search over the cached key/values as `transformers` with the length penalty 1.0. """
+        eos, pad = self.config.eos_token_id, self.config.pad_token_id
+        batch_size = encoder_hidden_states.shape[0] // num_beams
+        tokens = np.full((batch_size * num_beams, 1), self.config.decoder_start_token_id, dtype=np.int64)
+        # only the first beam is alive at the first step, so that the beams do not start from the same token
+        beam_scores = np.zeros((batch_size, num_beams), dtype=np.float32)
+        beam_scores[:, 1:] = -1e9
+        beam_scores = beam_scores.reshape(-1)
+        hypotheses = [Hypotheses(num_beams, early_stopping=early_stopping) for _ in range(batch_size)]
+        done = [False] * batch_size
+        past = None
+        for _ in range(max_length - 1):
+            log_probs, past = self.decode_step(tokens, encoder_hidden_states, attention_mask, past)
+            vocab_size = log_probs.shape[-1]
+            scores = (log_probs + beam_scores[:, None]).reshape(batch_size, num_beams * vocab_size)
+            # 2 * num_beams candidates, so that num_beams of them are left after removing the finished ones
+            top = np.argpartition(-scores, 2 * num_beams, axis=1)[:, :2 * num_beams]
+            next_scores, next_tokens, next_index = [], [], []
+            for b in range(batch_size):
+                if done[b]:
+                    next_scores += [0.0] * num_beams
+                    next_tokens += [pad] * num_beams
+                    next_index += [b * num_beams] * num_beams
+                    continue
+                candidates = sorted(top[b], key=lambda x: -scores[b, x])
+                beams = []
+                for rank, c in enumerate(candidates):
+                    index, token = b * num_beams + c // vocab_size, c % vocab_size
+                    if token == eos:
+                        if rank < num_beams:
+                            hypotheses[b].add(np.append(tokens[index], eos), scores[b, c], tokens.shape[1])
+                    else:
+                        beams.append((scores[b, c], token, index))
+                    if len(beams) == num_beams:
+                        break
+                next_scores += [i[0] for i in beams]
+                next_tokens += [i[1] for i in beams]
+                next_index += [i[2] for i in beams]
+                # the best score of the candidates including the finished ones
+                done[b] = hypotheses[b].is_done(scores[b, candidates[0]], tokens.shape[1])
+            beam_scores = np.array(next_scores, dtype=np.float32)
+            next_index = np.array(next_index)
+            tokens = np.concatenate([tokens[next_index], np.array(next_tokens, dtype=np.int64)[:, None]], axis=1)
+            # the beams are reordered within each input, so the cross attention key/values are unchanged
+            past = {k: v[next_index] if k in self.past_self_names else v for k, v in past.items()}
+            if all(done):
+                break
+        output = []
+        for b in range(batch_size):
+            if not done[b]:
+                for n in range(num_beams):
+                    hypotheses[b].add(tokens[b * num_beams + n], beam_scores[b * num_beams + n], tokens.shape[1] - 1)
+            output.append(hypotheses[b].beams[0][1])
+        max_length = max(len(o) for o in output)
+        return [np.concatenate([o, np.full(max_length - len(o), pad)]) for o in output]
@@ -0,0 +1,126 @@
+""" LRU cache of the generated sentences with TTL, size bounds, and an optional on-disk tier. """
+import hashlib
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from .instrumentation import METRICS
+
+__all__ = ('ResultCache',)
+
+
+def normalize(text: str or None):
+    if text is None:
+        return None
+    return re.sub(r'\s+', ' ', text).strip()
+
+
+class ResultCache:
+    """ Memoization of the model prediction keyed on the normalized input and the decoding config. """
+
+    def __init__(self,
+                 max_entries: int = 10000,
+                 max_bytes: int = None,
+                 ttl: float = None,
+                 path: str = None):
+        """ Memoization of the model prediction.
+
+        @param max_entries: Max number of the entries in memory.
+        @param max_bytes: Max total size (bytes of the key and the value) of the entries in memory.
+        @param ttl: Time to live of each entry in seconds (never expire if None).
+        @param path: Path to a sqlite file to keep the entries across restarts (memory only if None).
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.path = path
+        self.memory = OrderedDict()
+        self.bytes = 0
+        self.hit = 0
+        self.miss = 0
+        self.lock = threading.Lock()
+        self.db = None
+        if self.path is not None:
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+            self.db.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT, created REAL)')
+            self.db.commit()
+
+    @staticmethod
+    def key(input_text: str, highlight: str = None, **kwargs):
+        """ Key of the normalized input and the other config (num_beams, task_type, model fingerprint, etc). """
+        config = {'input_text': normalize(input_text), 'highlight': normalize(highlight)}
+        config.update(kwargs)
+        return hashlib.sha256(json.dumps(config, sort_keys=True).encode()).hexdigest()
+
+    def expired(self, created: float):
+        return self.ttl is not None and time.time() - created > self.ttl
+
+    def get(self, key: str):
+        """ Get the cached value (None if not found or expired). """
+        with self.lock:
+            if key in self.memory:
+                value, created = self.memory[key]
+                if not self.expired(created):
+                    self.memory.move_to_end(key)
+                    self.hit += 1
+                    METRICS.inc('t5qg_result_cache_total', result='hit')
+                    return value
+                self.pop(key)
+            if self.db is not None:
+                row = self.db.execute('SELECT value, created FROM cache WHERE key = ?', (key,)).fetchone()
+                if row is not None and not self.expired(row[1]):
+                    value = json.loads(row[0])
+                    self.put(key, value, row[1])
+                    self.hit += 1
+                    METRICS.inc('t5qg_result_cache_total', result='hit')
+                    return value
+            self.miss += 1
+            METRICS.inc('t5qg_result_cache_total', result='miss')
+            return None
+
+    def set(self, key: str, value):
+        created = time.time()
+        with self.lock:
+            self.put(key, value, created)
+            if self.db is not None:
+                try:
+                    self.db.execute('INSERT OR REPLACE INTO cache VALUES (?, ?, ?)', (key, json.dumps(value), created))
+                    if self.ttl is not None:
+                        self.db.execute('DELETE FROM cache WHERE created < ?', (created - self.ttl,))
+                    self.db.commit()
+                except sqlite3.Error:
+                    logging.exception('failed to write the result cache to {}'.format(self.path))
+
+    def put(self, key: str, value, created: float):
+        if key in self.memory:
+            self.pop(key)
+        self.memory[key] = (value, created)
+        self.bytes += self.size(key, value)
+        while len(self.memory) > 0 and (len(self.memory) > self.max_entries or
+                                        (self.max_bytes is not None and self.bytes > self.max_bytes)):
+            self.pop(next(iter(self.memory)))
+
+    def pop(self, key: str):
+        value, _ = self.memory.pop(key)
+        self.bytes -= self.size(key, value)
+
+    @staticmethod
+    def size(key: str, value):
+        return len(key) + len(json.dumps(value))
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+            self.bytes = 0
+            if self.db is not None:
+                self.db.execute('DELETE FROM cache')
+                self.db.commit()
+
+    def stats(self):
+        total = self.hit + self.miss
+        return {'hit': self.hit, 'miss': self.miss, 'hit_rate': self.hit / total if total > 0 else None,
+                'entries': len(self.memory), 'bytes': self.bytes, 'ttl': self.ttl, 'path': self.path}
@@ -2,7 +2,10 @@
 TODO: Cover all the language in TYDIQA dataset.
 """
 
+import hashlib
 import re
+import threading
+from collections import OrderedDict
 from typing import List
 from langdetect import detect
 import nltk
@@ -10,6 +13,7 @@ from nltk.tokenize import sent_tokenize
 
 
 __all__ = 'SentSplit'
+SPLITTER = {}  # splitter instance of each language, built once per process
 
 
 class JASplitter:
@@ -50,7 +54,10 @@ class JASplitter:
 class Splitter:
 
     def __init__(self):
-        nltk.download('punkt')
+        try:
+            nltk.data.find('tokenizers/punkt')
+        except LookupError:
+            nltk.download('punkt')
 
     def __call__(self, document):
         out = sent_tokenize(document)
@@ -66,29 +73,70 @@ class BengaliSplitter:
         return [re.sub(r'\s*\Z', ' ', i) for i in document.split(self.splitter)]
 
 
-def setup_splitter(language):
+def splitter_type(language):
     if language in ['ja', 'jp']:
-        return JASplitter()
+        return 'ja'
     elif language in ['bengali', 'be', 'bn']:
-        return BengaliSplitter()
-    else:
-        return Splitter()
+        return 'bn'
+    return 'default'
+
+
+def setup_splitter(language):
+    """ Get the splitter from the registry, which is instantiated at the first call for each language. """
+    key = splitter_type(language)
+    if key not in SPLITTER:
+        if key == 'ja':
+            SPLITTER[key] = JASplitter()
+        elif key == 'bn':
+            SPLITTER[key] = BengaliSplitter()
+        else:
+            SPLITTER[key] = Splitter()
+    return SPLITTER[key]
 
 
 class SentSplit:
 
-    def __init__(self, language: str = 'en'):
+    def __init__(self, language: str = 'en', cache_size: int = 10000):
+        """ Multilingual sentence splitter.
+
+        @param language: Default language.
+        @param cache_size: Max number of the language detection results cached by the document hash.
+        """
         self.language = language
         self.splitter = setup_splitter(self.language)
-
-    def __call__(self, docs: str):
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def detect(self, docs: str):
+        """ Detect the language with LRU cache keyed by the hash of the document. """
+        key = hashlib.md5(docs.encode()).digest()
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
         la = detect(docs)
-        if self.language != la:
-            self.splitter = setup_splitter(la)
-            self.language = la
-        return self.splitter(docs)
-
-
-
-
-
+        with self.lock:
+            self.cache[key] = la
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return la
+
+    def __call__(self, docs: str, language: str = None):
+        """ Split the document into sentences.
+
+        @param docs: Input document.
+        @param language: Language of the document (detected if None).
+        @return: List of sentences.
+        """
+        la = self.detect(docs) if language is None else language
+        return setup_splitter(la)(docs)
+
+    def split_many(self, docs: List, language: str = None):
+        """ Split the list of documents into sentences.
+
+        @param docs: List of the input documents.
+        @param language: Language of the documents (detected for each document if None).
+        @return: List of the sentences of each document.
+        """
+        return [self(d, language=language) for d in docs]
@@ -4,14 +4,18 @@ import json
 import logging
 import shutil
 import random
+from contextlib import nullcontext
 from glob import glob
 from typing import List
 
 import torch
 from transformers import get_linear_schedule_with_warmup
 
-from .lm_t5 import T5
+from .lm_t5 import T5, CE_IGNORE_INDEX
 from .data import get_dataset, DEFAULT_CACHE_DIR
+from .checkpoint import StepCheckpointer, get_rng_state, set_rng_state
+from .distributed import init_distributed, is_main_process, main_process_first, barrier, all_reduce_mean, \
+    all_gather_object, get_world_size
 
 
 class Config:
@@ -22,6 +26,8 @@ class Config:
         if os.path.exists(self.checkpoint_dir):
             logging.info('load config from existing checkpoint at {}'.format(self.checkpoint_dir))
             self.config = self.safe_open('{}/trainer_config.json'.format(self.checkpoint_dir))
+            # configs added after the checkpoint was created fall back to the given value
+            self.config.update({k: v for k, v in kwargs.items() if k not in self.config})
         else:
             logging.info('initialize checkpoint at {}'.format(self.checkpoint_dir))
             self.config = kwargs
@@ -69,30 +75,49 @@ class Trainer:
                  random_seed: int = 42,
                  gradient_accumulation_steps: int = 4,
                  label_smoothing: float = None,
-                 disable_log: bool = False):
+                 dynamic_padding: bool = False,
+                 packing: bool = False,
+                 max_tokens: int = None,
+                 disable_log: bool = False,
+                 distributed: bool = False):
 
         logging.info('initialize model trainer')
+        # DistributedDataParallel in the process group initialized from the environment variables (see
+        # t5qg.distributed.launch), where `batch` is the batch size of each process and only the rank 0 process saves
+        # the checkpoints and writes the logs
+        self.distributed = distributed
+        self.rank = 0
+        if self.distributed:
+            self.rank, world_size = init_distributed()
+            logging.info('distributed training: rank {}/{}'.format(self.rank, world_size))
+        self.is_main = is_main_process()
         # config
-        self.config = Config(
-            checkpoint_dir=checkpoint_dir,
-            dataset=dataset,
-            language=language,
-            task_type=task_type,
-            model=model,
-            max_length=max_length,
-            max_length_output=max_length_output,
-            epoch=epoch,
-            lr_warmup=lr_warmup,
-            batch=batch,
-            lr=lr,
-            fp16=fp16,
-            random_seed=random_seed,
-            gradient_accumulation_steps=gradient_accumulation_steps,
-            label_smoothing=label_smoothing)
+        with main_process_first():
+            self.config = Config(
+                checkpoint_dir=checkpoint_dir,
+                dataset=dataset,
+                language=language,
+                task_type=task_type,
+                model=model,
+                max_length=max_length,
+                max_length_output=max_length_output,
+                epoch=epoch,
+                lr_warmup=lr_warmup,
+                batch=batch,
+                lr=lr,
+                fp16=fp16,
+                random_seed=random_seed,
+                gradient_accumulation_steps=gradient_accumulation_steps,
+                label_smoothing=label_smoothing,
+                dynamic_padding=dynamic_padding,
+                packing=packing,
+                max_tokens=max_tokens)
+        assert not (self.config.packing and self.distributed), 'sequence packing does not support distributed training'
 
-        random.seed(self.config.random_seed)
-        torch.manual_seed(self.config.random_seed)
-        if not disable_log:
+        # the processes share the shuffle of the data by the seed of the sampler, but not the dropout
+        random.seed(self.config.random_seed + self.rank)
+        torch.manual_seed(self.config.random_seed + self.rank)
+        if not disable_log and self.is_main:
             # add file handler
             logger = logging.getLogger()
             file_handler = logging.FileHandler('{}/training.log'.format(self.config.checkpoint_dir))
@@ -102,14 +127,41 @@ class Trainer:
 
         # load model
         ckpts = glob('{}/epoch_*'.format(self.config.checkpoint_dir))
-        if len(ckpts):
-            epoch = sorted([int(i.split('epoch_')[-1]) for i in ckpts], reverse=True)[0]
+        epoch = sorted([int(i.split('epoch_')[-1]) for i in ckpts], reverse=True)[0] if len(ckpts) else 0
+        # step checkpoint within the epoch after the last epoch checkpoint
+        self.step_checkpointer = StepCheckpointer(self.config.checkpoint_dir)
+        self.step_state = self.step_checkpointer.load()
+        if self.step_state is not None and self.step_state['epoch'] < epoch:
+            self.step_state = None
+        self.current_batch = 0
+        self.global_step = 0
+        if self.step_state is not None:
+            path = '{}/epoch_{}'.format(self.config.checkpoint_dir, epoch) if epoch > 0 else self.config.model
+            logging.info('resume from step {} (epoch {}, batch {})'.format(
+                self.step_state['global_step'], self.step_state['epoch'], self.step_state['batch']))
+            self.model = T5(model=path,
+                            max_length=self.config.max_length,
+                            max_length_output=self.config.max_length_output,
+                            label_smoothing=self.config.label_smoothing,
+                            distributed=self.distributed)
+            (self.model.model.module if self.model.parallel else self.model.model).load_state_dict(
+                self.step_state['model'])
+            self.optimizer, self.scheduler = self.setup_optimizer()
+            self.optimizer.load_state_dict(self.step_state['optimizer'])
+            if self.scheduler is not None:
+                self.scheduler.load_state_dict(self.step_state['scheduler'])
+            self.current_epoch = self.step_state['epoch']
+            self.current_batch = self.step_state['batch']
+            self.global_step = self.step_state['global_step']
+            assert self.current_epoch <= self.config.epoch, 'model training is done'
+        elif len(ckpts):
             path = '{}/epoch_{}'.format(self.config.checkpoint_dir, epoch)
             logging.info('load checkpoint from {}'.format(path))
             self.model = T5(model=path,
                             max_length=self.config.max_length,
                             max_length_output=self.config.max_length_output,
-                            label_smoothing=self.config.label_smoothing)
+                            label_smoothing=self.config.label_smoothing,
+                            distributed=self.distributed)
             self.optimizer, self.scheduler = self.setup_optimizer(epoch)
             self.current_epoch = epoch
             assert self.current_epoch <= self.config.epoch, 'model training is done'
@@ -117,16 +169,21 @@ class Trainer:
             logging.info('initialize checkpoint with {}'.format(self.config.model))
             self.model = T5(model=self.config.model,
                             max_length=self.config.max_length,
-                            max_length_output=self.config.max_length_output)
+                            max_length_output=self.config.max_length_output,
+                            distributed=self.distributed)
 
             self.optimizer, self.scheduler = self.setup_optimizer()
             self.current_epoch = 0
 
         # GPU mixture precision
         self.scaler = torch.cuda.amp.GradScaler(enabled=self.config.fp16)
+        if self.step_state is not None:
+            self.scaler.load_state_dict(self.step_state['scaler'])
+            # the states are restored, and the position and the RNG of the step are kept to resume the loop
+            self.step_state = {k: self.step_state[k] for k in ['epoch', 'batch', 'global_step', 'rng', 'loss']}
 
-        # cached data folder
-        self.data_cache_dir = '{}/data_{}_encoded/{}.{}.{}.{}.pkl'.format(
+        # cached data folder (encoded features are stored under a content-addressed key within)
+        self.data_cache_dir = '{}/data_{}_encoded/{}.{}.{}.{}'.format(
             DEFAULT_CACHE_DIR,
             self.config.dataset,
             self.config.model,
@@ -135,8 +192,10 @@ class Trainer:
             '_'.join(sorted(self.config.task_type))
         )
         if self.config.dataset == 'tydiqa':
-            self.data_cache_dir = self.data_cache_dir.replace('.pkl', '') \
-                                  + '.' + '_'.join(sorted(self.config.language)) + '.pkl'
+            self.data_cache_dir += '.' + '_'.join(sorted(self.config.language))
+        # packing and token budget batching are made of the features without padding
+        if self.config.dynamic_padding or self.config.packing or self.config.max_tokens is not None:
+            self.data_cache_dir += '.dynamic_padding'
 
         os.makedirs(os.path.dirname(self.data_cache_dir), exist_ok=True)
 
@@ -172,71 +231,133 @@ class Trainer:
         else:
             torch.save({'optimizer_state_dict': self.optimizer.state_dict(),
                         'scheduler_state_dict': self.scheduler.state_dict()}, save_dir_opt)
+        # the epoch checkpoint supersedes the step checkpoints
+        self.step_checkpointer.clear()
+
+    def save_step(self, epoch: int, batch: int, global_step: int, loss: List):
+        """ Save the training state at the optimizer step in the background, to resume at the exact step. """
+        # RNG state of every process (called by all the processes at the same step)
+        rng = all_gather_object(get_rng_state()) if self.distributed else get_rng_state()
+        if not self.is_main:
+            return
+        model = self.model.model.module if self.model.parallel else self.model.model
+        self.step_checkpointer.save(global_step, {
+            'model': model.state_dict(),
+            'optimizer': self.optimizer.state_dict(),
+            'scheduler': None if self.scheduler is None else self.scheduler.state_dict(),
+            'scaler': self.scaler.state_dict(),
+            'rng': rng,
+            'epoch': epoch,
+            'batch': batch,
+            'global_step': global_step,
+            'loss': loss
+        })
 
     def train(self,
               num_workers: int = 0,
               epoch_save: None or int = 1,
               interval: int = 50,
               activate_tensorboard: bool = False,
-              epoch_partial: int = None):
+              epoch_partial: int = None,
+              step_save: int = None,
+              keep_last: int = 2):
         """ Train model.
 
         @param num_workers: Workers for DataLoader.
         @param epoch_save: Save the model every this epoch.
         @param interval:
         @param activate_tensorboard:
+        @param step_save: Save the training state every this optimizer step to resume within the epoch.
+        @param keep_last: Number of the step checkpoints to keep.
         """
+        self.step_checkpointer.keep_last = keep_last
 
         logging.info('dataset preprocessing')
-        raw_input, raw_output = get_dataset(
-            self.config.dataset,
-            split='train',
-            language=self.config.language,
-            task_type=self.config.task_type,
-            no_prefix=self.model.no_prefix)
-        loader = self.model.get_data_loader(
-            raw_input,
-            raw_output,
-            batch_size=self.config.batch,
-            shuffle=True,
-            drop_last=True,
-            num_workers=num_workers,
-            cache_path=self.data_cache_dir,
-            drop_overflow_text=True,
-            parallel=True)
+        # the dataset and the feature cache are built by the rank 0 process and loaded by the others
+        with main_process_first():
+            raw_input, raw_output = get_dataset(
+                self.config.dataset,
+                split='train',
+                language=self.config.language,
+                task_type=self.config.task_type,
+                no_prefix=self.model.no_prefix)
+            loader = self.model.get_data_loader(
+                raw_input,
+                raw_output,
+                batch_size=self.config.batch,
+                shuffle=True,
+                drop_last=True,
+                num_workers=num_workers,
+                cache_path=self.data_cache_dir,
+                drop_overflow_text=True,
+                batch_encoding=True,
+                dynamic_padding=self.config.dynamic_padding,
+                seed=self.config.random_seed,
+                num_replicas=get_world_size(),
+                rank=self.rank,
+                packing=self.config.packing,
+                max_tokens=self.config.max_tokens)
         self.model.train()
 
         logging.info('start model training')
-        global_step = 0
+        global_step = self.global_step
+        if self.step_state is not None:
+            rng = self.step_state['rng']
+            set_rng_state(rng[self.rank % len(rng)] if isinstance(rng, list) else rng)
         writer = None
-        if activate_tensorboard:
+        if activate_tensorboard and self.is_main:
             from torch.utils.tensorboard import SummaryWriter
             writer = SummaryWriter(log_dir=self.config.checkpoint_dir)
 
         with torch.cuda.amp.autocast(enabled=self.config.fp16):
             for e in range(self.current_epoch, self.config.epoch):  # loop over the epoch
-                mean_loss, global_step = self.train_single_epoch(loader, global_step, writer, interval)
-                logging.info('[epoch {}/{}] average loss: {}, lr: {}'.format(
-                    e, self.config.epoch, round(mean_loss, 3), self.optimizer.param_groups[0]['lr']))
-                if epoch_save is not None and (e + 1) % epoch_save == 0 and (e + 1) != 0:
+                # the shuffle of each epoch is seeded by the epoch, so the consumed batches can be skipped at resume
+                skip, loss = 0, []
+                if self.step_state is not None and e == self.step_state['epoch']:
+                    skip, loss = self.step_state['batch'], self.step_state['loss']
+                loader.batch_sampler.set_epoch(e, skip)
+                mean_loss, global_step = self.train_single_epoch(
+                    loader, global_step, writer, interval, epoch=e, skip=skip, total_loss=loss, step_save=step_save)
+                mean_loss = all_reduce_mean(mean_loss)
+                if self.is_main:
+                    logging.info('[epoch {}/{}] average loss: {}, lr: {}'.format(
+                        e, self.config.epoch, round(mean_loss, 3), self.optimizer.param_groups[0]['lr']))
+                if epoch_save is not None and (e + 1) % epoch_save == 0 and (e + 1) != 0 and self.is_main:
                     self.save(e)
                 if epoch_partial is not None and (e + 1) == epoch_partial:
                     break
 
         if writer is not None:
             writer.close()
-        self.save(e)
-        logging.info('complete training: model ckpt was saved at {}'.format(self.config.checkpoint_dir))
+        self.step_checkpointer.wait()
+        if self.is_main:
+            self.save(e)
+            logging.info('complete training: model ckpt was saved at {}'.format(self.config.checkpoint_dir))
+        barrier()
 
-    def train_single_epoch(self, data_loader, global_step: int, writer, interval):
-        total_loss = []
+    def train_single_epoch(self, data_loader, global_step: int, writer, interval, epoch: int = 0, skip: int = 0,
+                           total_loss: List = None, step_save: int = None):
+        total_loss = [] if total_loss is None else list(total_loss)
+        real_tokens, total_tokens = 0, 0
+        # with the token budget, the loss is summed over the tokens and the gradients are normalized by the number of
+        # the tokens of the step, so that each token has the same weight regardless of the batch size
+        per_token = self.config.max_tokens is not None
+        step_tokens = 0
         self.optimizer.zero_grad()
-        for n, encode in enumerate(data_loader):
-
-            loss = self.model.encode_to_loss(encode)
-            self.scaler.scale(loss).backward()
-            total_loss.append(loss.cpu().item())
-            if (n + 1) % self.config.gradient_accumulation_steps != 0:
+        for n, encode in enumerate(data_loader, start=skip):
+            if 'segment_ids' in encode:
+                for k in ['segment_ids', 'decoder_segment_ids']:
+                    real_tokens += encode[k].gt(0).sum().item()
+                    total_tokens += encode[k].numel()
+            num_tokens = encode['labels'].ne(CE_IGNORE_INDEX).sum().item()
+            step_tokens += num_tokens
+            sync = (n + 1) % self.config.gradient_accumulation_steps == 0
+            # all-reduce the gradients only at the last micro-batch of the accumulation
+            with nullcontext() if sync or not self.distributed else self.model.model.no_sync():
+                loss = self.model.encode_to_loss(encode, reduction='sum' if per_token else 'mean')
+                self.scaler.scale(loss).backward()
+            total_loss.append(loss.cpu().item() / max(num_tokens, 1) if per_token else loss.cpu().item())
+            if not sync:
                 continue
 
             global_step += 1
@@ -246,14 +367,30 @@ class Trainer:
                 writer.add_scalar('train/loss', inst_loss, global_step)
                 writer.add_scalar('train/learning_rate', self.optimizer.param_groups[0]['lr'], global_step)
             # optimizer update
+            if per_token:
+                # DistributedDataParallel averages the gradients over the processes, so divide by the mean tokens
+                self.scaler.unscale_(self.optimizer)
+                step_tokens = max(all_reduce_mean(step_tokens), 1)
+                for group in self.optimizer.param_groups:
+                    for p in group['params']:
+                        if p.grad is not None:
+                            p.grad.div_(step_tokens)
+            step_tokens = 0
             self.scaler.step(self.optimizer)
             self.scaler.update()
             if self.scheduler is not None:
                 self.scheduler.step()
             self.optimizer.zero_grad()
-            if global_step % interval == 0:
+            if global_step % interval == 0 and self.is_main:
                 logging.debug('\t * (global step {}: loss: {}, lr: {}'.format(
                     global_step, inst_loss, self.optimizer.param_groups[0]['lr']))
+            if step_save is not None and global_step % step_save == 0:
+                self.save_step(epoch, n + 1, global_step, total_loss)
 
         self.optimizer.zero_grad()
+        if total_tokens > 0:
+            logging.info('packing efficiency (real tokens / total tokens): {}'.format(
+                round(real_tokens / total_tokens, 3)))
+        if len(total_loss) == 0:
+            return float('nan'), global_step
         return sum(total_loss)/len(total_loss), global_step
@@ -16,6 +16,9 @@ def get_options():
     parser.add_argument('--max-length', default=512, type=int, help='max sequence length for input sequence')
     parser.add_argument('--max-length-output', default=32, type=int, help='max sequence length for output sequence')
     parser.add_argument('--random-seed', help='random seed', default=1234, type=int)
+    parser.add_argument('--dynamic-padding', help='pad each batch to its longest sequence', action='store_true')
+    parser.add_argument('--quantize', help='dynamic int8 quantization', action='store_true')
+    parser.add_argument('--n-sample', help='evaluate on the first n examples', default=None, type=int)
     # monitoring parameter
     parser.add_argument('--debug', help='log mode', action='store_true')
     return parser.parse_args()
@@ -34,7 +37,10 @@ def main():
         max_length=opt.max_length,
         max_length_output=opt.max_length_output,
         num_beams=opt.num_beams,
-        random_seed=opt.random_seed
+        random_seed=opt.random_seed,
+        dynamic_padding=opt.dynamic_padding,
+        quantize=opt.quantize,
+        n_sample=opt.n_sample
     )
 
 
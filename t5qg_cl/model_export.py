@@ -0,0 +1,25 @@
+""" Export a model checkpoint to ONNX graphs for `t5qg.OnnxT5`. """
+import argparse
+import logging
+from t5qg import export_onnx
+
+
+def get_options():
+    parser = argparse.ArgumentParser(description='export T5 to ONNX.')
+    parser.add_argument('-m', '--model', help='pretrained language model', required=True, type=str)
+    parser.add_argument('-e', '--export-dir', help='export dir', required=True, type=str)
+    parser.add_argument('--opset', help='ONNX opset version', default=13, type=int)
+    # monitoring parameter
+    parser.add_argument('--debug', help='log mode', action='store_true')
+    return parser.parse_args()
+
+
+def main():
+    opt = get_options()
+    level = logging.DEBUG if opt.debug else logging.INFO
+    logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s', level=level, datefmt='%Y-%m-%d %H:%M:%S')
+    export_onnx(model=opt.model, export_dir=opt.export_dir, opset=opt.opset)
+
+
+if __name__ == '__main__':
+    main()
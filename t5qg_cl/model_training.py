@@ -1,8 +1,10 @@
 """ Fine-tune T5. """
 import argparse
 import logging
+import os
 
 from t5qg import Trainer
+from t5qg.distributed import launch, cleanup
 
 
 def get_options():
@@ -23,18 +25,30 @@ def get_options():
     parser.add_argument('--max-length', default=512, type=int, help='max sequence length for input sequence')
     parser.add_argument('--max-length-output', default=32, type=int, help='max sequence length for output sequence')
     parser.add_argument('--label-smoothing', help='label smoothing', default=0.0, type=float)
+    parser.add_argument('--dynamic-padding', help='pad each batch to its longest sequence', action='store_true')
+    parser.add_argument('--packing', help='pack several examples into a row (T5 only, batch is the number of rows)',
+                        action='store_true')
+    parser.add_argument('--max-tokens', help='fill each batch up to this number of input and output tokens instead of '
+                                             'the batch size', default=None, type=int)
     # monitoring parameter
     parser.add_argument('--debug', help='log mode', action='store_true')
     parser.add_argument('--activate-tensorboard', help='log mode', action='store_true')
     parser.add_argument('--num-workers', default=0, type=int)
     parser.add_argument('--epoch-save', default=1, type=int)
     parser.add_argument('--interval', default=50, type=int)
+    parser.add_argument('--step-save', help='save training state every this step to resume', default=None, type=int)
+    parser.add_argument('--keep-last', help='number of step checkpoints to keep', default=2, type=int)
+    # distributed training
+    parser.add_argument('--nproc', help='number of local processes of distributed training (eg. with gloo on CPU)',
+                        default=1, type=int)
+    parser.add_argument('--master-port', help='port of the rank 0 process', default=29500, type=int)
     return parser.parse_args()
 
 
-def main():
-    opt = get_options()
+def train(opt, distributed: bool = False):
     level = logging.DEBUG if opt.debug else logging.INFO
+    if distributed and int(os.getenv('RANK', 0)) != 0:
+        level = logging.WARNING
     logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s', level=level, datefmt='%Y-%m-%d %H:%M:%S')
     # train model
     trainer = Trainer(
@@ -52,13 +66,32 @@ def main():
         max_length_output=opt.max_length_output,
         fp16=opt.fp16,
         gradient_accumulation_steps=opt.gradient_accumulation_steps,
-        label_smoothing=opt.label_smoothing
+        label_smoothing=opt.label_smoothing,
+        dynamic_padding=opt.dynamic_padding,
+        packing=opt.packing,
+        max_tokens=opt.max_tokens,
+        distributed=distributed
     )
     trainer.train(
         epoch_save=opt.epoch_save,
         interval=opt.interval,
         num_workers=opt.num_workers,
-        activate_tensorboard=opt.activate_tensorboard)
+        activate_tensorboard=opt.activate_tensorboard,
+        step_save=opt.step_save,
+        keep_last=opt.keep_last)
+
+
+def main():
+    opt = get_options()
+    if opt.nproc > 1:
+        launch(train, opt.nproc, opt, True, master_port=opt.master_port)
+    elif 'WORLD_SIZE' in os.environ:  # launched by torchrun
+        try:
+            train(opt, True)
+        finally:
+            cleanup()
+    else:
+        train(opt)
 
 
 if __name__ == '__main__':
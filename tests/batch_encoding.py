@@ -0,0 +1,44 @@
+""" Check that the batched encoding (`EncodePlus.batch_encode_plus`) is identical to the per-example `encode_plus`. """
+from itertools import product
+
+from t5qg.lm_t5 import EncodePlus
+from t5qg.exceptions import ExceedMaxLengthError, HighlightNotFoundError
+from tiny_model import get_tokenizer
+
+tokenizer = get_tokenizer()
+context = "Nintendo Co., Ltd. is a Japanese multinational consumer electronics and video game company headquartered " \
+          "in Kyoto. The company was founded in 1889 as Nintendo Karuta by craftsman Fusajiro Yamauchi and " \
+          "originally produced handmade hanafuda playing cards."
+data = [
+    ('Nintendo is a game company.', 'What is Nintendo?', None),
+    (context, 'Who founded Nintendo?', 'Fusajiro Yamauchi'),  # overflow of the input with the small max length
+    (context[:80], 'Where is Nintendo?', 'Kyoto'),  # highlight not in the context
+    (context[:100], 'Where is the headquarter of Nintendo located in and when was it founded by the craftsman?',
+     'Kyoto'),  # overflow of the output
+    ('<hl> Nintendo <hl> is a game company.', 'What is Nintendo?', None),  # highlight token in the input
+    ('The company was founded in 1889.', 'When was the company founded?', '1889')
+]
+
+
+def encode(f, batch: bool, inputs):
+    try:
+        if batch:
+            out = f.batch_encode_plus(inputs, chunk_size=4)
+        else:
+            out = [f(i) for i in inputs]
+    except (ExceedMaxLengthError, HighlightNotFoundError):
+        # the batched path checks all the highlights before the length, so the first error can be of the other type
+        return 'error'
+    return [None if o is None else {k: list(v) for k, v in o.items()} for o in out]
+
+
+for max_length, padding, drop_overflow_text, skip_overflow_error, skip_highlight_error, task_prefix in product(
+        [32, 512], [True, False], [True, False], [True, False], [True, False], [None, 'qg']):
+    config = dict(max_length=max_length, max_length_output=16, padding=padding, task_prefix=task_prefix,
+                  drop_overflow_text=drop_overflow_text, skip_overflow_error=skip_overflow_error,
+                  skip_highlight_error=skip_highlight_error)
+    f = EncodePlus(tokenizer, **config)
+    for inputs in [data, [(i[0], i[1]) for i in data], [(i[0],) for i in data]]:
+        single, batched = encode(f, False, inputs), encode(f, True, inputs)
+        assert single == batched, '{}\n{}\n{}'.format(config, single, batched)
+    print('ok: {}'.format(config))
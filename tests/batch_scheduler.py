@@ -0,0 +1,62 @@
+""" Check the micro-batching scheduler: the requests of a batch get the predictions of the model called one by one,
+and the error of a request (the highlight not in the context, the input exceeding the max length) is raised to the
+request only, not to the other requests of the batch. """
+import asyncio
+import tempfile
+
+from t5qg import T5
+from t5qg.batch_scheduler import BatchScheduler
+from t5qg.exceptions import ExceedMaxLengthError, HighlightNotFoundError
+from tiny_model import save_model
+
+context = "Nintendo Co., Ltd. is a Japanese multinational consumer electronics and video game company headquartered " \
+          "in Kyoto. The company was founded in 1889 as Nintendo Karuta by craftsman Fusajiro Yamauchi and " \
+          "originally produced handmade hanafuda playing cards."
+requests = [
+    ('Nintendo is in Kyoto.', 'Kyoto'),
+    (context, 'Fusajiro Yamauchi'),  # exceeds the max length
+    ('The company was founded in 1889.', 'Kyoto'),  # highlight not in the context
+    ('The company was founded in 1889.', '1889'),
+    ('Nintendo is a game company.', 'game company')
+]
+
+
+class CountT5(T5):
+    """ T5 counting the model calls and their batch size. """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.calls = []
+
+    def generate_prediction(self, list_context, **kwargs):
+        self.calls.append(len(list_context))
+        return super().generate_prediction(list_context, **kwargs)
+
+
+async def main(model, skip_overflow_error: bool = False):
+    scheduler = BatchScheduler(model, max_batch_size=8, max_wait_ms=100, skip_overflow_error=skip_overflow_error)
+    out = await asyncio.gather(*[scheduler.generate_q(c, h) for c, h in requests], return_exceptions=True)
+    await scheduler.stop()
+    return out
+
+
+with tempfile.TemporaryDirectory() as tmp:
+    model = CountT5(save_model('{}/model'.format(tmp), initializer_factor=10.0), max_length=32,
+                    max_length_output=8)
+    out = asyncio.run(main(model))
+    assert isinstance(out[1], ExceedMaxLengthError), out[1]
+    assert isinstance(out[2], HighlightNotFoundError), out[2]
+    # the valid requests of the batch, then each of them alone to find the overflow
+    assert model.calls == [4, 1, 1, 1, 1], model.calls
+    for n in [0, 3, 4]:
+        c, h = requests[n]
+        assert out[n] == model.generate_q([c], [h])[0], (n, out[n])
+    print(out)
+
+    # the overflow input is truncated instead
+    model.calls = []
+    out = asyncio.run(main(model, skip_overflow_error=True))
+    assert isinstance(out[2], HighlightNotFoundError), out[2]
+    assert all(isinstance(out[n], str) for n in [0, 1, 3, 4]), out
+    assert model.calls == [4], model.calls
+print('ok')
@@ -0,0 +1,67 @@
+""" Check the batch samplers: each example is drawn once per epoch, each batch of the token budget is within the
+budget after padding, and the length agrees with the iteration including the skipped batches of the resume. """
+import random
+from itertools import chain, product
+
+from t5qg.batching import RandomBatchSampler, BucketBatchSampler, TokenBudgetBatchSampler
+
+MAX_TOKENS = 64
+rng = random.Random(0)
+lengths = [rng.randint(1, 24) for _ in range(103)]
+label_lengths = [rng.randint(1, 8) for _ in range(103)]
+
+
+def get_samplers(shuffle: bool, drop_last: bool, num_replicas: int = 1, rank: int = 0):
+    return {
+        'random': RandomBatchSampler(len(lengths), 8, shuffle=shuffle, drop_last=drop_last, seed=0,
+                                     num_replicas=num_replicas, rank=rank),
+        'bucket': BucketBatchSampler(lengths, 8, shuffle=shuffle, drop_last=drop_last, bucket_size=3, seed=0,
+                                     num_replicas=num_replicas, rank=rank),
+        'token': TokenBudgetBatchSampler(lengths, label_lengths, MAX_TOKENS, shuffle=shuffle, drop_last=drop_last,
+                                         pool_size=30, seed=0, num_replicas=num_replicas, rank=rank)}
+
+
+for shuffle, drop_last in product([True, False], [True, False]):
+    for name, sampler in get_samplers(shuffle, drop_last).items():
+        for epoch in range(3):
+            sampler.set_epoch(epoch)
+            batches = list(sampler)
+            assert len(batches) == len(sampler), (name, len(batches), len(sampler))
+            index = list(chain(*batches))
+            assert len(index) == len(set(index)), 'example drawn twice: {}'.format(name)
+            if not drop_last:
+                assert sorted(index) == list(range(len(lengths))), 'example not drawn: {}'.format(name)
+            if name == 'token':
+                for batch in batches:
+                    padded = len(batch) * (max(lengths[i] for i in batch) + max(label_lengths[i] for i in batch))
+                    assert padded <= MAX_TOKENS or len(batch) == 1, (batch, padded)
+            # resume within the epoch: the remaining batches of the same shuffle
+            sampler.set_epoch(epoch, skip=3)
+            assert list(sampler) == batches[3:] and len(sampler) == len(batches) - 3, name
+            sampler.set_epoch(epoch, skip=len(batches) + 1)
+            assert list(sampler) == [] and len(sampler) == 0, name
+print('coverage, budget, skip: ok')
+
+# drop_last of the token budget does not always drop the longest examples
+drawn = set()
+sampler = TokenBudgetBatchSampler(lengths, label_lengths, MAX_TOKENS, drop_last=True, seed=0)
+for epoch in range(10):
+    sampler.set_epoch(epoch)
+    drawn.update(chain(*sampler))
+longest = max(range(len(lengths)), key=lambda x: lengths[x])
+assert longest in drawn, 'the longest example is always dropped'
+print('drop last: ok')
+
+# the replicas share the batches without overlap and have the same number of batches
+for shuffle, drop_last in product([True, False], [True, False]):
+    for name in ['random', 'bucket', 'token']:
+        samplers = [get_samplers(shuffle, drop_last, 2, rank)[name] for rank in range(2)]
+        for sampler in samplers:
+            sampler.set_epoch(1, skip=2)
+        batches = [list(sampler) for sampler in samplers]
+        assert len(batches[0]) == len(batches[1]) == len(samplers[0]) == len(samplers[1]), name
+        if drop_last:
+            index = [list(chain(*b)) for b in batches]
+            assert not set(index[0]) & set(index[1]), name
+print('replicas: ok')
+print('ok')
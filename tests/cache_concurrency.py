@@ -0,0 +1,65 @@
+""" Check that the feature cache and the cache manifest are safe to share across concurrent jobs. """
+import os
+import tempfile
+import time
+from multiprocessing import Process, Event
+
+from t5qg.cache import CacheManifest
+from t5qg.feature_cache import save_feature, load_feature
+
+NUM_PROCESS = 8
+features = [{'input_ids': list(range(n + 1)), 'attention_mask': [1] * (n + 1), 'labels': [n, 1]} for n in range(500)]
+
+
+def build(cache_dir):
+    save_feature(features, cache_dir, 'fingerprint')
+    dataset = load_feature(cache_dir, 'fingerprint')
+    assert len(dataset) == len(features)
+    assert dataset[10]['input_ids'].tolist() == features[10]['input_ids']
+
+
+def hold(root, path, ready, done):
+    manifest = CacheManifest(root, max_size_gb=None, grace=0)
+    manifest.lease(path)
+    manifest.touch(path)
+    ready.set()
+    done.wait()
+
+
+with tempfile.TemporaryDirectory() as root:
+    # concurrent builders of the same entry: every builder loads the same complete cache
+    cache_dir = '{}/feature'.format(root)
+    jobs = [Process(target=build, args=(cache_dir,)) for _ in range(NUM_PROCESS)]
+    for j in jobs:
+        j.start()
+    for j in jobs:
+        j.join()
+    assert all(j.exitcode == 0 for j in jobs), [j.exitcode for j in jobs]
+    assert not any('.tmp.' in i for i in os.listdir(root)), os.listdir(root)
+    print('concurrent build: ok')
+
+    # an entry leased by a live process is not evicted, and it is evicted after the process exits
+    entry_a, entry_b = '{}/a'.format(root), '{}/b'.format(root)
+    for p in [entry_a, entry_b]:
+        save_feature(features, p, 'fingerprint')
+    ready, done = Event(), Event()
+    job = Process(target=hold, args=(root, entry_a, ready, done))
+    job.start()
+    ready.wait()
+    time.sleep(0.01)
+    manifest = CacheManifest(root, max_size_gb=1e-9, grace=0)  # the limit is exceeded by any entry
+    manifest.touch(entry_b)
+    assert os.path.exists(entry_a), 'leased entry was evicted'
+    done.set()
+    job.join()
+    manifest.touch(entry_b)
+    assert not os.path.exists(entry_a), 'entry of the finished job was not evicted'
+    assert os.path.exists(entry_b)
+    print('lease: ok')
+
+    # an entry accessed within the grace window is not evicted
+    save_feature(features, entry_a, 'fingerprint')
+    CacheManifest(root, max_size_gb=None).touch(entry_a)
+    CacheManifest(root, max_size_gb=1e-9, grace=3600).touch(entry_b)
+    assert os.path.exists(entry_a), 'recently used entry was evicted'
+    print('grace: ok')
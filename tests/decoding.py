@@ -0,0 +1,31 @@
+""" Check the decoding policy, including the highlights of None from the sentence splitter. """
+from t5qg.decoding import DecodingPolicy, highlight_length
+
+
+def tokenizer(list_text):
+    """ Whitespace tokenizer with the interface of the huggingface tokenizer (raising on None as it does). """
+    for t in list_text:
+        if not isinstance(t, str):
+            raise ValueError('input must be str: {}'.format(t))
+    return {'input_ids': [t.split(' ') + ['</s>'] for t in list_text]}
+
+
+# regression: None highlights (eg. the empty segment after a trailing `।` of BengaliSplitter) are skipped
+assert highlight_length(tokenizer, ['a b c', None, 'd']) == 4
+assert highlight_length(tokenizer, [None, None]) == 0
+assert highlight_length(tokenizer, None) is None
+assert highlight_length(tokenizer, []) is None
+
+policy = DecodingPolicy()
+decoding = policy.resolve('ans_ext', max_length_output=32,
+                          highlight_length=highlight_length(tokenizer, ['a b c', None]))
+assert decoding['max_length_output'] == 6, decoding
+assert decoding['num_beams'] == 1, decoding
+decoding = policy.resolve('qg', max_length_output=32, highlight_length=1)
+assert decoding['max_length_output'] == 32 and decoding['num_beams'] == 4, decoding
+
+# latency budget lowers the number of beams by the measured cost
+policy = DecodingPolicy(latency_budget=1.0)
+policy.update('qg', num_beams=4, batch_size=1, elapsed=2.0)  # 0.5 sec per beam
+assert policy.resolve('qg', batch_size=1)['num_beams'] == 2
+print('ok')
@@ -0,0 +1,78 @@
+""" Check the distributed training on CPU with the gloo backend in 2 local processes: the gradients are averaged over
+the processes (with the accumulation under `no_sync`), the batches are sharded without overlap, and only the rank 0
+process writes the checkpoints. """
+import copy
+import os
+import socket
+import tempfile
+from contextlib import nullcontext
+from types import SimpleNamespace
+
+import torch
+import transformers
+from t5qg.batching import RandomBatchSampler
+from t5qg.checkpoint import StepCheckpointer
+from t5qg.distributed import launch, init_distributed, barrier, all_gather_object
+from t5qg.trainer import Trainer
+
+NUM_PROCESS = 2
+ACCUMULATION = 2
+config = transformers.T5Config(vocab_size=32, d_model=16, d_kv=4, d_ff=32, num_layers=1, num_heads=2,
+                               dropout_rate=0.0, decoder_start_token_id=0, pad_token_id=0)
+
+
+def get_batch(seed: int):
+    generator = torch.Generator().manual_seed(seed)
+    return {'input_ids': torch.randint(1, 32, (3, 7), generator=generator),
+            'labels': torch.randint(1, 32, (3, 5), generator=generator)}
+
+
+def run(checkpoint_dir: str):
+    rank, world_size = init_distributed('gloo')
+    assert world_size == NUM_PROCESS
+
+    # gradients: the micro-batches of the rank accumulated under no_sync and all-reduced at the last one
+    torch.manual_seed(0)
+    model = transformers.T5ForConditionalGeneration(config)
+    reference = copy.deepcopy(model)
+    ddp = torch.nn.parallel.DistributedDataParallel(model)
+    batches = [get_batch(n) for n in range(world_size * ACCUMULATION)]
+    for k in range(ACCUMULATION):
+        with ddp.no_sync() if k < ACCUMULATION - 1 else nullcontext():
+            ddp(**batches[rank * ACCUMULATION + k]).loss.backward()
+    # reference: all the micro-batches in a single process, averaged over the processes
+    for batch in batches:
+        reference(**batch).loss.backward()
+    for (name, p), q in zip(model.named_parameters(), reference.parameters()):
+        torch.testing.assert_close(p.grad, q.grad / world_size, rtol=1e-5, atol=1e-6, msg=name)
+
+    # sampler: the batches of the ranks are disjoint and cover the examples
+    sampler = RandomBatchSampler(12, 2, drop_last=True, seed=1, num_replicas=world_size, rank=rank)
+    sampler.set_epoch(3)
+    indices = [i for b in all_gather_object(list(sampler)) for batch in b for i in batch]
+    assert sorted(indices) == list(range(12)), indices
+
+    # checkpoint: every rank joins the step save, and only the rank 0 process writes
+    trainer = SimpleNamespace(
+        distributed=True, is_main=rank == 0, model=SimpleNamespace(model=ddp, parallel=True),
+        optimizer=torch.optim.SGD(ddp.parameters(), lr=0.1), scheduler=None,
+        scaler=torch.cuda.amp.GradScaler(enabled=False),
+        step_checkpointer=StepCheckpointer('{}/rank_{}'.format(checkpoint_dir, rank)))
+    Trainer.save_step(trainer, epoch=0, batch=ACCUMULATION, global_step=1, loss=[0.0])
+    trainer.step_checkpointer.wait()
+    barrier()
+    if rank == 0:
+        assert os.listdir('{}/rank_0/steps'.format(checkpoint_dir)) == ['step_1.pt']
+        assert not os.path.exists('{}/rank_1'.format(checkpoint_dir))
+        state = trainer.step_checkpointer.load()
+        assert len(state['rng']) == world_size  # RNG state of every process
+        assert state['model'].keys() == model.state_dict().keys()
+
+
+if __name__ == '__main__':
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    with tempfile.TemporaryDirectory() as tmp:
+        launch(run, NUM_PROCESS, tmp, master_port=port)
+    print('ok')
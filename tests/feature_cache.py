@@ -0,0 +1,60 @@
+""" Check the memory-mapped feature cache: the features are loaded as saved (also in a worker process), and a missing
+or stale cache (of another fingerprint or cache version) is not loaded. """
+import json
+import pickle
+import tempfile
+
+import torch
+from t5qg.feature_cache import save_feature, load_feature, feature_fingerprint, CACHE_VERSION
+from tiny_model import get_tokenizer
+
+features = [{'input_ids': list(range(n % 7 + 1)), 'attention_mask': [1] * (n % 7 + 1), 'labels': [n, 1]}
+            for n in range(50)]
+
+
+def check(dataset):
+    assert len(dataset) == len(features), len(dataset)
+    assert dataset.lengths('input_ids') == [len(f['input_ids']) for f in features]
+    for n, f in enumerate(features):
+        for k, v in f.items():
+            assert dataset[n][k].tolist() == v, (n, k)
+    assert dataset[0]['input_ids'].dtype == torch.long and dataset[0]['attention_mask'].dtype == torch.float32
+
+
+with tempfile.TemporaryDirectory() as tmp:
+    # fingerprint of the tokenizer and the preprocessing parameters
+    tokenizer = get_tokenizer()
+    fingerprint = feature_fingerprint(tokenizer, max_length=32)
+    assert fingerprint == feature_fingerprint(get_tokenizer(), max_length=32)
+    assert fingerprint != feature_fingerprint(tokenizer, max_length=64)
+    tokenizer.add_tokens(['<new>'])
+    assert fingerprint != feature_fingerprint(tokenizer, max_length=32)
+
+    # save and load
+    cache_dir = '{}/feature'.format(tmp)
+    assert load_feature(cache_dir, fingerprint) is None, 'missing cache is loaded'
+    save_feature(features, cache_dir, fingerprint)
+    check(load_feature(cache_dir, fingerprint))
+    check(load_feature(cache_dir))
+    # the memory map is re-opened after pickling (DataLoader worker)
+    check(pickle.loads(pickle.dumps(load_feature(cache_dir, fingerprint))))
+    # the existing cache is kept
+    save_feature(features[:10], cache_dir, fingerprint)
+    check(load_feature(cache_dir, fingerprint))
+    print('save and load: ok')
+
+    # stale cache
+    assert load_feature(cache_dir, 'other') is None, 'cache of another fingerprint is loaded'
+    with open('{}/meta.json'.format(cache_dir)) as f:
+        meta = json.load(f)
+    meta['version'] = CACHE_VERSION - 1
+    with open('{}/meta.json'.format(cache_dir), 'w') as f:
+        json.dump(meta, f)
+    assert load_feature(cache_dir, fingerprint) is None, 'cache of another version is loaded'
+    print('stale: ok')
+
+    # empty features
+    save_feature([], '{}/empty'.format(tmp), fingerprint)
+    assert len(load_feature('{}/empty'.format(tmp), fingerprint)) == 0
+    print('empty: ok')
+print('ok')
@@ -0,0 +1,49 @@
+""" Check the chunked label-smoothed loss against `label_smoothed_loss` (values and gradients). """
+import torch
+from t5qg.lm_t5 import label_smoothed_loss, chunked_label_smoothed_loss, CE_IGNORE_INDEX
+
+torch.manual_seed(0)
+BATCH, LENGTH, VOCAB = 4, 13, 1000
+
+for epsilon in [0.0, 0.1, 0.3]:
+    for reduction in ['mean', 'sum']:
+        for chunk_size in [1, 7, 1024]:
+            logits = torch.randn(BATCH, LENGTH, VOCAB, dtype=torch.float64)
+            labels = torch.randint(0, VOCAB, (BATCH, LENGTH))
+            labels[:, -4:] = CE_IGNORE_INDEX  # padding
+            labels[0, 5] = CE_IGNORE_INDEX
+
+            logits_ref = logits.clone().requires_grad_()
+            loss_ref = label_smoothed_loss(logits_ref, labels.clone(), epsilon, reduction)
+            loss_ref.backward()
+
+            logits_chunk = logits.clone().requires_grad_()
+            loss_chunk = chunked_label_smoothed_loss(logits_chunk, labels, epsilon, reduction, chunk_size=chunk_size)
+            loss_chunk.backward()
+
+            # the fp64 logits are not downcast
+            assert loss_chunk.dtype == torch.float64, loss_chunk.dtype
+            # (up to the reference summing the smoothed loss in fp32)
+            torch.testing.assert_close(loss_chunk, loss_ref, rtol=1e-6, atol=1e-6)
+            torch.testing.assert_close(logits_chunk.grad, logits_ref.grad, rtol=1e-5, atol=1e-7)
+            # labels are not modified in place
+            assert labels.eq(CE_IGNORE_INDEX).sum() == BATCH * 4 + 1
+            print('epsilon: {}, reduction: {}, chunk: {}, loss: {}'.format(
+                epsilon, reduction, chunk_size, loss_chunk.item()))
+
+# the half precision logits are upcast to fp32
+logits = torch.randn(BATCH, LENGTH, VOCAB)
+labels = torch.randint(0, VOCAB, (BATCH, LENGTH))
+loss = chunked_label_smoothed_loss(logits.bfloat16(), labels, 0.1, chunk_size=5)
+assert loss.dtype == torch.float32, loss.dtype
+torch.testing.assert_close(
+    loss, label_smoothed_loss(logits.bfloat16().float(), labels.clone(), 0.1), rtol=1e-5, atol=1e-5)
+
+# no gradient
+with torch.no_grad():
+    logits = torch.randn(BATCH, LENGTH, VOCAB)
+    labels = torch.randint(0, VOCAB, (BATCH, LENGTH))
+    torch.testing.assert_close(
+        chunked_label_smoothed_loss(logits, labels, 0.1, chunk_size=5),
+        label_smoothed_loss(logits, labels.clone(), 0.1), rtol=1e-5, atol=1e-5)
+print('ok')
@@ -0,0 +1,103 @@
+""" Check the model registry: the model of a request, the lazy load, the eviction of the least recently used model
+under the memory budget, and the swap of a model with a request in flight. """
+import asyncio
+import threading
+
+import torch
+from t5qg.batch_scheduler import BatchScheduler
+from t5qg.decoding import DecodingPolicy
+from t5qg.exceptions import ModelNotFoundError
+from t5qg.model_registry import ModelRegistry
+
+SIZE = 1 << 20  # bytes of each model
+
+
+class FakeModel:
+    """ Model of 1MB weights generating its own path, of which the prediction waits for the event if any. """
+
+    def __init__(self, path: str, event=None):
+        self.path = path
+        self.event = event
+        self.model = torch.nn.Linear(SIZE // 4, 1, bias=False)
+        self.startup_time = {}
+        self.decoding_policy = DecodingPolicy()
+
+    def generate_prediction(self, list_context, **kwargs):
+        if self.event is not None:
+            self.event.wait()
+        return ['{}: {}'.format(self.path, c) for c in list_context]
+
+
+loaded = []
+
+
+def loader(name, path):
+    loaded.append(name)
+    return FakeModel(path)
+
+
+async def predict(registry, name=None, language=None):
+    async with registry.acquire(name, language) as scheduler:
+        return await scheduler.generate_q('context')
+
+
+async def main():
+    registry = ModelRegistry({'a': 'path_a', 'b': 'path_b', 'c': 'path_c'}, loader=loader,
+                             scheduler_factory=BatchScheduler, languages={'ja': 'b'}, default='a',
+                             max_memory_gb=2.5 * SIZE / (1 << 30))  # two models fit in the budget
+
+    # model of the request
+    assert registry.resolve('c', 'ja') == 'c'
+    assert registry.resolve(language='ja') == 'b'
+    assert registry.resolve(language='en') == 'a', 'language without the model falls back to the default'
+    assert registry.resolve() == 'a'
+    try:
+        registry.resolve('d')
+        raise AssertionError('unknown model is resolved')
+    except ModelNotFoundError:
+        pass
+    print('resolve: ok')
+
+    # lazy load: each model is loaded at its first request only
+    assert loaded == [] and len(registry.entries) == 0
+    assert await predict(registry) == 'path_a: context'
+    assert await predict(registry, language='en') == 'path_a: context'
+    assert loaded == ['a'], loaded
+    print('lazy load: ok')
+
+    # eviction of the least recently used model
+    await predict(registry, 'b')
+    await predict(registry, 'a')  # `b` is the least recently used
+    entry_b = registry.entries['b']
+    await predict(registry, 'c')
+    assert list(registry.entries.keys()) == ['a', 'c'], list(registry.entries.keys())
+    assert entry_b.model is None and entry_b.scheduler is None, 'evicted model is not unloaded'
+    await predict(registry, 'b')
+    assert list(registry.entries.keys()) == ['c', 'b'] and loaded == ['a', 'b', 'c', 'b'], loaded
+    print('eviction: ok')
+
+    # model of a request in flight is not evicted
+    async with registry.acquire('c'):
+        await predict(registry, 'a')
+        assert list(registry.entries.keys()) == ['c', 'a'], list(registry.entries.keys())
+    print('in flight: ok')
+
+    # swap with a request in flight: the request is served by the old model, and the new requests by the new one
+    event = threading.Event()
+    registry.entries['a'].model.event = event
+    old = registry.entries['a']
+    request = asyncio.ensure_future(predict(registry, 'a'))
+    await asyncio.sleep(0.1)
+    assert old.refcount == 1
+    await registry.swap('a', 'path_a_new')
+    assert old.model is not None and old.retired, 'old model is unloaded with a request in flight'
+    assert await predict(registry, 'a') == 'path_a_new: context'
+    event.set()
+    assert await request == 'path_a: context'
+    assert old.model is None, 'old model is not unloaded after the request'
+    assert registry.models['a'] == 'path_a_new'
+    print('swap: ok')
+    await registry.close()
+
+
+asyncio.run(main())
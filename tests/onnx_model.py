@@ -0,0 +1,57 @@
+""" Check that the decoding of the exported ONNX graphs (`OnnxT5`) is identical to `generate` of the eager model, for
+the greedy and the beam search. Requires `pip install onnx onnxruntime`. """
+import tempfile
+from itertools import product
+
+import numpy as np
+from t5qg import T5
+from t5qg.onnx_model import export_onnx, OnnxT5
+from tiny_model import save_model
+
+MAX_LENGTH_OUTPUT = 12
+context = ['Nintendo is in Kyoto.', 'The company was founded in 1889 by craftsman Fusajiro Yamauchi.',
+           'Where is the game company?', 'Nintendo Karuta originally produced handmade hanafuda playing cards.']
+highlight = ['Kyoto', 'Fusajiro Yamauchi', 'game', 'hanafuda']
+
+
+def onnx_generate(model: OnnxT5, encode, num_beams: int, early_stopping: bool):
+    """ Tokens of `OnnxT5.generate_batch` before the detokenization. """
+    input_ids, attention_mask = encode['input_ids'].numpy(), encode['attention_mask'].numpy()
+    hidden = model.run('encoder', input_ids=input_ids, attention_mask=attention_mask)[0]
+    if num_beams == 1:
+        return model.greedy_search(hidden, attention_mask, MAX_LENGTH_OUTPUT)
+    return model.beam_search(np.repeat(hidden, num_beams, axis=0), np.repeat(attention_mask, num_beams, axis=0),
+                             num_beams, MAX_LENGTH_OUTPUT, early_stopping=early_stopping)
+
+
+def strip(tokens, pad: int):
+    tokens = [int(i) for i in tokens]
+    while len(tokens) > 1 and tokens[-1] == pad:
+        tokens.pop()
+    return tokens
+
+
+with tempfile.TemporaryDirectory() as tmp:
+    for seed in range(3):
+        # large initial weights, so that the random model generates various tokens and stops at various steps
+        save_model('{}/{}'.format(tmp, seed), seed=seed, initializer_factor=10.0)
+        export_onnx('{}/{}'.format(tmp, seed), '{}/{}_onnx'.format(tmp, seed))
+        model = T5('{}/{}'.format(tmp, seed), max_length=64, max_length_output=MAX_LENGTH_OUTPUT)
+        onnx_model = OnnxT5('{}/{}_onnx'.format(tmp, seed), max_length=64, max_length_output=MAX_LENGTH_OUTPUT)
+        pad = model.tokenizer.pad_token_id
+        encode = model.tokenizer(['{} {}'.format(h, c) for c, h in zip(context, highlight)], padding=True,
+                                 return_tensors='pt')
+        for num_beams, early_stopping in product([1, 2, 4], [True, False]):
+            tokens = model.model.generate(**encode, num_beams=num_beams, max_length=MAX_LENGTH_OUTPUT,
+                                          early_stopping=early_stopping)
+            tokens_onnx = onnx_generate(onnx_model, encode, num_beams, early_stopping)
+            assert [strip(i, pad) for i in tokens] == [strip(i, pad) for i in tokens_onnx], \
+                'seed: {}, num_beams: {}, early_stopping: {}\n{}\n{}'.format(
+                    seed, num_beams, early_stopping, tokens.tolist(), [i.tolist() for i in tokens_onnx])
+        # the whole prediction including the encoding and the detokenization
+        for num_beams in [1, 4]:
+            output = model.generate_q(context, highlight, num_beams=num_beams)
+            output_onnx = onnx_model.generate_q(context, highlight, num_beams=num_beams)
+            assert output == output_onnx, '{}\n{}'.format(output, output_onnx)
+        print('seed {}: ok ({})'.format(seed, output))
+print('ok')
@@ -0,0 +1,57 @@
+""" Check that the loss of the packed rows (`T5.packed_loss`) is the sum of the losses of each example unpacked. """
+import torch
+import transformers
+from t5qg.batching import PackedDataset, DynamicPaddingCollator
+from t5qg.lm_t5 import T5, Dataset, CE_IGNORE_INDEX
+
+config = transformers.T5Config(vocab_size=32, d_model=16, d_kv=4, d_ff=32, num_layers=2, num_heads=2,
+                               dropout_rate=0.0, decoder_start_token_id=0, pad_token_id=0, eos_token_id=1)
+
+
+class TinyT5(T5):
+    """ T5 of the randomly initialized small model (no checkpoint to download). """
+
+    def __init__(self, label_smoothing: float = None):
+        torch.manual_seed(0)
+        self.model = transformers.T5ForConditionalGeneration(config).double()
+        self.model.train()
+        self.parallel = False
+        self.device = 'cpu'
+        self.label_smoothing = label_smoothing
+
+
+generator = torch.Generator().manual_seed(0)
+data = []
+for _ in range(12):
+    length, label_length = torch.randint(2, 10, (2,), generator=generator).tolist()
+    data.append({'input_ids': torch.randint(2, 32, (length,), generator=generator).tolist() + [1],
+                 'labels': torch.randint(2, 32, (label_length,), generator=generator).tolist() + [1]})
+dataset = Dataset(data)
+packed = PackedDataset(dataset, max_length=24, max_length_output=12, decoder_start_token_id=0)
+assert len(packed) < len(dataset), 'no example is packed'
+assert max(packed.lengths('labels')) <= 12, packed.lengths('labels')
+assert len(PackedDataset(Dataset([]), max_length=24)) == 0, 'empty dataset'
+collator = DynamicPaddingCollator(config.pad_token_id, CE_IGNORE_INDEX)
+
+for label_smoothing in [None, 0.1]:
+    model = TinyT5(label_smoothing)
+    # the packed rows padded in a batch
+    loss = model.encode_to_loss(collator([packed[i] for i in range(len(packed))]), reduction='sum')
+    # each example by itself
+    loss_ref = sum(model.encode_to_loss(collator([dataset[i]]), reduction='sum') for i in range(len(dataset)))
+    torch.testing.assert_close(loss, loss_ref)
+    if label_smoothing is None:  # the sum from the logits is consistent with the mean loss of the model
+        batch = collator([dataset[i] for i in range(len(dataset))])
+        num_tokens = batch['labels'].ne(CE_IGNORE_INDEX).sum()
+        torch.testing.assert_close(
+            model.encode_to_loss(batch, reduction='sum'), model.encode_to_loss(batch) * num_tokens)
+    # the gradients as well
+    model.model.zero_grad()
+    loss.backward()
+    grad = [p.grad.clone() for p in model.model.parameters()]
+    model.model.zero_grad()
+    loss_ref.backward()
+    for g, p in zip(grad, model.model.parameters()):
+        torch.testing.assert_close(g, p.grad)
+    print('label smoothing: {}, loss: {}, rows: {}/{}'.format(label_smoothing, loss.item(), len(packed), len(dataset)))
+print('ok')
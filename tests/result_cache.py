@@ -0,0 +1,80 @@
+""" Check the result cache: the key of the normalized input, the eviction of the least recently used entry by the
+number and the size of the entries, the expiry by TTL, and the persistence of the sqlite tier across restarts. """
+import os
+import tempfile
+
+import t5qg.result_cache
+from t5qg.result_cache import ResultCache
+
+
+class Clock:
+    """ Clock of the cache advanced by the test instead of waiting. """
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+clock = Clock()
+t5qg.result_cache.time = clock
+
+# key of the normalized input and the decoding config
+key = ResultCache.key('Nintendo is  in\nKyoto. ', 'Kyoto', num_beams=4)
+assert key == ResultCache.key('Nintendo is in Kyoto.', ' Kyoto', num_beams=4)
+assert key != ResultCache.key('Nintendo is in Kyoto.', 'Kyoto', num_beams=1)
+assert key != ResultCache.key('Nintendo is in Kyoto.', None, num_beams=4)
+print('key: ok')
+
+# eviction of the least recently used entry
+cache = ResultCache(max_entries=2)
+cache.set('a', 'A')
+cache.set('b', 'B')
+assert cache.get('a') == 'A'  # `b` is the least recently used
+cache.set('c', 'C')
+assert cache.get('b') is None and cache.get('a') == 'A' and cache.get('c') == 'C'
+assert cache.stats()['hit'] == 3 and cache.stats()['miss'] == 1, cache.stats()
+cache = ResultCache(max_bytes=2 * ResultCache.size('a', 'A'))
+for k in 'abc':
+    cache.set(k, k.upper())
+assert list(cache.memory.keys()) == ['b', 'c'] and cache.bytes == 2 * ResultCache.size('a', 'A')
+cache.set('d', 'D' * 100)  # larger than the budget by itself
+assert len(cache.memory) == 0 and cache.bytes == 0, cache.memory
+print('eviction: ok')
+
+# expiry by TTL
+cache = ResultCache(ttl=10)
+cache.set('a', ['A'])
+clock.now += 5
+cache.set('b', ['B'])
+clock.now += 6
+assert cache.get('a') is None, 'expired entry is returned'
+assert cache.get('b') == ['B']
+assert 'a' not in cache.memory and cache.bytes == ResultCache.size('b', ['B'])
+print('ttl: ok')
+
+# sqlite tier: the entries are kept across restarts and expire by TTL as well
+with tempfile.TemporaryDirectory() as tmp:
+    path = os.path.join(tmp, 'cache.sqlite')
+    cache = ResultCache(max_entries=1, ttl=10, path=path)
+    cache.set('a', ['A', 'B'])
+    cache.set('b', ['C'])
+    assert list(cache.memory.keys()) == ['b']
+    assert cache.get('a') == ['A', 'B'], 'evicted entry is not read from the disk'
+    cache.db.close()
+
+    cache = ResultCache(ttl=10, path=path)  # restart
+    assert len(cache.memory) == 0
+    assert cache.get('a') == ['A', 'B'] and cache.get('b') == ['C']
+    clock.now += 11
+    cache.set('c', ['D'])  # the expired entries are deleted from the disk
+    cache.db.close()
+    cache = ResultCache(ttl=10, path=path)
+    assert cache.get('a') is None and cache.get('c') == ['D']
+    assert [r[0] for r in cache.db.execute('SELECT key FROM cache')] == ['c']
+    cache.clear()
+    assert cache.get('c') is None and cache.db.execute('SELECT COUNT(*) FROM cache').fetchone()[0] == 0
+    cache.db.close()
+print('sqlite: ok')
+print('ok')
@@ -0,0 +1,45 @@
+""" Small local tokenizer and T5 checkpoint of random weights for the tests, so that no checkpoint is downloaded. """
+import torch
+import transformers
+from tokenizers import Tokenizer, models, pre_tokenizers, processors, decoders
+from t5qg.lm_t5 import ADDITIONAL_SP_TOKENS
+
+CORPUS = [
+    "Nintendo Co., Ltd. is a Japanese multinational consumer electronics and video game company headquartered in "
+    "Kyoto. The company was founded in 1889 as Nintendo Karuta by craftsman Fusajiro Yamauchi and originally "
+    "produced handmade hanafuda playing cards.",
+    "generate question: extract answers: question: context: answer: What Who Where When How is was the of a in "
+    "located founded headquarter game company craftsman by and it"
+]
+
+
+def get_tokenizer():
+    """ WordPiece tokenizer appending the end of sentence token as the T5 tokenizer (pad: 0, eos: 1, unk: 2). """
+    pre_tokenizer = pre_tokenizers.Whitespace()
+    # the words of the corpus and the characters for the other words (the vocabulary of the WordPiece trainer is
+    # not deterministic)
+    words = sorted(set(w for text in CORPUS for w, _ in pre_tokenizer.pre_tokenize_str(text)))
+    chars = sorted(set(''.join(words)))
+    vocab = ['<pad>', '</s>', '<unk>'] + words + sorted(set(chars) - set(words)) + ['##' + c for c in chars]
+    tokenizer = Tokenizer(models.WordPiece({t: n for n, t in enumerate(vocab)}, unk_token='<unk>'))
+    tokenizer.pre_tokenizer = pre_tokenizer
+    tokenizer.decoder = decoders.WordPiece()
+    tokenizer.post_processor = processors.TemplateProcessing(
+        single='$A </s>', pair='$A </s> $B </s>', special_tokens=[('</s>', 1)])
+    # with the highlight token, so that loading the checkpoint does not add the embedding of random weights
+    return transformers.PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer, pad_token='<pad>', eos_token='</s>', unk_token='<unk>',
+        additional_special_tokens=list(ADDITIONAL_SP_TOKENS.values()),
+        model_input_names=['input_ids', 'attention_mask'])
+
+
+def save_model(path: str, seed: int = 0, **kwargs):
+    """ Save the tokenizer and a T5 checkpoint of random weights, which `t5qg.T5(path)` loads. """
+    tokenizer = get_tokenizer()
+    config = dict(vocab_size=len(tokenizer), d_model=16, d_kv=4, d_ff=32, num_layers=2, num_heads=2,
+                  dropout_rate=0.0, decoder_start_token_id=0, pad_token_id=0, eos_token_id=1)
+    config.update(kwargs)
+    torch.manual_seed(seed)
+    transformers.T5ForConditionalGeneration(transformers.T5Config(**config)).save_pretrained(path)
+    tokenizer.save_pretrained(path)
+    return path
@@ -0,0 +1,78 @@
+""" Check that the training resumed from the step checkpoint within an epoch follows the uninterrupted training: the
+same batches and losses of the following steps, and the same model at the end. """
+import os
+import tempfile
+
+import torch
+import t5qg.trainer
+from t5qg.trainer import Trainer
+from tiny_model import save_model
+
+EPOCH = 2
+STOP = 4  # global step to interrupt the training (6 steps per epoch)
+words = 'Nintendo Kyoto company game founded craftsman Fusajiro Yamauchi cards Japanese video consumer'.split()
+inputs = ['generate question: {} <hl> {} <hl> {}'.format(' '.join(words[:n % 5 + 1]), words[n % len(words)],
+                                                         ' '.join(words[n % 7:])) for n in range(24)]
+outputs = ['Where is {} {}?'.format(words[n % len(words)], words[(3 * n) % len(words)]) for n in range(24)]
+# the dataset of the test instead of the download
+t5qg.trainer.get_dataset = lambda *args, **kwargs: (inputs, outputs)
+
+
+class Interrupt(Exception):
+    pass
+
+
+class RecordTrainer(Trainer):
+    """ Trainer recording the state of each step save, and interrupted at the step if given. """
+
+    def __init__(self, stop: int = None, **kwargs):
+        super().__init__(**kwargs)
+        self.stop = stop
+        self.record = []
+
+    def save_step(self, epoch: int, batch: int, global_step: int, loss):
+        super().save_step(epoch, batch, global_step, loss)
+        self.record.append((epoch, batch, global_step, list(loss)))
+        if global_step == self.stop:
+            self.step_checkpointer.wait()
+            raise Interrupt()
+
+
+def get_trainer(checkpoint_dir: str, model: str, stop: int = None):
+    trainer = RecordTrainer(stop=stop, checkpoint_dir=checkpoint_dir, model=model, max_length=32,
+                            max_length_output=16, epoch=EPOCH, batch=2, lr=1e-3, lr_warmup=2,
+                            gradient_accumulation_steps=2, disable_log=True)
+    trainer.data_cache_dir = '{}/data'.format(checkpoint_dir)
+    return trainer
+
+
+with tempfile.TemporaryDirectory() as tmp:
+    model = save_model('{}/model'.format(tmp))
+
+    # uninterrupted
+    trainer = get_trainer('{}/a/ckpt'.format(tmp), model)
+    trainer.train(step_save=1, keep_last=1)
+    record = trainer.record
+    state = trainer.model.model.state_dict()
+    assert len(record) == EPOCH * 6, len(record)
+    assert os.listdir('{}/a/ckpt/steps'.format(tmp)) == [], 'step checkpoints are left after the epoch checkpoint'
+
+    # interrupted at the step within the first epoch and resumed from the step checkpoint
+    trainer = get_trainer('{}/b/ckpt'.format(tmp), model, stop=STOP)
+    try:
+        trainer.train(step_save=1, keep_last=1)
+        raise AssertionError('training is not interrupted')
+    except Interrupt:
+        pass
+    assert trainer.record == record[:STOP]
+    trainer = get_trainer('{}/b/ckpt'.format(tmp), model)
+    assert trainer.step_state.keys() == {'epoch', 'batch', 'global_step', 'rng', 'loss'}, trainer.step_state.keys()
+    assert (trainer.current_epoch, trainer.current_batch, trainer.global_step) == record[STOP - 1][:3]
+    trainer.train(step_save=1, keep_last=1)
+    for a, b in zip(trainer.record, record[STOP:]):
+        assert a[:3] == b[:3], 'batch position: {} != {}'.format(a[:3], b[:3])
+        torch.testing.assert_close(a[3], b[3])
+    assert len(trainer.record) == len(record) - STOP
+    for k, v in trainer.model.model.state_dict().items():
+        torch.testing.assert_close(v, state[k], msg=k)
+print('ok')